@@ -59,13 +59,15 @@ def config(ctx, setting=[], conf_dir=None):
         conf = LayeredLocalDirs(writable=conf_dir)
     else:
         conf = ctx.parent.conf
-    with conf._writer.exclusive:
-        if len(setting) <= 0:
+    if len(setting) <= 0:
+        with conf._writer.shared:
             for k, v in conf.items():
                 print k
                 print v
+        return
+    with conf.batch() as changes:
         for k, v in setting:
-            conf[k] = v
+            changes[k] = v
 
 
 @drcloud.command()
@@ -73,6 +75,27 @@ def console():
     load_ipython()
 
 
+@drcloud.command()
+@click.pass_context
+@click.option('--spool', type=str, default='/var/spool/drcloud',
+              help='The spool directory to fetch messages into.')
+@click.option('--lifetime', type=int, default=60,
+              help='Seconds to listen for, before exiting.')
+def listen(ctx, spool, lifetime):
+    """Fetch inbox messages as notifications of them arrive, and send the
+       outbox after each, leaving full syncs to drcloud-sync-var-spool.
+    """
+    from .node.channel import notify, s3
+
+    conf = ctx.parent.conf
+    if not conf['aws.sqs']:
+        log.info('No queue is configured (aws.sqs); not listening.')
+        return
+    chan = s3.Channel(spool, conf['service'], conf['aws.s3'],
+                      notifications=notify.SQS(conf['aws.sqs']))
+    chan.watch(period=None, lifetime=lifetime)
+
+
 def load_ipython():
     config_dir = os.path.expanduser('~/.ptpython/')
     history = os.path.join(config_dir, 'drcloud.history')
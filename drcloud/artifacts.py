@@ -0,0 +1,328 @@
+"""A node-local cache of downloaded executables, shared by tasks.
+
+Entries are keyed by URL and live in a directory named for the URL's hash,
+holding the content (``data``), what is known about it (``meta.json``: ETag,
+Last-Modified, SHA-256 and size) and a ``lock``. Using an entry revalidates
+it with a conditional request, so an unchanged artifact is never fetched
+twice; when a task gives the SHA-256 it expects and the entry already has
+that content, no request is made at all.
+
+An entry has two locks. ``lock`` is held while the entry is checked and
+fetched, so that concurrent tasks share a single download. ``use`` is held
+shared for as long as the artifact is in use, so that it is not evicted from
+under a running command; new content is renamed into place, so replacing it
+does not disturb those already running it. Once the cache grows past its
+limit, the least recently used entries not in use are evicted.
+
+Downloads are made in process, streaming to disk: over HTTP(S) with a pool
+of keep-alive connections, and from S3 with a single client, both shared by
+all tasks. ``curl`` is kept as a fallback, for when a connection can not be
+made at all.
+"""
+from collections import namedtuple
+from contextlib import contextmanager
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import subprocess
+import tempfile
+import threading
+from urlparse import urlparse
+
+import boto3
+from botocore.httpsession import get_cert_path
+import urllib3
+
+from . import atomic, cgroup, err
+from .flock import spin
+from .fsdict import mkdir_p
+from .logger import log
+
+
+root = '/var/cache/drcloud/artifacts'
+limit = 1024 * 1024 * 1024
+buffer = 64 * 1024
+
+
+class Cache(object):
+    def __init__(self, root=root, limit=limit, timeout=600):
+        self.root = root
+        self.limit = limit
+        self.timeout = timeout
+
+    @contextmanager
+    def fetch(self, url, fetcher, sha256=None):
+        """Make sure the artifact at ``url`` is cached and yield its path.
+
+        :param fetcher: A function like ``http()``, to download the artifact
+                        if it is missing or has changed.
+        :param sha256: The digest the content must have, if known.
+        """
+        entry = Entry(os.path.join(self.root, key(url)))
+        mkdir_p(entry.path)
+        use = os.open(entry.use, os.O_RDONLY | os.O_CREAT, 0o644)
+        try:
+            spin(use, fcntl.LOCK_SH, self.timeout, entry.use)
+            fd = os.open(entry.lock, os.O_RDONLY | os.O_CREAT, 0o644)
+            try:
+                spin(fd, fcntl.LOCK_EX, self.timeout, entry.lock)
+                self._refresh(entry, url, fetcher, sha256)
+            finally:
+                os.close(fd)
+            self.evict()
+            yield entry.data
+        finally:
+            os.close(use)
+
+    def _refresh(self, entry, url, fetcher, sha256):
+        meta = entry.meta()
+        if meta is not None and sha256 is not None:
+            if meta['sha256'] == sha256:
+                log.debug('Using %s (%s) from the cache.', url, sha256)
+                entry.touch()
+                return
+            meta = None                              # Not what we want
+        tmp = os.path.join(entry.path, '.data.part')
+        try:
+            res = fetcher(url, tmp, etag=(meta or {}).get('etag'),
+                          last_modified=(meta or {}).get('last_modified'))
+            if res.changed:
+                entry.store(tmp, url, res, sha256)
+            else:
+                log.debug('%s is unchanged since it was cached.', url)
+        finally:
+            atomic.unlink(tmp)
+        entry.touch()
+
+    def entries(self):
+        try:
+            names = os.listdir(self.root)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            names = []
+        return [Entry(os.path.join(self.root, name)) for name in names]
+
+    def evict(self):
+        """Remove the least recently used entries, until the cache fits."""
+        entries = [(e.used(), e.size(), e) for e in self.entries()]
+        total = sum(size for _, size, _ in entries)
+        for _, size, e in sorted(entries):
+            if total <= self.limit:
+                break
+            if size > 0 and e.evict():
+                total -= size
+
+
+class Entry(namedtuple('Entry', 'path')):
+    @property
+    def data(self):
+        return os.path.join(self.path, 'data')
+
+    @property
+    def lock(self):
+        return os.path.join(self.path, 'lock')
+
+    @property
+    def use(self):
+        return os.path.join(self.path, 'use')
+
+    @property
+    def info(self):
+        return os.path.join(self.path, 'meta.json')
+
+    def meta(self):
+        """What is known about the cached content, if there is any."""
+        try:
+            with open(self.info) as h:
+                meta = json.load(h)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+        except ValueError:
+            return None
+        return meta if os.path.exists(self.data) else None
+
+    def store(self, tmp, url, res, sha256=None):
+        digest = hash_file(tmp)
+        if sha256 is not None and digest != sha256:
+            raise Err('Content of %s has SHA-256 %s, not %s.' %
+                      (url, digest, sha256))
+        os.chmod(tmp, 0o750)
+        os.rename(tmp, self.data)
+        meta = dict(url=url, etag=res.etag, last_modified=res.last_modified,
+                    sha256=digest, size=os.path.getsize(self.data))
+        atomic.write(self.info, json.dumps(meta, sort_keys=True))
+        return meta
+
+    def touch(self):
+        os.utime(self.info, None)
+
+    def used(self):
+        try:
+            return os.path.getmtime(self.info)
+        except OSError:
+            return 0
+
+    def size(self):
+        try:
+            return os.path.getsize(self.data)
+        except OSError:
+            return 0
+
+    def evict(self):
+        """Remove the content, unless it is in use or being fetched.
+
+        The lock files are left in place, so that everyone keeps locking the
+        same files.
+        """
+        try:
+            fd = os.open(self.use, os.O_RDONLY)
+        except OSError:
+            return False
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            os.close(fd)
+            return False
+        try:
+            log.info('Evicting %s from the artifact cache.', self.path)
+            atomic.unlink(self.info)
+            atomic.unlink(self.data)
+            return True
+        finally:
+            os.close(fd)
+
+
+class Response(namedtuple('Response', 'changed etag last_modified')):
+    """The outcome of a (conditional) download."""
+    pass
+
+
+def http(url, path, etag=None, last_modified=None, insecure=False):
+    """Download over a pooled, keep-alive connection, unless the content is
+       unchanged; fall back to ``curl`` if the connection fails.
+    """
+    headers = {}
+    if etag is not None:
+        headers['If-None-Match'] = etag
+    if last_modified is not None:
+        headers['If-Modified-Since'] = last_modified
+    try:
+        res = session(insecure).request('GET', url, headers=headers,
+                                        preload_content=False,
+                                        retries=urllib3.Retry(2, redirect=5))
+    except urllib3.exceptions.HTTPError as e:
+        log.warning('Falling back to curl for %s: %s', url, e)
+        return curl(url, path, etag, last_modified, insecure)
+    try:
+        if res.status == 304:
+            return Response(False, etag, last_modified)
+        if res.status >= 400:
+            raise Err('Failed to download %s: HTTP %s' % (url, res.status))
+        with open(path, 'wb') as h:
+            for chunk in res.stream(buffer):
+                h.write(chunk)
+        return Response(True, res.headers.get('ETag'),
+                        res.headers.get('Last-Modified'))
+    finally:
+        res.release_conn()
+
+
+def curl(url, path, etag=None, last_modified=None, insecure=False):
+    """Download with ``curl``, unless the content is unchanged."""
+    headers = tempfile.NamedTemporaryFile(suffix='.drcloud')
+    with headers:
+        argv = ['curl', '-sSfL', '--retry', '2', '-o', path, '-D',
+                headers.name, '-w', '%{http_code}']
+        if insecure:
+            argv += ['--insecure']
+        if etag is not None:
+            argv += ['-H', 'If-None-Match: %s' % etag]
+        if last_modified is not None:
+            argv += ['-H', 'If-Modified-Since: %s' % last_modified]
+        code = subprocess.check_output(argv + [url],
+                                       preexec_fn=cgroup.preexec()).strip()
+        found = parse_headers(headers.read())
+    if code == '304':
+        return Response(False, etag, last_modified)
+    return Response(True, found.get('etag'), found.get('last-modified'))
+
+
+def s3(url, path, etag=None, last_modified=None, **options):
+    """Stream an object to ``path``, unless its ETag is unchanged."""
+    parsed = urlparse(url)
+    bucket, k = parsed.netloc, parsed.path.lstrip('/')
+    head = client('s3').head_object(Bucket=bucket, Key=k)
+    if etag is not None and head['ETag'] == etag:
+        return Response(False, etag, last_modified)
+    res = client('s3').get_object(Bucket=bucket, Key=k, IfMatch=head['ETag'])
+    with open(path, 'wb') as h:
+        for chunk in iter(lambda: res['Body'].read(buffer), ''):
+            h.write(chunk)
+    modified = res.get('LastModified')
+    return Response(True, res['ETag'], modified and modified.isoformat())
+
+
+_sessions = {}
+_clients = {}
+_lk = threading.Lock()
+
+
+def session(insecure=False):
+    """A pool of keep-alive connections, shared by all downloads."""
+    with _lk:
+        if insecure not in _sessions:
+            if insecure:
+                urllib3.disable_warnings()
+                pool = urllib3.PoolManager(cert_reqs='CERT_NONE')
+            else:
+                pool = urllib3.PoolManager(cert_reqs='CERT_REQUIRED',
+                                           ca_certs=get_cert_path(True))
+            _sessions[insecure] = pool
+        return _sessions[insecure]
+
+
+def client(service):
+    """A boto3 client, shared by all downloads (clients are thread safe)."""
+    with _lk:
+        if service not in _clients:
+            _clients[service] = boto3.client(service)
+        return _clients[service]
+
+
+def parse_headers(text):
+    """Find the headers of the last response in a ``curl -D`` dump.
+
+    >>> parse_headers('HTTP/1.1 302 Found\\r\\nLocation: /b\\r\\n\\r\\n'
+    ...               'HTTP/1.1 200 OK\\r\\nETag: "x"\\r\\n\\r\\n')
+    {'etag': '"x"'}
+    """
+    blocks = [b for b in text.replace('\r\n', '\n').split('\n\n') if b]
+    headers = {}
+    for line in (blocks[-1].splitlines()[1:] if blocks else []):
+        name, _, value = line.partition(':')
+        headers[name.strip().lower()] = value.strip()
+    return headers
+
+
+def key(url):
+    return hashlib.sha256(url).hexdigest()
+
+
+def hash_file(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), ''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+cache = Cache()
+
+
+class Err(err.Err):
+    pass
@@ -0,0 +1,124 @@
+"""Atomic file writes: write to a temporary file, then rename into place.
+
+Readers never see a partially written file and need no lock to be sure of
+that. Those watching with inotify should watch for ``IN_MOVED_TO``, which
+fires only once a file is complete, rather than ``IN_CREATE``.
+
+Temporary files are hidden (dot-prefixed) and live next to their
+destination, so that the rename never crosses filesystems.
+"""
+import errno
+import os
+import tempfile
+
+
+def write(path, data, fsync=False):
+    """Write ``data`` to ``path`` atomically.
+
+    :param fsync: Flush the file and its directory entry to disk before
+                  returning.
+    """
+    tmp = stage(path, data, fsync=fsync)
+    os.rename(tmp, path)
+    if fsync:
+        sync_dir(os.path.dirname(path))
+
+
+def stage(path, data, fsync=False):
+    """Write ``data`` to a temporary file next to ``path``.
+
+    :returns: The path of the temporary file.
+    """
+    d, name = os.path.split(path)
+    fd, tmp = tempfile.mkstemp(prefix='.%s.' % name, suffix='.tmp',
+                               dir=(d or '.'))
+    try:
+        os.fchmod(fd, 0o666 & ~umask)           # As `open()` would have done
+        with os.fdopen(fd, 'w') as h:
+            h.write(data)
+            if fsync:
+                h.flush()
+                os.fsync(h.fileno())
+    except Exception:
+        unlink(tmp)
+        raise
+    return tmp
+
+
+def sync_dir(d):
+    fd = os.open(d or '.', os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def unlink(path):
+    try:
+        os.unlink(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+def hidden(name):
+    """Whether a file name is hidden, as temporary files are.
+
+    >>> hidden('.a.tmp'), hidden('a')
+    (True, False)
+    """
+    return name.startswith('.')
+
+
+class Batch(object):
+    """Stage many writes and publish them together.
+
+    Data is written to temporary files as it arrives. On exit, the files are
+    flushed to disk together, renamed into place, and then each directory
+    that was written to is flushed once (rather than once per file). If the
+    block raises, the staged files are discarded.
+    """
+    def __init__(self, fsync=True):
+        self.fsync = fsync
+        self.staged = []
+
+    def write(self, path, data):
+        self.staged += [(stage(path, data), path)]
+
+    def commit(self):
+        if self.fsync:
+            for tmp, _ in self.staged:
+                fd = os.open(tmp, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+        for tmp, path in self.staged:
+            os.rename(tmp, path)
+        if self.fsync:
+            for d in set(os.path.dirname(path) for _, path in self.staged):
+                sync_dir(d)
+        self.staged = []
+
+    def discard(self):
+        for tmp, _ in self.staged:
+            unlink(tmp)
+        self.staged = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.discard()
+
+
+def current_umask():
+    mask = os.umask(0)
+    os.umask(mask)
+    return mask
+
+
+umask = current_umask()
@@ -0,0 +1,158 @@
+"""Run commands with their output captured, line by line, as it arrives.
+
+Lines from stdout and stderr are timestamped and handed to a ``Capture``,
+which reports them in batches: once ``lines`` lines have piled up, or once
+``interval`` seconds have passed since the last report. A long running
+command thus reports its progress regularly, without a report per line. The
+last ``keep`` lines are also kept in a ring buffer, for a summary at the end.
+
+Code run by a task reaches the capture for the current thread through
+``call()``; without one, output goes wherever the daemon's goes.
+"""
+from __future__ import absolute_import
+from collections import deque
+from contextlib import contextmanager
+import errno
+import os
+import select
+import subprocess
+import threading
+import time
+
+from . import cgroup
+from .time import utc
+
+
+lines = 128
+interval = 0.5
+keep = 1024
+
+_local = threading.local()
+
+
+class Capture(object):
+    """Collects output lines and passes them on, a batch at a time.
+
+    :param report: Called as ``report(o, e)`` with lists of ``(t, s)``
+                   pairs from stdout and stderr.
+
+    >>> batches = []
+    >>> c = Capture(lambda o, e: batches.append((len(o), len(e))),
+    ...             lines=2, interval=60)
+    >>> for s in 'abc':
+    ...     c.line('o', s)
+    >>> c.line('e', 'd')
+    >>> c.flush()
+    >>> batches
+    [(2, 0), (1, 1)]
+    """
+    def __init__(self, report, lines=lines, interval=interval, keep=keep):
+        self.report = report
+        self.lines = lines
+        self.interval = interval
+        self.ring = deque(maxlen=keep)
+        self._o, self._e = [], []
+        self._last = time.time()
+        self._lk = threading.RLock()       # Commands may run in many threads
+
+    def line(self, stream, s):
+        """Record a line from ``'o'`` (stdout) or ``'e'`` (stderr); bytes
+           which are not UTF-8 are replaced.
+        """
+        if isinstance(s, str):
+            s = s.decode('utf-8', 'replace')
+        entry = (utc(), s)
+        with self._lk:
+            self.ring.append((stream, entry))
+            (self._o if stream == 'o' else self._e).append(entry)
+            if max(len(self._o), len(self._e)) >= self.lines:
+                self.flush()
+            else:
+                self.tick()
+
+    def tick(self):
+        """Report what has piled up, if it has been a while."""
+        with self._lk:
+            if time.time() - self._last >= self.interval:
+                self.flush()
+
+    def flush(self):
+        with self._lk:
+            self._last = time.time()
+            if len(self._o) == 0 and len(self._e) == 0:
+                return
+            o, e = self._o, self._e
+            self._o, self._e = [], []
+            self.report(o, e)
+
+    def tail(self, n=lines):
+        """The last ``n`` lines of each stream still in the ring buffer."""
+        with self._lk:
+            ring = list(self.ring)
+        o = [entry for stream, entry in ring if stream == 'o']
+        e = [entry for stream, entry in ring if stream == 'e']
+        return o[-n:], e[-n:]
+
+
+@contextmanager
+def capturing(capture):
+    """Capture output of commands run with ``call()`` in this thread."""
+    outer = current()
+    _local.capture = capture
+    try:
+        yield capture
+    finally:
+        _local.capture = outer
+
+
+def current():
+    return getattr(_local, 'capture', None)
+
+
+def call(argv, **kwargs):
+    """Run a command, like ``subprocess.check_call``, capturing its output
+       if there is a capture for this thread (and in its cgroup, if there is
+       one of those).
+    """
+    kwargs.setdefault('preexec_fn', cgroup.preexec())
+    capture = current()
+    if capture is None:
+        return subprocess.check_call(argv, **kwargs)
+    p = subprocess.Popen(argv, stdout=subprocess.PIPE,
+                         stderr=subprocess.PIPE, close_fds=True, **kwargs)
+    stream(p, capture)
+    capture.flush()
+    code = p.wait()
+    if code != 0:
+        raise subprocess.CalledProcessError(code, argv)
+    return code
+
+
+def stream(p, capture):
+    """Read stdout and stderr of a process as they are written, without
+       blocking on either, until both are closed.
+    """
+    partial = {p.stdout.fileno(): ('o', ''), p.stderr.fileno(): ('e', '')}
+    while len(partial) > 0:
+        try:
+            ready, _, _ = select.select(list(partial), [], [],
+                                        capture.interval)
+        except select.error as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            continue
+        for fd in ready:
+            name, buffered = partial[fd]
+            data = os.read(fd, 65536)
+            if data == '':
+                if buffered != '':
+                    capture.line(name, buffered)
+                del partial[fd]
+                continue
+            chunks = (buffered + data).split('\n')
+            for s in chunks[:-1]:
+                capture.line(name, s)
+            partial[fd] = (name, chunks[-1])
+        capture.tick()
+    p.stdout.close()
+    p.stderr.close()
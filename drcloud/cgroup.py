@@ -0,0 +1,221 @@
+"""Confine tasks to cgroups (version 2) of their own, and account for them.
+
+A task run with limits gets a leaf cgroup, ``drcloud/<uuid>``, under the
+root of the cgroup2 hierarchy, with ``cpu.max`` and ``memory.max`` set from
+the limits. The processes the task starts are moved into the leaf as they
+start, by ``preexec()``, so that they and their children are confined and
+counted. The worker running the task stays where it is: a task reaching its
+memory limit has its own processes killed, not the worker. What the leaf
+used (CPU time, peak memory and bytes read and written) is read, once all of
+its processes are gone, before the leaf is removed.
+
+Controllers can only be used by a cgroup whose parent enables them, and only
+leaves may hold processes; so the ``drcloud`` cgroup holds none itself.
+"""
+from __future__ import absolute_import
+from collections import namedtuple
+from contextlib import contextmanager
+import errno
+import os
+import threading
+import time
+
+from . import err
+from .logger import log
+
+
+parent = 'drcloud'
+period = 100000                                # For cpu.max, in microseconds
+controllers = ['cpu', 'memory', 'io']
+
+_local = threading.local()
+
+
+class Usage(namedtuple('Usage', 'cpu_usec memory_peak io_read io_write')):
+    """What a cgroup used; any of which may be ``None``, if not known."""
+    pass
+
+
+class Group(object):
+    def __init__(self, name, root=None):
+        self.root = root or mountpoint()
+        self.path = os.path.join(self.root, parent, name)
+        self.usage = None
+
+    def create(self, cpu=None, memory=None):
+        """Make the leaf, limited to ``cpu`` CPUs and ``memory`` MiB."""
+        enable(self.root)
+        mkdir(os.path.dirname(self.path))
+        enable(os.path.dirname(self.path))
+        mkdir(self.path)
+        if cpu is not None:
+            write(self.file('cpu.max'), '%d %d' % (max(1000, cpu * period),
+                                                   period))
+        if memory is not None:
+            write(self.file('memory.max'), str(memory * 1024 * 1024))
+
+    def file(self, name):
+        return os.path.join(self.path, name)
+
+    def enter(self, pid=None):
+        write(self.file('cgroup.procs'), str(pid or os.getpid()))
+
+    def read_usage(self):
+        cpu = stat(read(self.file('cpu.stat'))).get('usage_usec')
+        peak = read(self.file('memory.peak'))
+        io = io_stat(read(self.file('io.stat')))
+        return Usage(cpu, int(peak) if peak else None,
+                     io.get('rbytes'), io.get('wbytes'))
+
+    def stop(self, timeout=5):
+        """Kill anything the task left running in the leaf, waiting up to
+           ``timeout`` seconds for ``cgroup.events`` to report it gone.
+        """
+        if os.path.exists(self.file('cgroup.kill')):
+            write(self.file('cgroup.kill'), '1')
+            deadline = time.time() + timeout
+            while self.populated() and time.time() < deadline:
+                time.sleep(0.01)
+
+    def remove(self):
+        """Remove the leaf, stopping anything the task left running in it."""
+        self.stop()
+        try:
+            os.rmdir(self.path)
+        except OSError as e:
+            log.warning('Could not remove cgroup %s: %s', self.path, e)
+
+    def populated(self):
+        """Whether any process is in the leaf."""
+        return stat(read(self.file('cgroup.events'))).get('populated', 0) != 0
+
+
+@contextmanager
+def confined(name, cpu=None, memory=None, root=None):
+    """Run the processes this thread starts in a leaf cgroup of their own,
+       for the block.
+
+    :returns: The ``Group``, whose ``usage`` is set when the block exits.
+    """
+    group = Group(name, root)
+    group.create(cpu, memory)
+    try:
+        with using(group):
+            yield group
+    finally:
+        group.stop()
+        group.usage = group.read_usage()
+        group.remove()
+
+
+@contextmanager
+def using(group):
+    """Start processes of this thread in ``group`` (or wherever this process
+       is, if it is ``None``).
+    """
+    outer = active()
+    _local.group = group
+    try:
+        yield group
+    finally:
+        _local.group = outer
+
+
+def active():
+    """The ``Group`` processes started by this thread go in, if any."""
+    return getattr(_local, 'group', None)
+
+
+def preexec():
+    """A ``preexec_fn`` which moves a child process into the ``Group`` of
+       this thread; or ``None``, if there is none.
+    """
+    group = active()
+    return group.enter if group is not None else None
+
+
+def mountpoint():
+    """Where the cgroup2 hierarchy is mounted."""
+    with open('/proc/mounts') as h:
+        for line in h:
+            fields = line.split()
+            if fields[2] == 'cgroup2' and \
+               read(os.path.join(fields[1], 'cgroup.controllers')):
+                return fields[1]
+    raise Err('No cgroup2 hierarchy with controllers is mounted.')
+
+
+def current():
+    """The cgroup2 path of this process."""
+    with open('/proc/self/cgroup') as h:
+        for line in h:
+            if line.startswith('0::'):
+                return line[3:].strip()
+    raise Err('This process is not in the cgroup2 hierarchy.')
+
+
+def enable(d):
+    """Let the children of a cgroup use the controllers we need."""
+    available = (read(os.path.join(d, 'cgroup.controllers')) or '').split()
+    enabled = (read(os.path.join(d, 'cgroup.subtree_control')) or '').split()
+    for c in controllers:
+        if c not in available:
+            log.warning('The %s controller is not available in %s.', c, d)
+            continue
+        if c not in enabled:
+            write(os.path.join(d, 'cgroup.subtree_control'), '+' + c)
+
+
+def stat(text):
+    """Parse a flat keyed file, like ``cpu.stat``.
+
+    >>> stat('usage_usec 1500\\nuser_usec 1000\\n')['usage_usec']
+    1500
+    """
+    fields = {}
+    for line in (text or '').splitlines():
+        k, _, v = line.partition(' ')
+        fields[k] = int(v)
+    return fields
+
+
+def io_stat(text):
+    """Total each key of ``io.stat`` over all devices.
+
+    >>> sorted(io_stat('8:0 rbytes=10 wbytes=1\\n8:16 rbytes=5 wbytes=0\\n')
+    ...        .items())
+    [('rbytes', 15), ('wbytes', 1)]
+    """
+    totals = {}
+    for line in (text or '').splitlines():
+        for field in line.split()[1:]:
+            k, _, v = field.partition('=')
+            totals[k] = totals.get(k, 0) + int(v)
+    return totals
+
+
+def mkdir(path):
+    try:
+        os.mkdir(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def read(path):
+    try:
+        with open(path) as h:
+            return h.read()
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return None
+
+
+def write(path, text):
+    with open(path, 'w') as h:
+        h.write(text)
+
+
+class Err(err.Err):
+    pass
@@ -11,13 +11,14 @@ import awacs.aws
 import awacs.sts
 import botocore
 import boto3
-from troposphere import (AWS_REGION, Base64, FindInMap, GetAtt, Join, Output,
-                         Parameter, Ref, Tags, Template)
+from troposphere import (AWS_ACCOUNT_ID, AWS_REGION, Base64, FindInMap, GetAtt,
+                         Join, Output, Parameter, Ref, Tags, Template)
 import troposphere.autoscaling as autoscaling
 import troposphere.iam as iam
 import troposphere.route53 as route53
 import troposphere.s3 as s3
 import troposphere.sns as sns
+import troposphere.sqs as sqs
 
 from ... import cloud
 from .. import err
@@ -321,11 +322,47 @@ class InVPC(Cfn):
         role_name = Ref(role)
         role_arn = GetAtt(role, 'Arn')
 
+        sns_topic = template.add_resource(sns.Topic('SNSTopic'))
+        template.add_output(Output(
+            'SNSTopic',
+            Value=Ref(sns_topic)
+        ))
+
+        # New objects in the bucket are announced on the topic, which feeds
+        # the inbox queue of each service (see UbuntuASG).
+        sns_topic_policy = template.add_resource(sns.TopicPolicy(
+            'SNSTopicPolicy',
+            Topics=[Ref(sns_topic)],
+            PolicyDocument=awacs.aws.Policy(
+                Version='2012-10-17',
+                Statement=[
+                    awacs.aws.Statement(
+                        Effect=awacs.aws.Allow,
+                        Principal=awacs.aws.Principal('Service',
+                                                      ['s3.amazonaws.com']),
+                        Action=[awacs.aws.Action('sns', 'Publish')],
+                        Resource=[Ref(sns_topic)],
+                        Condition=awacs.aws.Condition(awacs.aws.StringEquals(
+                            'aws:SourceAccount', Ref(AWS_ACCOUNT_ID)
+                        ))
+                    ),
+                ],
+            )
+        ))
+
         enable_versioning = s3.VersioningConfiguration(Status='Enabled')
+        announce_objects = s3.NotificationConfiguration(
+            TopicConfigurations=[
+                s3.TopicConfigurations(Event='s3:ObjectCreated:*',
+                                       Topic=Ref(sns_topic))
+            ]
+        )
         bucket = template.add_resource(s3.Bucket(
             'S3Bucket',
             VersioningConfiguration=enable_versioning,
+            NotificationConfiguration=announce_objects,
             Tags=Tags(drcloud=self.cloud),
+            DependsOn=sns_topic_policy,
             DeletionPolicy='Retain'
             # NB: "Only Amazon S3 buckets that are empty can be deleted.
             #      Deletion will fail for buckets that have contents."
@@ -336,12 +373,8 @@ class InVPC(Cfn):
         ))
         bucket_arn = Join('', ['arn:aws:s3:::', Ref(bucket)])
         bucket_arn_star = Join('', ['arn:aws:s3:::', Ref(bucket), '/*'])
-
-        sns_topic = template.add_resource(sns.Topic('SNSTopic'))
-        template.add_output(Output(
-            'SNSTopic',
-            Value=Ref(sns_topic)
-        ))
+        inbox_queues_arn = Join('', ['arn:aws:sqs:*:', Ref(AWS_ACCOUNT_ID),
+                                     ':*-inbox'])
 
         if self.with_zone:
             r53 = template.add_resource(route53.HostedZone(
@@ -388,6 +421,15 @@ class InVPC(Cfn):
                         Action=[awacs.aws.Action('s3', '*')],
                         Resource=[bucket_arn, bucket_arn_star]
                     ),
+                    awacs.aws.Statement(
+                        Effect=awacs.aws.Allow,
+                        Action=[
+                            awacs.aws.Action('sqs', 'ReceiveMessage'),
+                            awacs.aws.Action('sqs', 'DeleteMessage'),
+                            awacs.aws.Action('sqs', 'GetQueueAttributes'),
+                        ],
+                        Resource=[inbox_queues_arn]
+                    ),
                 ],
             )
         ))
@@ -536,6 +578,44 @@ class UbuntuASG(Cfn):
             Default=self.sns_topic
         ))
 
+        # Notifications of new objects are delivered to a queue for the
+        # service, which nodes long poll to learn of new inbox messages. The
+        # topic carries notifications for every service; nodes skip the ones
+        # which are not for them.
+        inbox = template.add_resource(sqs.Queue(
+            'InboxQueue',
+            QueueName=self.name() + '-inbox',
+            ReceiveMessageWaitTimeSeconds=20,
+            MessageRetentionPeriod=3600
+        ))
+        template.add_resource(sqs.QueuePolicy(
+            'InboxQueuePolicy',
+            Queues=[Ref(inbox)],
+            PolicyDocument=awacs.aws.Policy(
+                Version='2012-10-17',
+                Statement=[
+                    awacs.aws.Statement(
+                        Effect=awacs.aws.Allow,
+                        Principal=awacs.aws.Principal('Service',
+                                                      ['sns.amazonaws.com']),
+                        Action=[awacs.aws.Action('sqs', 'SendMessage')],
+                        Resource=[GetAtt(inbox, 'Arn')],
+                        Condition=awacs.aws.Condition(awacs.aws.ArnEquals(
+                            'aws:SourceArn', Ref(sns_topic)
+                        ))
+                    ),
+                ],
+            )
+        ))
+        template.add_resource(sns.SubscriptionResource(
+            'InboxSubscription',
+            Protocol='sqs',
+            Endpoint=GetAtt(inbox, 'Arn'),
+            TopicArn=Ref(sns_topic),
+            RawMessageDelivery=True
+        ))
+        template.add_output(Output('InboxQueue', Value=Ref(inbox)))
+
         # Use the size to find the platform and use the size and platform
         # together to find the AMI ID.
         ami_expr = FindInMap(region_ami_map,
@@ -560,6 +640,7 @@ class UbuntuASG(Cfn):
                                                rsyslog_conf=rsyslog_conf),
                                    aws=dict(
                                        s3=Join('', ['s3://', Ref(s3bucket)]),
+                                       sqs=Ref(inbox),
                                        sync_script=sync_script,
                                    )
                                ),
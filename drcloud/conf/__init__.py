@@ -1,8 +1,13 @@
+from threading import RLock
+
+from schematics.exceptions import BaseError
 from schematics.models import Model
 from schematics.types import IntType, StringType, URLType
 from schematics.types.compound import ModelType
 
-from .. import logger
+from .. import err, logger
+from ..logger import log
+from .lld import LayeredLocalDirs
 
 
 class Log(Model):
@@ -29,7 +34,113 @@ class Node(Model):
     log = ModelType(Log)
 
 
+class AWS(Model):
+    s3 = StringType()
+    sqs = URLType()
+
+
 class Config(Model):
+    cloud = StringType()
+    service = StringType()
+    aws = ModelType(AWS)
     node = ModelType(Node)
     log = ModelType(Log)
     conninfo = URLType()
+
+
+class Loader(object):
+    """Typed configuration, built from layered directories in one pass.
+
+    The ``Config`` last loaded is kept in ``.config``, so that hot paths
+    read attributes rather than files. ``load()`` rebuilds it only if some
+    layer has changed; ``reload()`` rebuilds it regardless.
+    """
+    def __init__(self, layers=None):
+        self.layers = layers if layers is not None else LayeredLocalDirs()
+        self._merged = None
+        self._config = None
+        self._lk = RLock()
+
+    @property
+    def config(self):
+        """:rtype: Config"""
+        if self._config is None:
+            return self.load()
+        return self._config
+
+    def load(self):
+        """:rtype: Config"""
+        with self._lk:
+            merged = self.layers.snapshot()
+            if merged is not self._merged:
+                self._config = build(merged)
+                self._merged = merged
+            return self._config
+
+    def reload(self):
+        """:rtype: Config"""
+        with self._lk:
+            self._merged = None
+            return self.load()
+
+
+def build(items):
+    """Convert dotted keys and string values into a validated ``Config``.
+
+    Keys which the model does not describe are ignored.
+
+    >>> build({'service': 'a.example.com', 'node.rotation': '5'}).node.rotation
+    5
+    """
+    try:
+        config = Config(nest(items), strict=False)
+        config.validate()
+    except BaseError as e:
+        raise Err('Configuration is not valid: %s' % e.messages, underlying=e)
+    return config
+
+
+def typed(key, value):
+    """Convert a single setting as ``build()`` would.
+
+    Values of keys the model does not describe are left as they are. This is
+    suitable as the ``convert`` argument of ``LayeredLocalDirs.watch()``.
+
+    >>> typed('node.agent.rotation', '5'), typed('x.y', '5')
+    (5, '5')
+    """
+    if value is None:
+        return None
+    node = build({key: value})
+    for part in key.split('.'):
+        if not isinstance(node, Model) or part not in node:
+            return value
+        node = node[part]
+    return node
+
+
+def nest(items):
+    """Turn a mapping with dotted keys into nested dicts.
+
+    >>> nest({'a.b': '1', 'a.c': '2', 'd': '3'}) == \\
+    ...     {'a': {'b': '1', 'c': '2'}, 'd': '3'}
+    True
+    """
+    nested = {}
+    for key, value in sorted(items.items()):
+        parts = key.split('.')
+        d = nested
+        for part in parts[:-1]:
+            d = d.setdefault(part, {})
+            if not isinstance(d, dict):
+                break
+        else:
+            if not isinstance(d.get(parts[-1]), dict):
+                d[parts[-1]] = value
+                continue
+        log.warning('Ignoring %s, which conflicts with other settings.', key)
+    return nested
+
+
+class Err(err.Err):
+    pass
@@ -1,9 +1,13 @@
 from collections import MutableMapping
+from contextlib import contextmanager
 import os
+from threading import Event, RLock, Thread
 
 
 from .. import dns
 from ..fsdict import FSDict, split_path
+from ..logger import log
+from ..packed import PackedFSDict, is_pack
 
 
 def default_writable():
@@ -21,24 +25,73 @@ etc = '/etc/drcloud'
 
 
 class LayeredLocalDirs(MutableMapping):
+    """Configuration merged from several layers, the first of which wins.
+
+    Layers may be given as directories, as packed files (paths ending in
+    ``.pack``) or as FSDicts of either kind.
+
+    Reads are answered from a merged snapshot of all the layers, which is
+    rebuilt when any layer's ``generation()`` changes. Files edited by hand
+    in place are noticed within ``FSDict.scan`` seconds, or at once after
+    ``refresh()``. It is rebuilt under the
+    shared lock of the writable layer, so it has all of a batch or none.
+    """
     def __init__(self,
                  paths=[userdir(), etc],
                  writable=default_writable(),
-                 timeout_millis=200):
-        self._writer = FSDict(writable, timeout_millis=timeout_millis)
+                 timeout_millis=200,
+                 cache=None):
+        self._writer = layer(writable, timeout_millis=timeout_millis,
+                             cache=cache)
         self._readers = []
         if writable not in paths:
             self._readers += [self._writer]
         for path in paths:
-            self._readers += [FSDict(path, timeout_millis=timeout_millis)]
+            if path == writable:
+                self._readers += [self._writer]
+                continue
+            self._readers += [layer(path, timeout_millis=timeout_millis,
+                                    cache=cache)]
+        self._lk = RLock()
+        self._stamps = None
+        self._merged = None
+
+    @contextmanager
+    def batch(self):
+        """Collect changes and write them all at once, under a single lock.
+
+        See ``FSDict.batch()``: values and tombstones alike are published
+        together when the block exits.
+
+        :rtype: Batch
+        """
+        with self._writer.batch() as changes:
+            yield Batch(changes)
+
+    def watch(self, keys, callback, debounce=0.25, convert=None, poll=5):
+        """Call ``callback(key, old, new)`` whenever one of ``keys`` changes.
+
+        The directory trees of all layers (for packed layers, the
+        directories holding them) are watched with inotify, and the watches
+        are in place when this returns. From a background thread, values are
+        compared once events have stopped arriving for ``debounce`` seconds.
+        Every ``poll`` seconds the layers are checked regardless, which
+        catches layers that did not exist yet when the watch started.
+
+        :param convert: Applied as ``convert(key, value)`` to values before
+                        they are compared and delivered (see ``conf.typed``).
+        :rtype: Watch
+        """
+        w = Watch(self, keys, callback, debounce=debounce,
+                  convert=convert or (lambda key, value: value), poll=poll)
+        w.start()
+        return w
 
     def __getitem__(self, key):
-        path = LayeredLocalDirs.key_to_path(key)
-        if '!/' + path in self._writer:
-            return
-        for reader in self._readers:
-            if path in reader:
-                return reader[path]
+        merged, _ = self._snapshot()
+        if key in merged:
+            return merged[key]
+        LayeredLocalDirs.key_to_path(key)                # Reject bad keys
 
     def __setitem__(self, key, value):
         path = LayeredLocalDirs.key_to_path(key)
@@ -51,25 +104,70 @@ class LayeredLocalDirs(MutableMapping):
         self._writer['!/' + path] = ''
 
     def __iter__(self):
-        paths = set()
-        negated = {path[2:] for path in self._writer.keys()
-                   if path.startswith('!/')}
-        for reader in self._readers:
-            for path in reader.keys():
-                if path in paths or path in negated:
-                    continue
-                paths |= set([path])
-        keys = [LayeredLocalDirs.path_to_key(path) for path in paths]
-        return iter(sorted(keys, key=split_path))
+        _, keys = self._snapshot()
+        return iter(keys)
 
     def __len__(self):
-        return len(iter(self))
+        _, keys = self._snapshot()
+        return len(keys)
 
     def __contains__(self, key):
-        path = LayeredLocalDirs.key_to_path(key)
+        merged, _ = self._snapshot()
+        return key in merged
+
+    def refresh(self):
+        """Look for changes made to the layers by hand on the next read."""
+        for reader in self._readers:
+            reader.refresh()
+
+    def close(self):
+        """Stop the layers' caches following changes; see ``FSDict.close``.
+        """
+        for reader in self._readers:
+            reader.close()
+
+    def snapshot(self):
+        """All keys and values, merged.
+
+        The dict is replaced, never changed, when the layers change; it is
+        the same object for as long as they do not.
+        """
+        merged, _ = self._snapshot()
+        return merged
+
+    def _snapshot(self):
+        """All layers merged, with tombstones applied, as a dict and a sorted
+           list of keys.
+
+        The merge is redone only when the generation of some layer changes,
+        so that lookups are dictionary hits. A batch being published changes
+        the generation, and the merge waits for it to finish.
+        """
+        stamps = [reader.generation() for reader in self._readers]
+        with self._lk:
+            if stamps != self._stamps:
+                with self._writer.shared:
+                    stamps = [reader.generation() for reader in self._readers]
+                    merged = self._merge()
+                self._merged = (merged, sorted(merged, key=split_path))
+                self._stamps = stamps
+            return self._merged
+
+    def _merge(self):
+        merged = {}
+        negated = {path[2:] for path in self._writer if path.startswith('!/')}
         for reader in self._readers:
-            if path in reader and '!/' + path not in self._writer:
-                return True
+            for path in reader:
+                if path in negated or path.startswith('!/'):
+                    continue
+                try:
+                    key = LayeredLocalDirs.path_to_key(path)
+                except ValueError:
+                    log.warning('Ignoring %s in %s.', path, reader.path)
+                    continue
+                if key not in merged:
+                    merged[key] = reader[path]
+        return merged
 
     @staticmethod
     def path_to_key(path):
@@ -83,3 +181,153 @@ class LayeredLocalDirs(MutableMapping):
         if not dns.validate(key):
             raise ValueError('Only dotted names with hyphens are accepted.')
         return key.replace('.', '/')
+
+
+def layer(path, **options):
+    """An FSDict for ``path``, packed or not; FSDicts are passed through."""
+    if isinstance(path, FSDict):
+        return path
+    if is_pack(path):
+        return PackedFSDict(path, **options)
+    return FSDict(path, **options)
+
+
+class Batch(object):
+    """Changes to layered configuration, to be written to the writable layer
+       together.
+    """
+    def __init__(self, changes):
+        self._changes = changes
+
+    def __setitem__(self, key, value):
+        path = LayeredLocalDirs.key_to_path(key)
+        self._changes[path] = value
+        del self._changes['!/' + path]
+
+    def __delitem__(self, key):
+        path = LayeredLocalDirs.key_to_path(key)
+        del self._changes[path]
+        self._changes['!/' + path] = ''
+
+
+class Watch(object):
+    """A background thread which reports changes to some configuration keys.
+    """
+    events = ['IN_ATTRIB', 'IN_CLOSE_WRITE', 'IN_CREATE', 'IN_DELETE',
+              'IN_MODIFY', 'IN_MOVED_FROM', 'IN_MOVED_TO']
+
+    def __init__(self, layers, keys, callback, debounce, convert, poll):
+        self.layers = layers
+        self.keys = list(keys)
+        self.callback = callback
+        self.debounce = debounce
+        self.convert = convert
+        self.poll = poll
+        self.values = self._values({})
+        self._stopped = Event()
+        self._watcher = None
+        self._trees = set()                 # Directories watched recursively
+        self._thread = Thread(target=self._run,
+                              name='watch:%s' % ','.join(self.keys))
+        self._thread.daemon = True
+
+    def start(self):
+        """Put the inotify watches in place and start following changes."""
+        try:
+            self._watcher = self._inotify()
+        except Exception as e:
+            log.warning('Not able to watch with inotify, so polling: %s', e)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the thread, and close the inotify watcher.
+
+        The watcher's descriptors are closed when it is let go of; the
+        inotify library has no other way to close them.
+        """
+        self._stopped.set()
+        self._thread.join()
+        self._watcher = None
+
+    def check(self):
+        """Compare the keys to their last known values, reporting changes."""
+        self.layers.refresh()
+        values = self._values(self.values)
+        for key in self.keys:
+            old, new = self.values[key], values[key]
+            if old == new:
+                continue
+            self.values[key] = new
+            try:
+                self.callback(key, old, new)
+            except Exception as e:
+                log.exception('Failed to handle change to %s: %s', key, e)
+
+    def _values(self, last):
+        merged, values = self.layers.snapshot(), {}
+        for key in self.keys:
+            try:
+                values[key] = self.convert(key, merged.get(key))
+            except Exception as e:
+                log.warning('Ignoring new value of %s: %s', key, e)
+                values[key] = last.get(key)
+        return values
+
+    def _run(self):
+        if self._watcher is not None:
+            try:
+                self._follow()
+            except Exception as e:
+                log.warning('Stopped watching with inotify, so polling: %s',
+                            e)
+        while not self._stopped.wait(self.poll):
+            self.check()
+
+    def _inotify(self):
+        import inotify.adapters  # Not available on all platforms
+        import inotify.constants
+        self._mask = reduce(lambda a, b: a | b,
+                            [getattr(inotify.constants, e)
+                             for e in self.events])
+        watcher = inotify.adapters.Inotify(block_duration_s=self.debounce)
+        for d, recursive in set(directory(r) for r in self.layers._readers):
+            if os.path.isdir(d):
+                self._add(watcher, d, recursive)
+        return watcher
+
+    def _add(self, watcher, d, recursive):
+        """Watch ``d`` and, if ``recursive``, every directory under it."""
+        if not recursive:
+            watcher.add_watch(d, self._mask)
+            return
+        for root, _, _ in os.walk(d):
+            watcher.add_watch(root, self._mask)
+            self._trees.add(root)
+
+    def _follow(self):
+        dirty, polled = False, 0
+        # The generator produces ``None`` each time ``debounce`` seconds pass
+        # with no events.
+        for event in self._watcher.event_gen(yield_nones=True):
+            if self._stopped.is_set():
+                return
+            if event is not None:
+                _, types, d, name = event
+                if 'IN_ISDIR' in types and d in self._trees and \
+                   ('IN_CREATE' in types or 'IN_MOVED_TO' in types):
+                    self._add(self._watcher, os.path.join(d, name), True)
+                dirty = True
+                continue
+            polled += self.debounce
+            if dirty or polled >= self.poll:
+                self.check()
+                dirty, polled = False, 0
+
+
+def directory(layer):
+    """The directory to watch for changes to a layer, and whether to watch
+       the directories under it too.
+    """
+    if isinstance(layer, PackedFSDict):
+        return os.path.dirname(layer.path) or '.', False
+    return layer.path, True
@@ -0,0 +1,368 @@
+import fcntl
+import os
+import shutil
+import threading
+import time
+import tempfile
+
+from nose import with_setup
+
+from .. import atomic, packed
+from ..flock import Timeout
+from ..fsdict import FSDict
+from ..packed import PackedFSDict
+from . import Err, Loader, typed
+from .lld import LayeredLocalDirs
+
+
+test_dir = None
+
+
+def make_test_dir():
+    global test_dir
+    test_dir = tempfile.mkdtemp()
+
+
+def clear_test_dir():
+    shutil.rmtree(test_dir)
+
+
+@with_setup(setup=make_test_dir, teardown=clear_test_dir)
+def test_atomic_writes_leave_no_temporary_files():
+    d = FSDict(test_dir)
+    d['a/b'] = 'one'
+    d['a/b'] = 'two'
+    d['c'] = 'three'
+    assert d['a/b'] == 'two'
+    assert os.listdir(os.path.join(test_dir, 'a')) == ['b']
+    assert list(d) == ['a/b', 'c']
+
+
+@with_setup(setup=make_test_dir, teardown=clear_test_dir)
+def test_staged_files_are_not_keys():
+    d = FSDict(test_dir)
+    d['a'] = 'one'
+    with atomic.Batch() as batch:
+        batch.write(os.path.join(test_dir, 'b'), 'two\n')
+        assert list(d) == ['a']
+        assert 'b' not in d
+    assert d['b'] == 'two'
+
+
+@with_setup(setup=make_test_dir, teardown=clear_test_dir)
+def test_mtime_cache_sees_changes_from_other_writers():
+    d, other = FSDict(test_dir, cache='mtime'), FSDict(test_dir)
+    other['a'] = 'one'
+    assert d['a'] == 'one' and d['a'] == 'one' and 'b' not in d
+    assert (d.cache.hits, d.cache.misses) == (1, 2)
+    other['a'] = 'a different value'
+    assert d['a'] == 'a different value'
+
+
+@with_setup(setup=make_test_dir, teardown=clear_test_dir)
+def test_cached_lookups_of_directories_and_below_files():
+    for cache in [None, 'mtime', 'inotify']:
+        d = FSDict(os.path.join(test_dir, str(cache)), cache=cache)
+        d['a/b'] = 'one'
+        assert 'a' in d and 'a/b' in d and 'a/b/c' not in d
+        assert d['a'] is None and d['a/b/c'] is None
+
+
+@with_setup(setup=make_test_dir, teardown=clear_test_dir)
+def test_inotify_cache_sees_changes_from_other_writers():
+    d, other = FSDict(test_dir, cache='inotify'), FSDict(test_dir)
+    other['a/b'] = 'one'
+    assert d['a/b'] == 'one' and d['a/b'] == 'one'
+    assert (d.cache.hits, d.cache.misses) == (1, 1)
+    other['a/b'] = 'two'
+    for _ in range(100):
+        if d['a/b'] == 'two':
+            break
+        time.sleep(0.01)
+    assert d['a/b'] == 'two'
+
+
+@with_setup(setup=make_test_dir, teardown=clear_test_dir)
+def test_closing_inotify_caches_and_watches_releases_descriptors():
+    fds = len(os.listdir('/proc/self/fd'))
+    conf = LayeredLocalDirs(paths=[test_dir], writable=test_dir,
+                            cache='inotify')
+    conf['a'] = 'one'
+    assert conf['a'] == 'one'
+    w = conf.watch(['a'], lambda *args: None, debounce=0.01)
+    assert len(os.listdir('/proc/self/fd')) > fds
+    w.stop()
+    conf.close()
+    assert len(os.listdir('/proc/self/fd')) == fds
+    assert conf['a'] == 'one'
+
+
+@with_setup(setup=make_test_dir, teardown=clear_test_dir)
+def test_locks_work_from_worker_threads():
+    d, errors = FSDict(test_dir, timeout_millis=5000), []
+
+    def work(n):
+        try:
+            for i in range(20):
+                with d.exclusive:
+                    with d.shared:
+                        d['t%s' % n] = str(i)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=work, args=(n,)) for n in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert errors == []
+    assert [d['t%s' % n] for n in range(4)] == ['19'] * 4
+
+
+@with_setup(setup=make_test_dir, teardown=clear_test_dir)
+def test_locks_time_out_when_held_elsewhere():
+    d = FSDict(test_dir, timeout_millis=50)
+    fd = os.open(test_dir, os.O_RDONLY)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        with d.shared:
+            assert False, 'Took a lock held by someone else.'
+    except Timeout:
+        pass
+    finally:
+        os.close(fd)
+    with d.shared:
+        pass
+
+
+@with_setup(setup=make_test_dir, teardown=clear_test_dir)
+def test_batches_publish_all_changes_together():
+    d = FSDict(test_dir)
+    d['gone'] = 'soon'
+    with d.batch() as changes:
+        changes['a/b'] = 'one'
+        changes['a/c'] = 'two'
+        del changes['gone']
+        assert changes['a/b'] == 'one' and changes['gone'] is None
+        assert list(d) == ['gone']
+    assert list(d) == ['a/b', 'a/c']
+    assert d['a/c'] == 'two'
+
+
+@with_setup(setup=make_test_dir, teardown=clear_test_dir)
+def test_batches_change_nothing_on_error():
+    d = FSDict(test_dir)
+    try:
+        with d.batch() as changes:
+            changes['a'] = 'one'
+            raise RuntimeError()
+    except RuntimeError:
+        pass
+    assert list(d) == [] and os.listdir(test_dir) == []
+
+
+@with_setup(setup=make_test_dir, teardown=clear_test_dir)
+def test_layered_batches_write_tombstones():
+    lower = os.path.join(test_dir, 'lower')
+    upper = os.path.join(test_dir, 'upper')
+    FSDict(lower)['x/y'] = 'below'
+    conf = LayeredLocalDirs(paths=[upper, lower], writable=upper)
+    with conf.batch() as changes:
+        changes['a.b'] = 'one'
+        del changes['x.y']
+    assert list(conf) == ['a.b']
+    assert sorted(FSDict(upper)) == ['!/x/y', 'a/b']
+    with conf.batch() as changes:
+        changes['x.y'] = 'above'
+    assert conf['x.y'] == 'above'
+
+
+@with_setup(setup=make_test_dir, teardown=clear_test_dir)
+def test_layered_snapshots_see_all_of_a_batch_or_none():
+    conf = LayeredLocalDirs(paths=[test_dir], writable=test_dir)
+    conf['a'] = 'old'
+    assert conf.snapshot() == {'a': 'old'}
+    other, started = FSDict(test_dir, timeout_millis=1000), threading.Event()
+
+    def publish():                 # Like a batch published by another process
+        with other.exclusive:
+            for k in ['a', 'b']:
+                atomic.write(os.path.join(test_dir, k), 'new\n')
+                started.set()
+                time.sleep(0.05)
+
+    t = threading.Thread(target=publish)
+    t.start()
+    started.wait()
+    try:
+        assert conf.snapshot() == {'a': 'new', 'b': 'new'}
+    finally:
+        t.join()
+
+
+@with_setup(setup=make_test_dir, teardown=clear_test_dir)
+def test_iteration_is_ordered_by_path_segments():
+    d = FSDict(test_dir)
+    for k in ['a-x', 'a/c', 'b', 'a/b/c', '.hidden']:
+        d[k] = k
+    keys = iter(d)
+    assert next(keys) == 'a/b/c'
+    assert list(keys) == ['a/c', 'a-x', 'b']
+    assert len(d) == 4
+    assert len(FSDict(os.path.join(test_dir, 'nothing-here'))) == 0
+
+
+@with_setup(setup=make_test_dir, teardown=clear_test_dir)
+def test_packed_dicts_act_like_directories():
+    path = os.path.join(test_dir, 'conf.pack')
+    d, other = PackedFSDict(path), PackedFSDict(path)
+    d['a/b'] = 'one'
+    d['c'] = 'two'
+    assert other['a/b'] == 'one' and 'c' in other and len(other) == 2
+    del d['c']
+    with d.batch() as changes:
+        changes['a/b'] = 'three'
+        changes['d'] = 'four'
+    assert list(other) == ['a/b', 'd'] and other['a/b'] == 'three'
+    assert other['c'] is None
+    assert sorted(os.listdir(test_dir)) == ['conf.pack', 'conf.pack.lock']
+
+
+@with_setup(setup=make_test_dir, teardown=clear_test_dir)
+def test_packed_dicts_compact_and_recover_from_torn_writes():
+    path = os.path.join(test_dir, 'conf.pack')
+    d, other = PackedFSDict(path), PackedFSDict(path)
+    for i in range(packed.compact_min // 100):
+        d['key'] = 'x' * 200 + str(i)
+    assert os.path.getsize(path) < packed.compact_min
+    assert other['key'].endswith(str(i))
+    with open(path, 'a') as h:
+        h.write(packed.record('torn', 'value')[:-1])
+    assert 'torn' not in other
+    d['more'] = 'after'
+    assert list(other) == ['key', 'more']
+
+
+@with_setup(setup=make_test_dir, teardown=clear_test_dir)
+def test_layers_can_be_packed():
+    lower = os.path.join(test_dir, 'lower.pack')
+    upper = os.path.join(test_dir, 'upper')
+    PackedFSDict(lower)['x/y'] = 'below'
+    conf = LayeredLocalDirs(paths=[upper, lower], writable=upper)
+    conf['a.b'] = 'above'
+    assert list(conf) == ['a.b', 'x.y'] and conf['x.y'] == 'below'
+
+
+@with_setup(setup=make_test_dir, teardown=clear_test_dir)
+def test_layered_snapshots_follow_changes_to_any_layer():
+    lower = os.path.join(test_dir, 'lower.pack')
+    upper = os.path.join(test_dir, 'upper')
+    conf = LayeredLocalDirs(paths=[upper, lower], writable=upper)
+    other = LayeredLocalDirs(paths=[upper, lower], writable=upper)
+    PackedFSDict(lower)['x/y'] = 'below'
+    assert conf['x.y'] == 'below'
+    merged = conf._snapshot()
+    assert conf._snapshot() is merged
+    other['x.y'] = 'above'
+    assert conf['x.y'] == 'above'
+    del other['x.y']
+    assert 'x.y' not in conf and list(conf) == []
+    with open(os.path.join(upper, 'z'), 'w') as h:
+        h.write('by hand\n')
+    assert conf['z'] == 'by hand'
+    other['a.b'] = 'one'
+    assert conf['a.b'] == 'one'
+    with open(os.path.join(upper, 'a', 'b'), 'w') as h:
+        h.write('edited by hand\n')
+    conf.refresh()
+    assert conf['a.b'] == 'edited by hand'
+
+
+@with_setup(setup=make_test_dir, teardown=clear_test_dir)
+def test_layered_lookups_do_not_walk_the_layers():
+    conf = LayeredLocalDirs(paths=[test_dir], writable=test_dir)
+    with conf.batch() as changes:
+        for n in range(300):
+            changes['k%s.v' % n] = str(n)
+    walks = []
+    stamps = FSDict._stamps
+
+    def counted(self, prefix):
+        if prefix == '':
+            walks.append(prefix)
+        return stamps(self, prefix)
+
+    FSDict._stamps = counted
+    try:
+        conf.refresh()
+        for n in range(100):
+            assert conf['k%s.v' % n] == str(n)
+    finally:
+        FSDict._stamps = stamps
+    assert len(walks) == 1
+
+
+@with_setup(setup=make_test_dir, teardown=clear_test_dir)
+def test_loaded_config_is_typed_and_follows_changes():
+    conf = LayeredLocalDirs(paths=[test_dir], writable=test_dir)
+    loader = Loader(conf)
+    with conf.batch() as changes:
+        changes['service'] = 'a.example.com'
+        changes['node.agent.rotation'] = '10'
+        changes['unknown.setting'] = 'ignored'
+    config = loader.config
+    assert config.service == 'a.example.com'
+    assert config.node.agent.rotation == 10
+    assert loader.load() is config
+    conf['node.agent.rotation'] = '20'
+    assert loader.config is config
+    assert loader.load().node.agent.rotation == 20
+    conf['node.agent.rotation'] = 'many'
+    try:
+        loader.reload()
+        assert False, 'Loaded an invalid rotation.'
+    except Err:
+        pass
+
+
+@with_setup(setup=make_test_dir, teardown=clear_test_dir)
+def test_watches_deliver_typed_changes():
+    conf = LayeredLocalDirs(paths=[test_dir], writable=test_dir)
+    conf['node.rotation'] = '5'
+    changes = []
+    w = conf.watch(['node.rotation', 'service'],
+                   lambda *args: changes.append(args),
+                   debounce=0.01, convert=typed)
+    try:
+        assert w.values == {'node.rotation': 5, 'service': None}
+        conf['node.rotation'] = '6'
+        conf['service'] = 'a.example.com'
+        for _ in range(200):
+            if len(changes) >= 2:
+                break
+            time.sleep(0.01)
+    finally:
+        w.stop()
+    assert sorted(changes) == [('node.rotation', 5, 6),
+                               ('service', None, 'a.example.com')]
+
+
+@with_setup(setup=make_test_dir, teardown=clear_test_dir)
+def test_watches_see_nested_changes_made_by_hand():
+    conf = LayeredLocalDirs(paths=[test_dir], writable=test_dir)
+    changes = []
+    w = conf.watch(['a.b.c'], lambda *args: changes.append(args),
+                   debounce=0.01)
+    try:
+        os.makedirs(os.path.join(test_dir, 'a', 'b'))
+        path = os.path.join(test_dir, 'a', 'b', 'c')
+        with open(os.path.join(test_dir, 'a', 'b', '.c.swp'), 'w') as h:
+            h.write('one\n')
+        os.rename(h.name, path)              # As editors do, all at once
+        for _ in range(200):
+            if len(changes) >= 1:
+                break
+            time.sleep(0.01)
+    finally:
+        w.stop()
+    assert changes == [('a.b.c', None, 'one')]
@@ -1,12 +1,20 @@
+from __future__ import absolute_import
 from contextlib import contextmanager
 import errno
 import fcntl
-import signal
+import os
+import threading
+import time
 
 from . import err
 from .logger import log
 
 
+# Bounds on the pause between attempts to take a contended lock, in seconds.
+backoff_min = 0.0005
+backoff_max = 0.05
+
+
 @contextmanager
 def flock(path, flags=None, seconds=None):
     flags = sort_out_flag_defaults(path, flags, seconds)
@@ -19,14 +27,7 @@ def flock(path, flags=None, seconds=None):
                     raise e
                 raise Locked(path)
         else:
-            with timeout(seconds):
-                try:
-                    fcntl.flock(handle, flags)
-                except IOError as e:
-                    errnos = [errno.EINTR, errno.EACCES, errno.EAGAIN]
-                    if e.errno not in errnos:
-                        raise e
-                    raise Timeout(path)
+            spin(handle, flags, seconds, path)
         yield handle
         log.debug('Unlocking %s.', path)
 
@@ -46,21 +47,122 @@ def sort_out_flag_defaults(path, flags=None, seconds=None):
     return flags
 
 
-@contextmanager
-def timeout(seconds):
-    """Raise if we run out of time.
+def spin(fd, flags, seconds, path=None):
+    """Take a lock, waiting up to ``seconds`` for it, without using signals.
 
-    Due to Glenn Maynard: http://stackoverflow.com/a/5255473/48251
+    A non-blocking ``flock`` is retried, with exponential backoff between
+    attempts, until it succeeds or time runs out. Unlike a blocking ``flock``
+    interrupted by ``SIGALRM``, this works from any thread.
     """
-    def timeout_handler(signum, frame):
-        pass
-    original_handler = signal.signal(signal.SIGALRM, timeout_handler)
-    try:
-        signal.alarm(seconds)
-        yield
-    finally:
-        signal.alarm(0)
-        signal.signal(signal.SIGALRM, original_handler)
+    deadline = time.time() + seconds
+    delay = backoff_min
+    while True:
+        try:
+            fcntl.flock(fd, flags | fcntl.LOCK_NB)
+            return
+        except IOError as e:
+            if e.errno not in [errno.EACCES, errno.EAGAIN]:
+                raise
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise Timeout(path)
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, backoff_max)
+
+
+class Lock(object):
+    """A ``flock`` on a path, shared by all the threads of a process.
+
+    Threads may nest shared and exclusive holds. Only changes to the strongest
+    hold across the process reach the kernel, so re-entering a lock already
+    held costs no system calls. A thread waits while another thread of the
+    process holds the lock in a conflicting way.
+
+    If the path does not exist, holds are tracked but no ``flock`` is taken.
+    """
+    def __init__(self, path, seconds=10):
+        self.path = path
+        self.seconds = seconds
+        self._fd = None
+        self._flags = fcntl.LOCK_UN
+        self._holds = {}                       # Thread ID -> stack of flags
+        self._cv = threading.Condition(threading.Lock())
+
+    def acquire(self, flags):
+        me = threading.current_thread().ident
+        deadline = time.time() + self.seconds
+        with self._cv:
+            mine = self._holds.get(me, [])
+            if fcntl.LOCK_EX in mine or (flags == fcntl.LOCK_SH and mine):
+                self._holds[me] = mine + [flags]   # Covered by what we hold
+                return
+            while self._conflicts(me, flags):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise Timeout(self.path)
+                self._cv.wait(remaining)
+            self._holds[me] = mine + [flags]
+            try:
+                self._apply(deadline)
+            except Exception:
+                self._pop(me)
+                raise
+
+    def release(self):
+        me = threading.current_thread().ident
+        with self._cv:
+            self._pop(me)
+            self._apply(time.time() + self.seconds)
+            self._cv.notify_all()
+
+    def close(self):
+        """Close the descriptor the lock is taken on, if it is not held; it
+           is opened again when next needed.
+        """
+        with self._cv:
+            if self._fd is not None and len(self._holds) == 0:
+                os.close(self._fd)
+                self._fd = None
+
+    def _pop(self, me):
+        self._holds[me] = self._holds[me][:-1]
+        if len(self._holds[me]) <= 0:
+            del self._holds[me]
+
+    def _conflicts(self, me, flags):
+        others = [f for t, fs in self._holds.items() if t != me for f in fs]
+        if flags == fcntl.LOCK_EX:
+            return len(others) > 0
+        return fcntl.LOCK_EX in others
+
+    def _apply(self, deadline):
+        held = [f for fs in self._holds.values() for f in fs]
+        if fcntl.LOCK_EX in held:
+            flags = fcntl.LOCK_EX
+        elif len(held) > 0:
+            flags = fcntl.LOCK_SH
+        else:
+            flags = fcntl.LOCK_UN
+        if flags == self._flags:
+            return
+        self._open()
+        if self._fd is None:
+            return
+        log.debug('Lock (%s -> %s) on: %s', format_lock_flags(self._flags),
+                  format_lock_flags(flags), self.path)
+        if flags == fcntl.LOCK_UN:
+            fcntl.flock(self._fd, flags)
+        else:
+            spin(self._fd, flags, max(0, deadline - time.time()), self.path)
+        self._flags = flags
+
+    def _open(self):
+        if self._fd is None:
+            try:
+                self._fd = os.open(self.path, os.O_RDONLY)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
 
 
 def format_lock_flags(flags):
@@ -1,25 +1,52 @@
+from __future__ import absolute_import
 from collections import MutableMapping
 from contextlib import contextmanager
 import errno
-from fcntl import flock, LOCK_EX, LOCK_NB, LOCK_SH, LOCK_UN
-import itertools
+from fcntl import LOCK_EX, LOCK_SH
 import os
-import signal
-from threading import RLock
+from threading import Event, RLock, Thread
+import time
 
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir
 
+from . import atomic
+from .flock import Lock
 from .logger import log
 
 
 class FSDict(MutableMapping):
-    def __init__(self, path, textual=True, timeout_millis=10):
+    """A directory of files, as a mapping from relative paths to contents.
+
+    Many changes can be made together with ``.batch()``.
+
+    With ``atomic`` (the default), values are written to a temporary file and
+    renamed into place, so single key reads need no lock. Hidden files, like
+    those temporary files, are not keys. With ``fsync``, writes are flushed
+    to disk before they are considered done.
+
+    Values read can be kept in memory by passing ``cache='mtime'``, which
+    checks each file with a ``stat`` before answering from memory, or
+    ``cache='inotify'``, which drops values as inotify reports changes and
+    so answers repeated reads with no system calls at all. The cache, with
+    its ``hits`` and ``misses`` counters, is available as ``.cache``.
+
+    :cvar scan: How often, in seconds, ``generation()`` may walk the tree.
+    """
+    scan = 5.0
+
+    def __init__(self, path, textual=True, timeout_millis=10,
+                 atomic=True, fsync=False, cache=None):
         self.path = path
         self.textual = textual
         self.timeout_millis = timeout_millis
-        self._lk = RLock()
-        self._fd = None
-        self._flags = LOCK_UN
-        self._flags_stack = []
+        self.atomic = atomic
+        self.fsync = fsync
+        self.cache = caches[cache](path) if cache else None
+        self._lock = Lock(path, seconds=timeout_millis / 1000.0)
+        self._scanned = (None, None)               # Time of the walk, stamps
 
     @property
     @contextmanager
@@ -33,120 +60,440 @@ class FSDict(MutableMapping):
         with self._with(shared=True) as self:
             yield self
 
+    # Implement safe locking of this object and the underlying directory. By
+    # locking the underlying directory with `flock`, we allow multiple
+    # processes to share it safely, either via this library or through external
+    # calls to `flock`. Nested uses within a process are handled by the lock
+    # without further calls to `flock`, and any thread may use them.
+
     @contextmanager
     def _with(self, shared=False):
-        self._lock_in(shared=shared)
-        yield self
+        self._lock.acquire(LOCK_SH if shared else LOCK_EX)
         try:
-            self._lock_out()
-        except:
-            if self._fd is not None:
-                os.close(self._fd)
-            raise
+            yield self
+        finally:
+            self._lock.release()
 
-    # Implement safe locking of this object and the underlying directory. By
-    # locking the underlying directory with `flock`, we allow multiple
-    # processes to share it safely, either via this library or through external
-    # calls to `flock`.
+    def generation(self):
+        """A stamp which changes whenever the contents do.
 
-    def _lock_in(self, shared=False):
-        with self._lk:
-            flags = LOCK_SH if shared else LOCK_EX
-            self._flags_stack += [flags]
-            if self._flags != LOCK_EX:         # Don't give up EX on the way in
-                self._flock(flags)
+        Writes through an FSDict touch a hidden ``.generation`` file, and
+        entries added to or removed from the top directory change its mtime;
+        both are checked each time, with a ``stat``. Other changes, like
+        edits by hand to files already there, are noticed by the inode,
+        mtime and size of each file and directory, which are found by
+        walking the tree at most once every ``scan`` seconds, or when asked
+        to with ``refresh()``. With ``cache='inotify'``, the count of changes
+        inotify has reported is used instead, which takes no system calls.
+        """
+        if isinstance(self.cache, InotifyCache) and self.cache.following():
+            return ('inotify', self.cache.changes)
+        stamps = []
+        for path in [self.path, os.path.join(self.path, generation)]:
+            try:
+                st = os.stat(path)
+                stamps += [(st.st_ino, st.st_mtime)]
+            except OSError as e:
+                if e.errno not in [errno.ENOENT, errno.ENOTDIR]:
+                    raise
+                stamps += [None]
+        t, tree = self._scanned
+        if t is None or time.time() - t >= self.scan:
+            tree = hash(tuple(self._stamps('')))
+            self._scanned = (time.time(), tree)
+        return tuple(stamps + [tree])
 
-    def _lock_out(self):
-        with self._lk:
-            self._flags_stack = self._flags_stack[:-1]
-            if self._fd is not None:
-                flags = ([LOCK_UN] + self._flags_stack)[-1]
-                self._flock(flags)  # It's okay to give up locks on the way out
+    def refresh(self):
+        """Walk the tree on the next ``generation()``, to notice changes made
+           without going through an FSDict.
+        """
+        self._scanned = (None, None)
 
-    def _flock(self, flags):
-        with self._lk:
-            self._try_to_open_path()
-            if self._fd is not None and self._flags != flags:
-                log.debug('Lock (%s -> %s) on: %s',
-                          fmt_flock(self._flags),
-                          fmt_flock(flags),
-                          self.path)
-                with timeout_in_syscalls(self.timeout_millis / 1000.0):
-                    flock(self._fd, flags)
-                    self._flags = flags
-
-    def _try_to_open_path(self):
-        if self._fd is None:
+    def close(self):
+        """Stop the cache's background thread, if it has one, and close the
+           lock's descriptor. Lookups still work afterwards, without the
+           cache.
+        """
+        if self.cache is not None:
+            self.cache.close()
+        self._lock.close()
+
+    def _stamps(self, prefix):
+        """The inode, mtime and size of everything under ``prefix``."""
+        try:
+            entries = list(scandir(os.path.join(self.path, prefix)))
+        except OSError as e:
+            if e.errno not in [errno.ENOENT, errno.ENOTDIR]:
+                raise
+            return
+        for entry in sorted(entries, key=lambda entry: entry.name):
             try:
-                self._fd = os.open(self.path, os.O_RDONLY)
+                st = entry.stat()
             except OSError as e:
-                if e.errno != errno.ENOENT:
+                if e.errno != errno.ENOENT:            # Removed since listed
                     raise
+                continue
+            yield prefix + entry.name, st.st_ino, st.st_mtime, st.st_size
+            if entry.is_dir():
+                for stamp in self._stamps(prefix + entry.name + '/'):
+                    yield stamp
+
+    def _bump(self):
+        try:
+            atomic.write(os.path.join(self.path, generation), '')
+        except EnvironmentError as e:
+            if e.errno != errno.ENOENT:                # Nothing written yet
+                raise
+
+    @contextmanager
+    def batch(self):
+        """Collect changes and publish them together when the block exits.
+
+        The exclusive lock is taken once, for the whole block. On exit, each
+        directory written to is created once, new values are staged next to
+        their destinations and flushed (if ``fsync`` is set), and then they
+        are all renamed into place. If the block raises, nothing changes.
+
+        Readers holding the shared lock, like the snapshots of
+        ``LayeredLocalDirs``, see all of the changes or none of them.
+        Lock-free readers of single keys see each key either before or after,
+        but may see some keys changed before others.
+
+        :rtype: Batch
+        """
+        with self.exclusive:
+            changes = Batch(self)
+            yield changes
+            changes.commit()
+
+    def _publish(self, changes):
+        writes = {os.path.join(self.path, path): data
+                  for path, data in changes.items() if data is not None}
+        deletes = [os.path.join(self.path, path)
+                   for path, data in changes.items() if data is None]
+        with self.exclusive:
+            self._ensure_path()
+            for directory in set(os.path.dirname(f) for f in writes):
+                mkdir_p(directory)
+            with atomic.Batch(fsync=self.fsync) as staged:
+                for f, data in sorted(writes.items()):
+                    staged.write(f, self._format(data))
+            for f in deletes:
+                atomic.unlink(f)
+            self._bump()
+            if self.cache is not None:
+                for path in changes:
+                    self.cache.invalidate(path)
 
     def _ensure_path(self):
         mkdir_p(os.path.dirname(self.path))
 
+    def _format(self, text):
+        return text.strip() + '\n' if self.textual else text
+
     def _blind_write(self, path, text):
-        if self.textual:
-            text = text.strip() + '\n'
+        text = self._format(text)
+        if self.atomic:
+            atomic.write(os.path.join(self.path, path), text, self.fsync)
+            return
         with open(os.path.join(self.path, path), 'w') as h:
             return h.write(text)
 
+    @property
+    @contextmanager
+    def _reading(self):
+        """Readers of a single key need a lock only if writes aren't atomic.
+        """
+        if self.atomic:
+            yield self
+        else:
+            with self.shared:
+                yield self
+
     def __getitem__(self, path):
         if not isinstance(path, basestring):
             raise ValueError('FSDicts accept only string keys.')
-        with self.shared:
+        if self.cache is None:
+            return self._read(path)
+        return self.cache.get(path, lambda: self._read(path))
+
+    def _read(self, path):
+        """The contents of a file, or ``None`` if there is no file there
+           (though there may be a directory).
+        """
+        with self._reading:
             try:
                 with open(os.path.join(self.path, path)) as h:
                     return h.read().strip() if self.textual else h.read()
             except IOError as e:
-                if e.errno != errno.ENOENT:
+                if e.errno not in [errno.ENOENT, errno.EISDIR, errno.ENOTDIR]:
                     raise
 
     def __setitem__(self, path, data):
-        if not isinstance(path, basestring):
-            raise ValueError('FSDicts accept only string keys.')
+        check(path, data)
         if data is None:
             self.__delitem__(path)
             return
-        if not isinstance(data, basestring):
-            raise ValueError('FSDicts accept only string values.')
         self._ensure_path()
+        if self.cache is not None:
+            self.cache.invalidate(path)
         with self.exclusive:
             try:
                 self._blind_write(path, data)
-                return
-            except IOError as e:
+            except EnvironmentError as e:
                 if e.errno != errno.ENOENT:
                     raise
-            mkdir_p(os.path.dirname(os.path.join(self.path, path)))
-            self._blind_write(path, data)
+                mkdir_p(os.path.dirname(os.path.join(self.path, path)))
+                self._blind_write(path, data)
+            self._bump()
 
     def __delitem__(self, path):
+        if self.cache is not None:
+            self.cache.invalidate(path)
         with self.exclusive:
             try:
                 os.unlink(os.path.join(self.path, path))
             except OSError as e:
                 if e.errno != errno.ENOENT:
                     raise
+                return
+            self._bump()
 
     def __iter__(self):
+        return self._walk('')
+
+    def _walk(self, prefix):
+        """Yield the keys under ``prefix``, in order, a directory at a time.
+
+        The shared lock is held while each directory is listed, not while
+        keys are being consumed.
+        """
         with self.shared:
-            self_path_with_slash = os.path.join(self.path, '')
-            walker = os.walk(self.path, followlinks=True)
-            paths = [(os.path.join(d, f).split(self_path_with_slash, 1)[1]
-                      for f in fs)
-                     for d, _, fs in walker]
-            return iter(sorted(itertools.chain(*paths), key=split_path))
+            entries = self._list(prefix)
+        for name, is_dir in entries:
+            if is_dir:
+                for path in self._walk(prefix + name + '/'):
+                    yield path
+            else:
+                yield prefix + name
+
+    def _list(self, prefix):
+        try:
+            entries = list(scandir(os.path.join(self.path, prefix)))
+        except OSError as e:
+            if e.errno not in [errno.ENOENT, errno.ENOTDIR]:
+                raise
+            return []
+        return sorted((entry.name, entry.is_dir()) for entry in entries
+                      if not atomic.hidden(entry.name))
 
     def __len__(self):
-        return len(iter(self))
+        return sum(1 for _ in self)
 
     def __contains__(self, path):
-        with self.shared:
+        """Like ``os.path.exists``, so directories are in the dict too; keys
+           found in the cache are answered from it.
+        """
+        if self.cache is not None and self[path] is not None:
+            return True
+        with self._reading:
             return os.path.exists(os.path.join(self.path, path))
 
 
+generation = '.generation'
+
+
+class Batch(object):
+    """Changes to an FSDict, held back until they are committed.
+
+    Reads through a batch see its own changes.
+    """
+    def __init__(self, fsdict):
+        self.fsdict = fsdict
+        self.changes = {}                       # Path -> value, None to delete
+
+    def __getitem__(self, path):
+        if path in self.changes:
+            data = self.changes[path]
+            textual = data is not None and self.fsdict.textual
+            return data.strip() if textual else data
+        return self.fsdict[path]
+
+    def __setitem__(self, path, data):
+        check(path, data)
+        self.changes[path] = data
+
+    def __delitem__(self, path):
+        self.changes[path] = None
+
+    def commit(self):
+        self.fsdict._publish(self.changes)
+        self.changes = {}
+
+
+class Cache(object):
+    """Values read from an FSDict, held in memory until they go stale.
+
+    Missing files are cached too, as ``None``.
+
+    :ivar hits: Lookups answered from memory.
+    :ivar misses: Lookups that went to disk.
+    """
+    def __init__(self, root):
+        self.root = root
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+        self._changes = 0
+        self._lk = RLock()
+
+    def get(self, path, load):
+        """Answer from memory, or else ``load()`` the value and keep it."""
+        with self._lk:
+            if path in self._entries:
+                value, stamp = self._entries[path]
+                if self._fresh(path, stamp):
+                    self.hits += 1
+                    return value
+            self.misses += 1
+            changes = self._changes
+        stamp = self._stamp(path)
+        value = load()
+        with self._lk:
+            # If anything was invalidated while we were loading, what we
+            # loaded may already be stale.
+            if changes == self._changes:
+                self._entries[path] = (value, stamp)
+        return value
+
+    def invalidate(self, path=None):
+        """Drop ``path`` and anything under it; or everything."""
+        with self._lk:
+            self._changes += 1
+            if path is None:
+                self._entries.clear()
+                return
+            prefix = path.rstrip('/') + '/'
+            for k in [k for k in self._entries
+                      if k == path or k.startswith(prefix)]:
+                del self._entries[k]
+
+    def close(self):
+        pass
+
+    def _stamp(self, path):
+        return None
+
+    def _fresh(self, path, stamp):
+        return True
+
+
+class MtimeCache(Cache):
+    """Checks the mtime, size and inode of the file on every lookup: one
+       ``stat`` instead of a lock, an open and a read.
+    """
+    def _stamp(self, path):
+        try:
+            st = os.stat(os.path.join(self.root, path))
+        except OSError as e:
+            if e.errno not in [errno.ENOENT, errno.ENOTDIR]:
+                raise
+            return None
+        return (st.st_mtime, st.st_size, st.st_ino)
+
+    def _fresh(self, path, stamp):
+        return self._stamp(path) == stamp
+
+
+class InotifyCache(Cache):
+    """Drops entries as inotify reports changes under the directory, so that
+       cached lookups make no system calls.
+
+    A background thread follows the events. Changes made through the FSDict
+    itself are seen at once; changes made by others are seen as soon as the
+    thread is told of them. While the directory does not exist, nothing is
+    cached.
+
+    ``close()`` stops the thread; the inotify descriptors are closed as it
+    lets go of them.
+
+    :cvar poll: How long, in seconds, the thread may take to notice that it
+                has been closed.
+    """
+    events = ['IN_ATTRIB', 'IN_CLOSE_WRITE', 'IN_CREATE', 'IN_DELETE',
+              'IN_DELETE_SELF', 'IN_MODIFY', 'IN_MOVED_FROM', 'IN_MOVED_TO']
+    poll = 0.25
+
+    def __init__(self, root):
+        super(InotifyCache, self).__init__(root)
+        self._watching = False
+        self._closed = Event()
+        self._thread = None
+
+    @property
+    def changes(self):
+        """Counts the changes reported, and so those made, to the directory.
+        """
+        return self._changes
+
+    def following(self):
+        """Whether changes are being followed, starting to if need be."""
+        if not self._watching:
+            self._watch()
+        return self._watching
+
+    def get(self, path, load):
+        if not self.following():
+            with self._lk:
+                self.misses += 1
+            return load()
+        return super(InotifyCache, self).get(path, load)
+
+    def close(self):
+        self._closed.set()
+        with self._lk:
+            t = self._thread
+        if t is not None:
+            t.join()
+
+    def _watch(self):
+        import inotify.adapters  # Not available on all platforms
+        import inotify.constants
+        with self._lk:
+            if self._watching or self._closed.is_set() or \
+               not os.path.isdir(self.root):
+                return
+            mask = reduce(lambda a, b: a | b,
+                          [getattr(inotify.constants, e) for e in self.events])
+            tree = inotify.adapters.InotifyTree(self.root, mask=mask,
+                                                block_duration_s=self.poll)
+            self._thread = Thread(target=self._follow, args=(tree,),
+                                  name='inotify:%s' % self.root)
+            self._thread.daemon = True
+            self._thread.start()
+            self._watching = True
+
+    def _follow(self, tree):
+        try:
+            # ``None`` is produced each time ``poll`` seconds pass quietly.
+            for event in tree.event_gen(yield_nones=True):
+                if self._closed.is_set():
+                    break
+                if event is None:
+                    continue
+                _, _, d, name = event
+                path = os.path.relpath(os.path.join(d, name), self.root)
+                self.invalidate(None if path == '.' else path)
+        except Exception as e:
+            log.warning('Stopped watching %s: %s', self.root, e)
+        with self._lk:
+            self._watching = False
+            self.invalidate()
+
+
+caches = dict(mtime=MtimeCache, inotify=InotifyCache)
+
+
 def mkdir_p(path):
     try:
         os.makedirs(path)
@@ -155,25 +502,12 @@ def mkdir_p(path):
             raise
 
 
-def split_path(path):
-    return path.split('/')
-
+def check(path, data=None):
+    if not isinstance(path, basestring):
+        raise ValueError('FSDicts accept only string keys.')
+    if data is not None and not isinstance(data, basestring):
+        raise ValueError('FSDicts accept only string values.')
 
-def fmt_flock(flags):
-    labels = dict(EX=LOCK_EX, NB=LOCK_NB, SH=LOCK_SH, UN=LOCK_UN)
-    return '|'.join(s for s, f in sorted(labels.items()) if (flags & f) != 0)
 
-
-@contextmanager
-def timeout_in_syscalls(seconds):
-    def do_nothing_handler(signum, frame):
-        pass
-    previous_handler = signal.signal(signal.SIGALRM, do_nothing_handler)
-    previous_itimer_values = None
-    try:
-        previous_itimer_values = signal.setitimer(signal.ITIMER_REAL, seconds)
-        yield
-    finally:
-        if previous_itimer_values is not None:
-            signal.setitimer(signal.ITIMER_REAL, *previous_itimer_values)
-        signal.signal(signal.SIGALRM, previous_handler)
+def split_path(path):
+    return path.split('/')
@@ -0,0 +1,85 @@
+"""A record of commands that have succeeded, so that resent commands can be
+skipped.
+
+Commands whose options have ``memoize`` set are identified by a hash of
+everything that determines what they do: the command word and arguments, the
+options they run with, and the changes to the environment made by ``//env``
+and the working directory left by ``//cd``. The environment the daemon
+inherited is left out, since parts of it (like systemd's ``INVOCATION_ID``)
+differ every time it starts. When such a command succeeds, the time is
+recorded in a node-local FSDict, under ``<hash of word>/<hash of command>``;
+the same command, sent again before the record expires, is not run. Internal
+commands are never skipped, since the commands after them need the scope
+they leave.
+
+Records for some command words, or for all of them, are dropped with
+``//forget``.
+"""
+from __future__ import absolute_import
+import hashlib
+import json
+import os
+import time
+
+from .fsdict import FSDict
+from .logger import log
+
+
+root = '/var/lib/drcloud/memo'
+ttl = 24 * 60 * 60
+
+
+class Memo(object):
+    def __init__(self, root=root, ttl=ttl):
+        self.root = root
+        self.ttl = ttl
+        self.store = FSDict(root, timeout_millis=1000)
+
+    def key(self, word, args, options, env=None, cwd=None):
+        """The key for a command, run with the changes ``env`` made to the
+           environment (by default, none) in ``cwd`` (by default, that of
+           this process).
+
+        >>> m = Memo(root='tmp/memo')
+        >>> a = m.key('ls', ['/'], {})
+        >>> a == m.key('ls', ['/'], {}), a == m.key('ls', ['/tmp'], {})
+        (True, False)
+        >>> a.split('/')[0] == digest('ls')
+        True
+        """
+        state = dict(word=word, args=list(args), options=options,
+                     env=dict(env or {}),
+                     cwd=os.getcwd() if cwd is None else cwd)
+        return '%s/%s' % (digest(word), digest(json.dumps(state,
+                                                          sort_keys=True)))
+
+    def fresh(self, key, ttl=None):
+        """Whether the command has succeeded within the last ``ttl`` seconds.
+        """
+        recorded = self.store[key]
+        if recorded is None:
+            return False
+        ttl = self.ttl if ttl is None else ttl
+        return time.time() - float(recorded) < ttl
+
+    def record(self, key):
+        self.store[key] = '%f' % time.time()
+
+    def forget(self, *words):
+        """Drop the records for commands with these words, or all records.
+        """
+        prefixes = tuple(digest(word) + '/' for word in words)
+        keys = [k for k in self.store if not words or k.startswith(prefixes)]
+        with self.store.batch() as changes:
+            for k in keys:
+                del changes[k]
+        log.info('Forgot %s memoized commands.', len(keys))
+
+
+def digest(s):
+    if isinstance(s, unicode):
+        s = s.encode('utf-8')
+    return hashlib.sha256(s).hexdigest()
+
+
+results = Memo()
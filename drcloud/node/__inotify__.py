@@ -1,11 +1,13 @@
 from collections import namedtuple
 from datetime import timedelta
+import errno
 import glob
 from multiprocessing import active_children, Process, Manager
 import os
 
 from sh import mkdir
 
+from .. import atomic
 from ..dds import Envelope
 from ..flock import flock, Timeout
 from ..logger import log
@@ -54,8 +56,13 @@ class Rx(object):
 
     def input_watcher(self):
         import inotify.adapters
+        import inotify.constants
+        # Envelopes are renamed into place once written, so we watch for
+        # renames rather than creation, which happens before the data is
+        # there. Closes after writing cover writers that don't rename.
         w = inotify.adapters.Inotify()
-        w.add_watch(self.i(), mask=inotify.constants.IN_CREATE)
+        w.add_watch(self.i(), mask=(inotify.constants.IN_MOVED_TO |
+                                    inotify.constants.IN_CLOSE_WRITE))
         return (event for event in w.event_gen() if event is not None)
 
     def out_of_time(self):
@@ -77,37 +84,35 @@ class Rx(object):
             if event is None:
                 continue
             (header, types, watchroot, path) = event
-            if 'IN_CREATE' not in types:
+            if not set(types) & set(['IN_MOVED_TO', 'IN_CLOSE_WRITE']):
+                continue
+            if atomic.hidden(path):                    # Still being written
                 continue
             self._counter += 1
             log.debug('Active children: %s', len(active_children()))
             self.sync()
 
     def sync(self):
+        # Envelopes are renamed into place only once they are complete, so
+        # the spools can be read without taking the lock.
+        self.inbox.update(read_spool(self.i()))
+        self.sent.update(read_spool(self.o()))
         log.info('Locking %s', self.lock)
         with flock(self.lock, seconds=self.timeout) as handle:
             handle.seek(0)
             handle.truncate()
             handle.write(self.ident + '\n')
-            ins = [os.path.basename(p) for p in glob.glob(self.i('*'))]
-            outs = [os.path.basename(p) for p in glob.glob(self.o('*'))]
-            for uuid in ins:
-                with open(self.i(str(uuid))) as h:
-                    self.inbox[uuid] = Envelope.unmarshal(h)
-            for uuid in outs:
-                with open(self.o(str(uuid))) as h:
-                    self.sent[uuid] = Envelope.unmarshal(h)
             for envelope in self.pending:
                 log.debug('Writing %s.', envelope.uuid)
-                with open(self.o(str(envelope.uuid)), 'w') as h:
-                    Envelope.marshal(envelope, h)
+                self.write(envelope)
             with self.shared.lock:
                 while not self.shared.pending.empty():
-                    envelope = self.shared.pending.get()
-                    with open(self.o(str(envelope.uuid)), 'w') as h:
-                        Envelope.marshal(envelope, h)
+                    self.write(self.shared.pending.get())
             self.pending = []
 
+    def write(self, envelope):
+        atomic.write(self.o(str(envelope.uuid)), Envelope.marshal(envelope))
+
     def handle(self, envelope):
         assert isinstance(envelope, Envelope)
         handler = Handler(envelope, self.shared.pending)
@@ -157,6 +162,17 @@ class Rx(object):
         return self._service
 
 
+def read_spool(d):
+    """Load the envelopes in a spool directory, by name."""
+    for path in glob.glob(os.path.join(d, '*')):
+        try:
+            with open(path) as h:
+                yield os.path.basename(path), Envelope.unmarshal(h)
+        except IOError as e:
+            if e.errno != errno.ENOENT:         # Removed since we listed it
+                raise
+
+
 class Shared(namedtuple('Shared', 'pending handlers lock')):
     pass
 
@@ -165,9 +181,10 @@ def watcher(d):
     import inotify.adapters
     import inotify.constants
     w = inotify.adapters.Inotify()
-    w.add_watch(d, mask=inotify.constants.IN_CREATE)
+    w.add_watch(d, mask=inotify.constants.IN_MOVED_TO)
     return ((watchroot, path) for _header, _types, watchroot, path in
-            (event for event in w.event_gen() if event is not None))
+            (event for event in w.event_gen() if event is not None)
+            if not atomic.hidden(path))
 
 
 class Handler(object):
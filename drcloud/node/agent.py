@@ -1,5 +1,6 @@
 from collections import namedtuple
 from datetime import timedelta
+import errno
 import glob
 from multiprocessing import active_children, Process, Manager
 import os
@@ -9,6 +10,7 @@ from schematics.types import IntType
 from schematics.types.compound import ModelType
 from sh import mkdir
 
+from .. import atomic
 from ..dds import Envelope
 from ..flock import flock, Timeout
 from ..logger import log
@@ -67,30 +69,26 @@ class Agent(object):
                      self._counter, self._ended - self._started, self.lifetime)
 
     def sync(self):
+        # Envelopes are renamed into place only once they are complete, so
+        # the spools can be read without taking the lock.
+        self.inbox.update(read_spool(self.i()))
+        self.sent.update(read_spool(self.o()))
         log.info('Locking %s', self.lock)
         with flock(self.lock, seconds=self.timeout) as handle:
             handle.seek(0)
             handle.truncate()
             handle.write(self.ident + '\n')
-            ins = [os.path.basename(p) for p in glob.glob(self.i('*'))]
-            outs = [os.path.basename(p) for p in glob.glob(self.o('*'))]
-            for uuid in ins:
-                with open(self.i(str(uuid))) as h:
-                    self.inbox[uuid] = Envelope.unmarshal(h)
-            for uuid in outs:
-                with open(self.o(str(uuid))) as h:
-                    self.sent[uuid] = Envelope.unmarshal(h)
             for envelope in self.pending:
                 log.debug('Writing %s.', envelope.uuid)
-                with open(self.o(str(envelope.uuid)), 'w') as h:
-                    Envelope.marshal(envelope, h)
+                self.write(envelope)
             with self.shared.lock:
                 while not self.shared.pending.empty():
-                    envelope = self.shared.pending.get()
-                    with open(self.o(str(envelope.uuid)), 'w') as h:
-                        Envelope.marshal(envelope, h)
+                    self.write(self.shared.pending.get())
             self.pending = []
 
+    def write(self, envelope):
+        atomic.write(self.o(str(envelope.uuid)), Envelope.marshal(envelope))
+
     def handle(self, envelope):
         assert isinstance(envelope, Envelope)
         handler = Handler(envelope, self.shared.pending)
@@ -140,6 +138,17 @@ class Agent(object):
         return self._service
 
 
+def read_spool(d):
+    """Load the envelopes in a spool directory, by name."""
+    for path in glob.glob(os.path.join(d, '*')):
+        try:
+            with open(path) as h:
+                yield os.path.basename(path), Envelope.unmarshal(h)
+        except IOError as e:
+            if e.errno != errno.ENOENT:         # Removed since we listed it
+                raise
+
+
 class Config(Model):
     channel = ModelType(channel.Config())
     lifetime = IntType(min_value=1, max_value=86400)
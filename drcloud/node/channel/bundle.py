@@ -0,0 +1,81 @@
+"""Bundles group many small outbox envelopes into a single object.
+
+A bundle is a one line JSON index followed by the bundled bodies, back to
+back::
+
+    {"bundle": 1, "index": [["<name>", <offset>, <length>], ...]}
+    <body 0><body 1>...
+
+Offsets are relative to the end of the index line, so a reader can slice out
+any one entry without parsing the others.
+"""
+import json
+import uuid
+
+from ... import err
+
+
+suffix = '.bundle'
+version = 1
+
+
+def name():
+    """A fresh object name for a bundle."""
+    return str(uuid.uuid4()) + suffix
+
+
+def is_bundle(name):
+    return name.endswith(suffix)
+
+
+def pack(entries):
+    """Bundle ``(name, data)`` pairs into a single string.
+
+    >>> pack([('a', 'x'), ('b', 'yz')])
+    '{"bundle": 1, "index": [["a", 0, 1], ["b", 1, 2]]}\\nxyz'
+    """
+    entries = list(entries)
+    index, offset = [], 0
+    for name, data in entries:
+        index += [[name, offset, len(data)]]
+        offset += len(data)
+    header = json.dumps(dict(bundle=version, index=index), sort_keys=True)
+    return header + '\n' + ''.join(data for _, data in entries)
+
+
+def unpack(data):
+    """Recover the ``(name, data)`` pairs from a bundle.
+
+    >>> unpack(pack([('a', 'x'), ('b', 'yz')]))
+    [('a', 'x'), ('b', 'yz')]
+    """
+    header, newline, body = data.partition('\n')
+    try:
+        meta = json.loads(header)
+    except ValueError as e:
+        raise Err('Bundle index is not valid JSON.', underlying=e)
+    if newline == '' or meta.get('bundle') != version:
+        raise Err('Not a version %s bundle.' % version)
+    entries = []
+    for name, offset, length in meta['index']:
+        if offset + length > len(body):
+            raise Err('Bundle is truncated at entry %s.' % name)
+        entries += [(str(name), body[offset:offset + length])]
+    return entries
+
+
+def explode(name, data):
+    """Expand an object from an outbox into its envelopes.
+
+    Objects which are not bundles are passed through as a single entry.
+
+    >>> explode('a', 'x')
+    [('a', 'x')]
+    """
+    if is_bundle(name):
+        return unpack(data)
+    return [(name, data)]
+
+
+class Err(err.Err):
+    pass
@@ -0,0 +1,128 @@
+"""Notifications of new objects, so that channels need not poll S3.
+
+S3 announces new objects on the cloud's SNS topic, which feeds a queue for
+each service. A node long polls its service's queue and fetches only the
+objects named in the notifications it receives.
+"""
+from collections import namedtuple
+import json
+import Queue
+import urllib
+import urlparse
+
+import boto3
+
+from ...logger import log
+
+
+class Notifications(object):
+    """A source of notifications about new objects."""
+    def receive(self, wait=20):
+        """Wait up to ``wait`` seconds for notifications to arrive.
+
+        :rtype: list[Message]
+        """
+        raise NotImplementedError()
+
+    def ack(self, messages):
+        """Mark messages as handled, so that they are not delivered again."""
+        raise NotImplementedError()
+
+
+class SQS(Notifications):
+    def __init__(self, url, **options):
+        self.url = url
+        if 'region_name' not in options:
+            options['region_name'] = region(url)
+        self.sqs = boto3.client('sqs', **options)
+
+    def receive(self, wait=20):
+        res = self.sqs.receive_message(QueueUrl=self.url,
+                                       MaxNumberOfMessages=10,
+                                       WaitTimeSeconds=wait)
+        return [Message(m['ReceiptHandle'], parse(m['Body']))
+                for m in res.get('Messages', [])]
+
+    def ack(self, messages):
+        # Batch deletes are limited to 10 entries, as are receives.
+        for n in range(0, len(messages), 10):
+            entries = [dict(Id=str(i), ReceiptHandle=m.receipt)
+                       for i, m in enumerate(messages[n:n + 10])]
+            self.sqs.delete_message_batch(QueueUrl=self.url, Entries=entries)
+
+
+class Local(Notifications):
+    """A stand-in for a queue, for tests and for running without AWS."""
+    def __init__(self):
+        self.q = Queue.Queue()
+        self.acked = []
+
+    def post(self, key, etag=None):
+        self.q.put(Message(None, [Object(key, etag)]))
+
+    def receive(self, wait=20):
+        messages = []
+        try:
+            messages += [self.q.get(timeout=wait) if wait else
+                         self.q.get_nowait()]
+            while True:
+                messages += [self.q.get_nowait()]
+        except Queue.Empty:
+            pass
+        return messages
+
+    def ack(self, messages):
+        self.acked += messages
+
+
+class Message(namedtuple('Message', 'receipt objects')):
+    """A received notification and the objects it announces."""
+    pass
+
+
+class Object(namedtuple('Object', 'key etag')):
+    pass
+
+
+def region(url):
+    """The region a queue is in, going by its URL.
+
+    >>> region('https://sqs.us-west-2.amazonaws.com/123456789012/q')
+    'us-west-2'
+    >>> region('https://queue.amazonaws.com/123456789012/q') is None
+    True
+    """
+    host = urlparse.urlparse(url).netloc.split('.')
+    if len(host) == 4 and host[0] == 'sqs':
+        return host[1]
+
+
+def parse(body):
+    """Find the new objects described by an S3 event notification.
+
+    Notifications may come straight from S3 or wrapped by SNS. Anything else
+    (for example, auto-scaling notifications from the same topic) describes
+    no objects.
+
+    >>> parse('{"Records": [{"eventName": "ObjectCreated:Put", '
+    ...       '"s3": {"object": {"key": "a/i/b+c", "eTag": "x"}}}]}')
+    [Object(key='a/i/b c', etag='"x"')]
+    >>> parse('{"Type": "Notification", "Message": "{}"}')
+    []
+    """
+    try:
+        data = json.loads(body)
+        if data.get('Type') == 'Notification':
+            data = json.loads(data['Message'])
+    except (ValueError, KeyError, AttributeError):
+        log.warning('Not able to parse notification: %s', body)
+        return []
+    objects = []
+    for record in data.get('Records', []):
+        if not record.get('eventName', '').startswith('ObjectCreated:'):
+            continue
+        o = record['s3']['object']
+        key = urllib.unquote_plus(str(o['key']))
+        etag = '"%s"' % str(o['eTag']) if 'eTag' in o else None
+        objects += [Object(key, etag)]
+    return objects
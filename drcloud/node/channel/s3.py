@@ -1,12 +1,16 @@
 from collections import namedtuple
 import glob
+import itertools
 import os
+import time
 
 import boto3
 from sh import mkdir
 
+from ... import atomic
 from ...anno import computedfield, pre, runonce
 from .. import channel
+from . import bundle, transfer
 from ...logger import log
 
 
@@ -14,28 +18,115 @@ class Channel(channel.Channel):
     def __init__(self, root, name, url,
                  aws_access_key_id=None,
                  aws_secret_access_key=None,
-                 region_name=None):
+                 region_name=None,
+                 bundle=False,
+                 notifications=None):
         options = {k: v for k, v
                    in [('aws_access_key_id', aws_access_key_id),
                        ('aws_secret_access_key', aws_secret_access_key),
                        ('region_name', region_name)]
                    if v}
         super(Channel, self).__init__(root, name, url, **options)
+        self.bundle = bundle
+        self.notifications = notifications
 
     def sync(self):
+        self.pull()
+        self.push()
+
+    def pull(self):
         etag_files = set(self.fslist('etags'))
         for item in self.s3list(self.name, 'i'):
             if item.name in etag_files:
                 continue
-            etag, data = self.s3get(item.key)
-            self.fsput(data, 'i', item.name)
-            self.fsput(etag, 'etags', item.name)
-        for f in self.fslist('o'):
-            if f in etag_files:
+            self.pull_inbox(item.name, item.key)
+        for item in self.s3list(self.name, 'misc'):
+            if self.fsetag(item.name) == item.etag:
                 continue
+            etag = self.s3fetch(item.key, 'misc', item.name)
+            self.fsput(etag, 'etags', item.name)
+
+    def pull_inbox(self, name, key):
+        """Fetch an inbox object, exploding it if it is a bundle.
+        """
+        etag, data = self.s3get(key)
+        for envelope, text in bundle.explode(name, data):
+            self.fsput(text, 'i', envelope)
+        self.fsput(etag, 'etags', name)
+
+    def push(self):
+        etag_files = set(self.fslist('etags'))
+        outs = sorted(f for f in self.fslist('o') if f not in etag_files)
+        if self.bundle:
+            self.push_bundle(outs)
+            return
+        for f in outs:
             key = os.path.join(self.prefix, self.name, 'o', f)
-            data = self.fsget('o', f)
-            etag = self.s3put(key, data)
+            etag = self.s3send(key, 'o', f)
+            self.fsput(etag, 'etags', f)
+
+    def listen(self, wait=20):
+        """Wait for notifications and fetch only the inbox objects they name.
+
+        :returns: The number of new inbox messages.
+        """
+        messages = self.notifications.receive(wait)
+        inbox = os.path.join(self.prefix, self.name, 'i') + '/'
+        etag_files = set(self.fslist('etags'))
+        n = 0
+        for o in itertools.chain(*(m.objects for m in messages)):
+            name = o.key[len(inbox):]
+            if not o.key.startswith(inbox) or '/' in name:
+                continue
+            if name in etag_files:
+                continue
+            self.pull_inbox(name, o.key)
+            etag_files |= set([name])
+            n += 1
+        self.notifications.ack(messages)
+        return n
+
+    def watch(self, period=300, wait=20, lifetime=None):
+        """Exchange messages as they arrive, driven by notifications.
+
+        The inbox is still listed in full every ``period`` seconds, to pick up
+        anything the notifications missed; with ``period=None``, it is never
+        listed, and full syncs are left to someone else.
+        """
+        started, synced = time.time(), None
+        while lifetime is None or time.time() - started < lifetime:
+            if period is not None and \
+               (synced is None or time.time() - synced >= period):
+                self.sync()
+                synced = time.time()
+                continue
+            if lifetime is not None:
+                wait = max(0, min(wait, lifetime - (time.time() - started)))
+            self.listen(wait)
+            self.push()
+
+    def push_bundle(self, outs):
+        """Send all pending outbox envelopes as a single object.
+        """
+        if len(outs) <= 0:
+            return
+        data = bundle.pack((f, self.fsget('o', f)) for f in outs)
+        key = os.path.join(self.prefix, self.name, 'o', bundle.name())
+        log.debug('Bundling %s envelopes into %s.', len(outs), key)
+        etag = self.s3put(key, data)
+        for f in outs:
+            self.fsput(etag, 'etags', f)
+
+    def outbox(self):
+        """Read a node's outbox, as seen from the control side.
+
+        Bundles are exploded, so every envelope is yielded on its own, as a
+        ``(name, data)`` pair.
+        """
+        for item in self.s3list(self.name, 'o'):
+            _, data = self.s3get(item.key)
+            for name, envelope in bundle.explode(item.name, data):
+                yield name, envelope
 
     def s3list(self, *path):
         pgn = self.s3.get_paginator('list_objects')
@@ -57,20 +148,37 @@ class Channel(channel.Channel):
 
     @runonce
     def setup(self):
-        dirs = [self.path('i'), self.path('o'), self.path('etags')]
+        dirs = [self.path('i'), self.path('o'), self.path('misc'),
+                self.path('etags')]
         log.debug('Setting up directories: %s', ' '.join(dirs))
         mkdir('-p', *dirs)
 
+    @pre(setup)
+    def s3fetch(self, key, *path):
+        """Stream a large object to disk, resuming if it was interrupted.
+        """
+        return transfer.download(self.s3, self.bucket, key, self.path(*path))
+
+    @pre(setup)
+    def s3send(self, key, *path):
+        """Stream a file from disk, with multipart upload if it is large.
+        """
+        return transfer.upload(self.s3, self.bucket, key, self.path(*path))
+
     @pre(setup)
     def fsput(self, data, *path):
-        with open(self.path(*path), 'w+') as h:
-            h.write(data)
+        atomic.write(self.path(*path), data)
 
     @pre(setup)
     def fsget(self, *path):
         with open(self.path(*path)) as h:
             return h.read()
 
+    @pre(setup)
+    def fsetag(self, name):
+        if os.path.exists(self.path('etags', name)):
+            return self.fsget('etags', name)
+
     @pre(setup)
     def fslist(self, *path):
         path = list(path) + ['*']
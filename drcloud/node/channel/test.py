@@ -1,5 +1,11 @@
+import os
+import shutil
+import tempfile
+
 from ... import logger
-from . import s3
+from ...dds import Envelope
+from ...protocol import hello
+from . import bundle, notify, s3, transfer
 
 
 def test_s3_works_with_no_input_or_output_on_readonly_bucket():
@@ -9,5 +15,200 @@ def test_s3_works_with_no_input_or_output_on_readonly_bucket():
     chan.sync()
 
 
+def test_bundles_explode_into_their_envelopes():
+    entries = [('1', '{"a": 1}\n'), ('2', ''), ('3', '{\n  "b": [2]\n}')]
+    data = bundle.pack(entries)
+    assert bundle.explode(bundle.name(), data) == entries
+    assert bundle.explode('1', entries[0][1]) == entries[:1]
+
+
+def test_truncated_bundles_are_rejected():
+    data = bundle.pack([('1', 'abc'), ('2', 'def')])
+    try:
+        bundle.unpack(data[:-1])
+    except bundle.Err:
+        return
+    assert False, 'Truncated bundle was accepted.'
+
+
+def test_downloads_resume_after_failure():
+    d = tempfile.mkdtemp()
+    try:
+        path = os.path.join(d, 'artifact')
+        data = ''.join(chr(n % 256) for n in range(1000))
+        fake = FakeS3(data, fail_after=2)
+        try:
+            transfer.download(fake, 'b', 'k', path, chunk=100, workers=1)
+            assert False, 'Download should have failed.'
+        except transfer.Err:
+            pass
+        assert not os.path.exists(path)
+        fake.fail_after = None
+        transfer.download(fake, 'b', 'k', path, chunk=100, workers=3)
+        with open(path, 'rb') as h:
+            assert h.read() == data
+        assert fake.ranges == 2 + 8, 'Finished chunks were fetched again.'
+        assert os.listdir(d) == ['artifact']
+    finally:
+        shutil.rmtree(d)
+
+
+def test_large_uploads_are_multipart():
+    d = tempfile.mkdtemp()
+    try:
+        path = os.path.join(d, 'artifact')
+        with open(path, 'wb') as h:
+            h.write('x' * 250)
+        fake = FakeS3('')
+        transfer.upload(fake, 'b', 'k', path, chunk=100)
+        assert fake.parts == [100, 100, 50]
+        assert fake.data == 'x' * 250
+    finally:
+        shutil.rmtree(d)
+
+
+def test_notifications_fetch_only_named_inbox_objects():
+    d = tempfile.mkdtemp()
+    try:
+        queue = notify.Local()
+        chan = s3.Channel(d, 'a.example.com', 's3://drcloud-test/p/',
+                          notifications=queue)
+        fake = FakeS3('', objects={'p/a.example.com/i/1': '{}'})
+        setattr(chan, '__s3', fake)             # Where computedfield caches
+        queue.post('p/a.example.com/i/1')
+        queue.post('p/b.example.com/i/2')
+        assert chan.listen(wait=0) == 1
+        assert chan.fsget('i', '1') == '{}'
+        assert len(queue.acked) == 2
+        queue.post('p/a.example.com/i/1')
+        assert chan.listen(wait=0) == 0, 'Message was fetched twice.'
+    finally:
+        shutil.rmtree(d)
+
+
+def test_watching_without_a_period_never_lists_the_bucket():
+    d = tempfile.mkdtemp()
+    try:
+        queue = notify.Local()
+        chan = s3.Channel(d, 'a.example.com', 's3://drcloud-test/p/',
+                          notifications=queue)
+        fake = FakeS3('', objects={'p/a.example.com/i/1': '{}'})
+        fake.get_paginator = None               # Listing would fail
+        setattr(chan, '__s3', fake)
+        queue.post('p/a.example.com/i/1')
+        chan.fsput('{}', 'o', '2')
+        chan.watch(period=None, wait=1, lifetime=0.1)
+        assert chan.fsget('i', '1') == '{}'
+        assert 'p/a.example.com/o/2' in fake.objects
+    finally:
+        shutil.rmtree(d)
+
+
+def test_push_streams_the_outbox_and_records_etags():
+    d = tempfile.mkdtemp()
+    try:
+        chan = s3.Channel(d, 'a.example.com', 's3://drcloud-test/p/')
+        fake = FakeS3('')
+        setattr(chan, '__s3', fake)
+        chan.fsput('{}', 'o', '1')
+        chan.push()
+        assert fake.objects == {'p/a.example.com/o/1': '{}'}
+        assert chan.fsetag('1') == '"p/a.example.com/o/1"'
+        chan.push()
+        assert len(fake.objects) == 1
+    finally:
+        shutil.rmtree(d)
+
+
+def test_bundles_round_trip_through_the_channel():
+    d = tempfile.mkdtemp()
+    try:
+        fake = FakeS3('')
+        node = s3.Channel(os.path.join(d, 'node'), 'a.example.com',
+                          's3://drcloud-test/p/', bundle=True)
+        control = s3.Channel(os.path.join(d, 'control'), 'a.example.com',
+                             's3://drcloud-test/p/')
+        setattr(node, '__s3', fake)
+        setattr(control, '__s3', fake)
+        envelopes = {}
+        for n in range(3):
+            m = Envelope(dict(channel='a.example.com', data=hello.Hello(),
+                              sender='node@a.example.com'))
+            envelopes[str(m.uuid)] = Envelope.marshal(m)
+            node.fsput(envelopes[str(m.uuid)], 'o', str(m.uuid))
+        node.push()
+        keys = fake.objects.keys()
+        assert len(keys) == 1 and bundle.is_bundle(keys[0]), keys
+        assert dict(control.outbox()) == envelopes
+        node.push()
+        assert len(fake.objects) == 1, 'Bundled envelopes were sent again.'
+        key = 'p/a.example.com/i/' + bundle.name()
+        fake.objects = {key: fake.objects[keys[0]]}
+        node.pull()
+        assert sorted(node.fslist('i')) == sorted(envelopes)
+        for name, text in envelopes.items():
+            assert Envelope.unmarshal(node.fsget('i', name)).uuid == \
+                Envelope.unmarshal(text).uuid
+    finally:
+        shutil.rmtree(d)
+
+
+class FakeS3(object):
+    """Just enough of the S3 client to exercise channels."""
+    def __init__(self, data, fail_after=None, objects=None):
+        self.data = data
+        self.objects = {} if objects is None else objects
+        self.fail_after = fail_after
+        self.ranges = 0
+        self.parts = []
+
+    def get_paginator(self, operation):
+        return self
+
+    def paginate(self, Bucket, Delimiter, Prefix):
+        keys = sorted(k for k in self.objects
+                      if k.startswith(Prefix) and
+                      Delimiter not in k[len(Prefix):])
+        yield dict(Contents=[dict(Key=k, ETag='"%s"' % k) for k in keys])
+
+    def head_object(self, Bucket, Key):
+        return dict(ETag='"e"', ContentLength=len(self.data))
+
+    def get_object(self, Bucket, Key, IfMatch=None, Range=None):
+        if Range is None:
+            return dict(ETag='"%s"' % Key, Body=FakeBody(self.objects[Key]))
+        if self.fail_after is not None and self.ranges >= self.fail_after:
+            raise IOError('Connection reset.')
+        self.ranges += 1
+        start, end = [int(_) for _ in Range.split('=')[1].split('-')]
+        return dict(Body=FakeBody(self.data[start:end + 1]))
+
+    def put_object(self, Bucket, Key, Body):
+        self.objects[Key] = Body.read() if hasattr(Body, 'read') else Body
+        return dict(ETag='"%s"' % Key)
+
+    def create_multipart_upload(self, Bucket, Key):
+        return dict(UploadId='u')
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        self.parts += [len(Body)]
+        self.data += Body
+        return dict(ETag='"%s"' % PartNumber)
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId,
+                                  MultipartUpload):
+        return dict(ETag='"e-%s"' % len(MultipartUpload['Parts']))
+
+
+class FakeBody(object):
+    def __init__(self, data):
+        self.data = data
+
+    def read(self, n=None):
+        n = len(self.data) if n is None else n
+        data, self.data = self.data[:n], self.data[n:]
+        return data
+
+
 def setup():
     logger.configure()
@@ -0,0 +1,196 @@
+"""Streaming, resumable transfers of large objects to and from S3.
+
+Downloads are split into ranged GETs which run in parallel and are written
+straight to their place in a hidden partial file, ``.<name>.part``. Progress
+is recorded next to it, in ``.<name>.part.json``, along with the object's ETag;
+an interrupted download picks up where it left off as long as the ETag still
+matches. Uploads larger than a single chunk use multipart upload.
+
+Memory use is bounded by ``workers * buffer`` on the way down and by
+``chunk`` on the way up, no matter how big the object is.
+"""
+from collections import namedtuple
+import errno
+import json
+import os
+from Queue import Empty, Queue
+import threading
+
+from botocore.exceptions import ClientError
+
+from ... import atomic, err
+from ...logger import log
+
+
+chunk = 8 * 1024 * 1024
+buffer = 64 * 1024
+workers = 4
+
+
+def download(s3, bucket, key, path, chunk=chunk, workers=workers):
+    """Stream an object to ``path``, resuming an earlier attempt if possible.
+
+    :returns: The ETag of the object.
+    """
+    head = s3.head_object(Bucket=bucket, Key=key)
+    etag, size = head['ETag'], head['ContentLength']
+    part = Partial.load(path, etag, size, chunk)
+    todo = [n for n in range(part.chunks) if n not in part.done]
+    if len(todo) < part.chunks:
+        log.info('Resuming %s at %s of %s chunks.',
+                 key, part.chunks - len(todo), part.chunks)
+
+    def fetch(n):
+        fetch_range(s3, bucket, key, etag, part, n)
+        part.finish(n)
+
+    errors = parallel(fetch, todo, workers)
+    if len(errors) > 0:
+        if precondition_failed(errors[0]):
+            log.warning('%s changed while downloading; starting over.', key)
+            part.discard()
+        raise Err('Failed to download %s.' % key, underlying=errors[0])
+    part.complete()
+    return etag
+
+
+def fetch_range(s3, bucket, key, etag, part, n):
+    start, end = part.range(n)
+    if end < start:                                     # Zero length object
+        return
+    res = s3.get_object(Bucket=bucket, Key=key, IfMatch=etag,
+                        Range='bytes=%d-%d' % (start, end))
+    body = res['Body']
+    with open(part.data, 'r+b') as h:
+        h.seek(start)
+        while True:
+            data = body.read(buffer)
+            if not data:
+                break
+            h.write(data)
+
+
+def parallel(f, items, workers=workers):
+    """Apply ``f`` to ``items`` in a few threads, stopping at the first error.
+
+    :returns: A list of the exceptions raised, if any.
+    """
+    q, errors = Queue(), []
+    for item in items:
+        q.put(item)
+
+    def work():
+        while len(errors) == 0:
+            try:
+                item = q.get_nowait()
+            except Empty:
+                return
+            try:
+                f(item)
+            except Exception as e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=work)
+               for _ in range(min(workers, len(items)))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return errors
+
+
+def upload(s3, bucket, key, path, chunk=chunk):
+    """Upload a file, with multipart upload if it spans more than one chunk.
+
+    :returns: The ETag of the new object.
+    """
+    size = os.path.getsize(path)
+    if size <= chunk:
+        with open(path, 'rb') as h:
+            return s3.put_object(Bucket=bucket, Key=key, Body=h)['ETag']
+    mpu = s3.create_multipart_upload(Bucket=bucket, Key=key)
+    uid, parts = mpu['UploadId'], []
+    try:
+        with open(path, 'rb') as h:
+            for n in range(1, (size + chunk - 1) // chunk + 1):
+                res = s3.upload_part(Bucket=bucket, Key=key, UploadId=uid,
+                                     PartNumber=n, Body=h.read(chunk))
+                parts += [dict(ETag=res['ETag'], PartNumber=n)]
+        res = s3.complete_multipart_upload(Bucket=bucket, Key=key,
+                                           UploadId=uid,
+                                           MultipartUpload=dict(Parts=parts))
+        return res['ETag']
+    except Exception:
+        s3.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=uid)
+        raise
+
+
+def precondition_failed(e):
+    if not isinstance(e, ClientError):
+        return False
+    return e.response.get('Error', {}).get('Code') in ['PreconditionFailed',
+                                                       '412']
+
+
+class Partial(namedtuple('Partial', 'path etag size chunk done lock')):
+    """An in progress download: the partial file and a record of the chunks
+       which have been written to it.
+    """
+    @classmethod
+    def load(cls, path, etag, size, chunk):
+        part = cls(path, etag, size, chunk, set(), threading.Lock())
+        try:
+            with open(part.state) as h:
+                state = json.load(h)
+            if (state['etag'], state['size'], state['chunk']) == \
+               (etag, size, chunk) and os.path.exists(part.data):
+                part.done.update(state['done'])
+                return part
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        except (ValueError, KeyError):
+            pass
+        part.discard()
+        with open(part.data, 'wb') as h:
+            h.truncate(size)
+        part.save()
+        return part
+
+    @property
+    def data(self):
+        d, name = os.path.split(self.path)
+        return os.path.join(d, '.%s.part' % name)
+
+    @property
+    def state(self):
+        return self.data + '.json'
+
+    @property
+    def chunks(self):
+        return max(1, (self.size + self.chunk - 1) // self.chunk)
+
+    def range(self, n):
+        return n * self.chunk, min(self.size, (n + 1) * self.chunk) - 1
+
+    def finish(self, n):
+        with self.lock:
+            self.done.add(n)
+            self.save()
+
+    def save(self):
+        state = dict(etag=self.etag, size=self.size, chunk=self.chunk,
+                     done=sorted(self.done))
+        atomic.write(self.state, json.dumps(state))
+
+    def complete(self):
+        os.rename(self.data, self.path)
+        os.unlink(self.state)
+
+    def discard(self):
+        atomic.unlink(self.data)
+        atomic.unlink(self.state)
+
+
+class Err(err.Err):
+    pass
@@ -1,4 +1,27 @@
 # coding: utf-8
+"""Routes (NAT rules) and names (``/etc/hosts``) for a node, with Linux.
+
+NAT rules can be kept in three ways:
+
+* ``LocalNet`` reconciles rules in the ``OUTPUT`` chain, one by one, with
+  python-iptables;
+* ``RestoreLocalNet`` renders a whole ``DRCLOUD`` chain, jumped to from
+  ``OUTPUT``, and replaces it at once with ``ip6tables-restore --noflush``;
+* ``NftLocalNet`` replaces an nftables table, in which a map from endpoints
+  to upstreams is looked up in one step, however many endpoints there are.
+
+The last two can be run with ``dry_run``, to render what would be loaded,
+and what would be written to ``/etc/hosts``, without changing either (and so
+without root).
+
+Earlier versions put rules in the ``mangle`` table, where DNAT does not
+work; any left there are deleted the first time a node is configured.
+"""
+from collections import namedtuple
+import shlex
+
+import sh
+
 from ..flock import flock
 from ..logger import log
 from . import net
@@ -8,32 +31,53 @@ from .. import time
 class LocalNet(net.LocalNet):
     def __init__(self, hosts_file='/etc/hosts'):
         self.hosts_file = hosts_file
+        self.purged = False
 
     def configure(self, mappings):
+        if not self.purged:
+            self.purge()
+            self.purged = True
         self.nat(mappings)
         self.hosts(mappings)
 
+    def purge(self):
+        """Delete the ``drcloud//`` rules left in the ``mangle`` table."""
+        try:
+            ip6tables = sh.Command('ip6tables')
+            listed = ip6tables('-t', 'mangle', '-S', 'OUTPUT')
+            stale = stale_rules(str(listed))
+            for spec in stale:
+                ip6tables('-t', 'mangle', '-D', *spec)
+        except (sh.ErrorReturnCode, sh.CommandNotFound) as e:
+            log.warning('Could not delete old rules from mangle: %s', e)
+            return
+        if len(stale) > 0:
+            log.info('Deleted %s old rules from mangle.', len(stale))
+
     def nat(self, mappings):
+        """Bring the ``drcloud//`` rules in line with the mappings, inserting
+           and deleting only what differs, in a single commit (or none, if
+           nothing does).
+        """
         import iptc  # Not available on all platforms that might load this file
-        table = iptc.Table6(iptc.Table6.MANGLE)
+        table = iptc.Table6(iptc.Table6.NAT)              # Needed for DNAT
         table.autocommit = False
+        table.refresh()
         chain = iptc.Chain(table, 'OUTPUT')
-        for endpoint, upstreams in mappings.forwards.items():
-            rule = iptc.Rule()
-            rule.dst = str(endpoint)
-            label = rule.create_match('comment')
-            label.comment = 'drcloud//%s' % mappings.names[endpoint]
-            for ip in upstreams:
-                # TODO: Weights
-                if isinstance(ip, net.IPv4):
-                    # TODO: Taiga for IPv6<->IPv4
-                    log.error('Not able to NAT IPv6 to IPv4 yet. (%s <=> %s)',
-                              endpoint, ip)
-                    continue
-                dnat = rule.create_target('DNAT')
-                dnat.to_destination = str(ip)
-            chain.insert_rule(rule)
+        existing = [(parse_rule(rule), rule) for rule in chain.rules]
+        existing = [(found, rule) for found, rule in existing if found]
+        inserts, deletes = diff([found for found, _ in existing],
+                                desired_rules(mappings))
+        if len(inserts) == 0 and len(deletes) == 0:
+            log.debug('NAT rules are up to date.')
+            return
+        for i in sorted(deletes, reverse=True):
+            chain.delete_rule(existing[i][1])
+        for wanted in inserts:
+            chain.insert_rule(make_rule(iptc, wanted))
         table.commit()
+        log.info('NAT rules: %s inserted, %s deleted.',
+                 len(inserts), len(deletes))
 
     def hosts(self, mappings):
         updated_names = sort_and_format_hosts(mappings.names)
@@ -45,6 +89,249 @@ class LocalNet(net.LocalNet):
             handle.write('\n'.join(lines + updated_names + ['']))
 
 
+class Forward(namedtuple('Forward', 'dst comment to')):
+    """A rule sending traffic for an endpoint to an upstream."""
+    pass
+
+
+def desired_rules(mappings):
+    """The rules there should be for the mappings, in order.
+
+    IPv4 upstreams can not be used yet. Where there are many upstreams, the
+    last is used.
+
+    >>> m = net.Mappings({net.FQDN('a.example.com'): net.IPv6('fd00::1'),
+    ...                   net.FQDN('b.example.com'): net.IPv6('fd00::2')},
+    ...                  {net.IPv6('fd00::1'): [net.IPv6('fd00::a'),
+    ...                                         net.IPv6('fd00::b')],
+    ...                   net.IPv6('fd00::2'): [net.IPv4('10.0.0.1')]})
+    >>> desired_rules(m)
+    [Forward(dst='fd00::1', comment='drcloud//a.example.com', to='fd00::b')]
+    """
+    rules = []
+    for endpoint, upstreams in sorted(mappings.forwards.items()):
+        usable = []
+        for ip in upstreams:
+            # TODO: Weights
+            if isinstance(ip, net.IPv4):
+                # TODO: Taiga for IPv6<->IPv4
+                log.error('Not able to NAT IPv6 to IPv4 yet. (%s <=> %s)',
+                          endpoint, ip)
+                continue
+            usable += [ip]
+        if len(usable) == 0:
+            continue
+        rules += [Forward(str(endpoint),
+                          'drcloud//%s' % mappings.ips_to_names[endpoint],
+                          str(usable[-1]))]
+    return rules
+
+
+def stale_rules(listed):
+    """The ``drcloud//`` rules in ``ip6tables -S`` output, as arguments that
+       would delete them.
+
+    >>> stale_rules('-P OUTPUT ACCEPT\\n-A OUTPUT -d fd00::1/128 -m comment '
+    ...             '--comment "drcloud//a.example.com" -j DNAT\\n')
+    ... # doctest: +NORMALIZE_WHITESPACE
+    [['OUTPUT', '-d', 'fd00::1/128', '-m', 'comment', '--comment',
+      'drcloud//a.example.com', '-j', 'DNAT']]
+    """
+    return [shlex.split(line)[1:] for line in listed.splitlines()
+            if line.startswith('-A ') and 'drcloud//' in line]
+
+
+def diff(existing, desired):
+    """What to insert and what to delete (by index into ``existing``) to get
+       from the existing rules to those desired. Duplicates are deleted.
+
+    >>> a, b, c = [Forward('fd00::%s' % n, 'drcloud//x', 'fd00::f')
+    ...            for n in range(3)]
+    >>> diff([a, b, a], [a, c])
+    ([Forward(dst='fd00::2', comment='drcloud//x', to='fd00::f')], [1, 2])
+    >>> diff([a], [a])
+    ([], [])
+    """
+    wanted, kept, deletes = set(desired), set(), []
+    for i, rule in enumerate(existing):
+        if rule in wanted and rule not in kept:
+            kept.add(rule)
+        else:
+            deletes += [i]
+    return [rule for rule in desired if rule not in kept], deletes
+
+
+def parse_rule(rule):
+    """The ``Forward`` an iptc rule is, if it is one of ours."""
+    comments = [m.comment for m in rule.matches if m.name == 'comment']
+    comments = [c for c in comments if c and c.startswith('drcloud//')]
+    if len(comments) == 0:
+        return None
+    to = None
+    if rule.target is not None and rule.target.name == 'DNAT':
+        to = normal(rule.target.to_destination)
+    return Forward(normal(rule.dst.split('/')[0]), comments[0], to)
+
+
+def normal(ip):
+    """An address as we write it, however iptables shows it.
+
+    >>> normal('[fd00:0::0001]')
+    'fd00::1'
+    """
+    try:
+        return str(net.IP(ip.strip('[]')))
+    except Exception:
+        return ip
+
+
+def make_rule(iptc, forward):
+    rule = iptc.Rule6()
+    rule.dst = forward.dst
+    label = rule.create_match('comment')
+    label.comment = forward.comment
+    dnat = rule.create_target('DNAT')
+    dnat.to_destination = forward.to
+    return rule
+
+
+class Loader(LocalNet):
+    """Replaces all the rules at once, by loading a rendering of them."""
+    def __init__(self, hosts_file='/etc/hosts', dry_run=False):
+        super(Loader, self).__init__(hosts_file)
+        self.dry_run = dry_run
+        self.rendered = None
+
+    def nat(self, mappings):
+        self.rendered = self.render(desired_rules(mappings))
+        if self.dry_run:
+            log.info('Would load:\n%s', self.rendered)
+            return
+        self.load(self.rendered)
+
+    def hosts(self, mappings):
+        if self.dry_run:
+            log.info('Would write to %s:\n%s', self.hosts_file,
+                     '\n'.join(sort_and_format_hosts(mappings.names)))
+            return
+        super(Loader, self).hosts(mappings)
+
+    def purge(self):
+        if not self.dry_run:
+            super(Loader, self).purge()
+
+    def render(self, rules):
+        raise NotImplementedError()
+
+    def load(self, text):
+        raise NotImplementedError()
+
+
+jump_comment = 'drcloud//'               # Comment on the jump to our chain
+
+
+class RestoreLocalNet(Loader):
+    chain = 'DRCLOUD'
+
+    def render(self, rules):
+        return render_restore(rules, self.chain, jump=not self.jumped())
+
+    def jumped(self):
+        """Whether ``OUTPUT`` already jumps to our chain."""
+        if self.dry_run:
+            return False
+        try:
+            sh.Command('ip6tables')('-t', 'nat', '-C', 'OUTPUT',
+                                    '-m', 'comment', '--comment', jump_comment,
+                                    '-j', self.chain)
+        except sh.ErrorReturnCode:
+            return False
+        return True
+
+    def load(self, text):
+        sh.Command('ip6tables-restore')('--noflush', _in=text)
+
+
+class NftLocalNet(Loader):
+    table = 'drcloud'
+
+    def render(self, rules):
+        return render_nft(rules, self.table)
+
+    def load(self, text):
+        sh.Command('nft')('-f', '-', _in=text)
+
+
+def render_restore(rules, chain='DRCLOUD', jump=True):
+    """Input for ``ip6tables-restore --noflush`` that replaces ``chain``,
+       in the ``nat`` table, with the rules.
+
+    Declaring the chain creates it, or flushes it, and nothing else in the
+    table is touched. Unless ``OUTPUT`` already jumps to the chain, ``jump``
+    should be set to add the jump.
+
+    >>> f = Forward('fd00::1', 'drcloud//a.example.com', 'fd00::b')
+    >>> print render_restore([f]),
+    *nat
+    :DRCLOUD - [0:0]
+    -A DRCLOUD -d fd00::1/128 -m comment --comment "drcloud//a.example.com" \
+-j DNAT --to-destination fd00::b
+    -I OUTPUT 1 -m comment --comment "drcloud//" -j DRCLOUD
+    COMMIT
+    """
+    lines = ['*nat', ':%s - [0:0]' % chain]
+    for rule in rules:
+        lines += ['-A %s -d %s/128 -m comment --comment "%s" '
+                  '-j DNAT --to-destination %s' %
+                  (chain, rule.dst, rule.comment, rule.to)]
+    if jump:
+        lines += ['-I OUTPUT 1 -m comment --comment "%s" -j %s' %
+                  (jump_comment, chain)]
+    return '\n'.join(lines + ['COMMIT', ''])
+
+
+def render_nft(rules, table='drcloud'):
+    """Input for ``nft -f`` that replaces ``table`` with one that sends
+       traffic for each endpoint to its upstream, through a map.
+
+    The table is declared before it is deleted so that the deletion can
+    not fail; all of it is one transaction.
+
+    >>> f = Forward('fd00::1', 'drcloud//a.example.com', 'fd00::b')
+    >>> print render_nft([f]),
+    table ip6 drcloud
+    delete table ip6 drcloud
+    table ip6 drcloud {
+      map forwards {
+        type ipv6_addr : ipv6_addr
+        elements = { fd00::1 : fd00::b }
+      }
+      chain output {
+        type nat hook output priority -100; policy accept;
+        dnat to ip6 daddr map @forwards
+      }
+    }
+    """
+    elements = ', '.join('%s : %s' % (rule.dst, rule.to) for rule in rules)
+    lines = ['table ip6 %s' % table,
+             'delete table ip6 %s' % table,
+             'table ip6 %s {' % table,
+             '  map forwards {',
+             '    type ipv6_addr : ipv6_addr']
+    if len(rules) > 0:
+        lines += ['    elements = { %s }' % elements]
+    lines += ['  }',
+              '  chain output {',
+              '    type nat hook output priority -100; policy accept;',
+              '    dnat to ip6 daddr map @forwards',
+              '  }',
+              '}']
+    return '\n'.join(lines + [''])
+
+
+backends = dict(iptc=LocalNet, restore=RestoreLocalNet, nft=NftLocalNet)
+
+
 def sort_and_format_hosts(names):
     """
     >>> sort_and_format_hosts({})
@@ -0,0 +1,223 @@
+"""A whole FSDict in a single file, so that loading it costs one open.
+
+The file is a log of records, appended to as keys change::
+
+    drcloud-pack 1\\n
+    <crc32> <kind> <key length> <value length> <key> <value>
+    ...
+
+Readers map the file into memory and index it, scanning only what was
+appended since they last looked; they need no lock, since a record is only
+indexed once it is complete and its checksum matches. Writers append under
+an exclusive ``flock`` on a sidecar file, ``<name>.lock`` (the pack itself
+is replaced when it is compacted, so it can not carry the lock). Once most
+of the file is superseded records, it is compacted: the live records are
+written to a new file, which is renamed into place.
+"""
+from __future__ import absolute_import
+from contextlib import contextmanager
+import errno
+import mmap
+import os
+import struct
+from threading import RLock
+import zlib
+
+from . import atomic, err
+from .flock import Lock
+from .fsdict import FSDict, check, mkdir_p, split_path
+
+
+suffix = '.pack'
+magic = 'drcloud-pack 1\n'
+header = struct.Struct('!IBII')
+put, delete = 1, 2
+
+# Compact once the file is larger than this and mostly superseded records.
+compact_min = 64 * 1024
+
+
+class PackedFSDict(FSDict):
+    """An FSDict kept in one append-only file, with the same interface.
+
+    The index of keys is always in memory, so ``cache`` is ignored.
+    """
+    def __init__(self, path, textual=True, timeout_millis=10,
+                 atomic=True, fsync=False, cache=None):
+        super(PackedFSDict, self).__init__(path, textual=textual,
+                                           timeout_millis=timeout_millis,
+                                           atomic=atomic, fsync=fsync)
+        self._lock = Lock(self.lockfile, seconds=timeout_millis / 1000.0)
+        self._lk = RLock()
+        self._reset()
+
+    @property
+    def lockfile(self):
+        return self.path + '.lock'
+
+    @contextmanager
+    def _with(self, shared=False):
+        if not shared:
+            self._ensure_path()                 # So there is a file to lock
+        with super(PackedFSDict, self)._with(shared=shared) as self:
+            yield self
+
+    def generation(self):
+        try:
+            st = os.stat(self.path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+        return (st.st_dev, st.st_ino, st.st_size)
+
+    def _reset(self):
+        self._stamp = None
+        self._map = None
+        self._index = {}                  # Key -> (offset, length, record)
+        self._scanned = len(magic)
+        self._live = len(magic)
+
+    def _refresh(self):
+        """Bring the index up to date with the file, if it has changed."""
+        try:
+            st = os.stat(self.path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            self._reset()
+            return
+        stamp = (st.st_dev, st.st_ino, st.st_size)
+        if stamp == self._stamp:
+            return
+        if self._stamp is None or self._stamp[:2] != stamp[:2]:
+            self._reset()                              # Replaced or new
+        with open(self.path, 'rb') as h:
+            if st.st_size > 0:
+                self._map = mmap.mmap(h.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map is not None and len(self._map) >= len(magic) and \
+           self._map[:len(magic)] != magic:
+            raise Err('Not a pack: %s' % self.path)
+        self._scan()
+        self._stamp = stamp
+
+    def _scan(self):
+        data, offset = self._map, self._scanned
+        while data is not None and offset + header.size <= len(data):
+            crc, kind, k, v = header.unpack_from(data, offset)
+            start = offset + header.size
+            end = start + k + v
+            if end > len(data) or crc != checksum(data[offset + 4:end]):
+                break                       # Incomplete, or not yet written
+            key = data[start:start + k]
+            self._drop(key)
+            if kind == put:
+                self._index[key] = (start + k, v, end - offset)
+                self._live += end - offset
+            offset = end
+        self._scanned = offset
+
+    def _drop(self, key):
+        if key in self._index:
+            self._live -= self._index.pop(key)[2]
+
+    def __getitem__(self, path):
+        check(path)
+        with self._lk:
+            self._refresh()
+            if path not in self._index:
+                return None
+            offset, length, _ = self._index[path]
+            data = self._map[offset:offset + length]
+        return data.strip() if self.textual else data
+
+    def __setitem__(self, path, data):
+        check(path, data)
+        self._publish({path: data})
+
+    def __delitem__(self, path):
+        check(path)
+        self._publish({path: None})
+
+    def __iter__(self):
+        with self._lk:
+            self._refresh()
+            return iter(sorted(self._index, key=split_path))
+
+    def __len__(self):
+        with self._lk:
+            self._refresh()
+            return len(self._index)
+
+    def __contains__(self, path):
+        with self._lk:
+            self._refresh()
+            return path in self._index
+
+    def _ensure_path(self):
+        mkdir_p(os.path.dirname(self.path) or '.')
+        if not os.path.exists(self.lockfile):
+            with open(self.lockfile, 'a'):
+                pass
+
+    def _publish(self, changes):
+        """Append records for all the changes with a single write."""
+        with self.exclusive, self._lk:
+            self._refresh()
+            if self._stamp is not None and self._stamp[2] != self._scanned:
+                # Anything past the last complete record was left by a
+                # writer that died part way through, and would hide what we
+                # append. Rewriting the file, rather than truncating it, is
+                # safe for readers who have it mapped.
+                self.compact()
+            records = ''.join(record(k, None if v is None else self._format(v))
+                              for k, v in sorted(changes.items()))
+            self._append(records)
+            self._refresh()
+            size = self._stamp[2]
+            if size > compact_min and self._live * 2 < size:
+                self.compact()
+
+    def _append(self, records):
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o666)
+        try:
+            if os.fstat(fd).st_size == 0:
+                records = magic + records
+            os.write(fd, records)
+            if self.fsync:
+                os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def compact(self):
+        """Rewrite the file with only its live records."""
+        with self.exclusive, self._lk:
+            self._refresh()
+            records = [record(k, self._map[o:o + n])
+                       for k, (o, n, _) in sorted(self._index.items())]
+            atomic.write(self.path, magic + ''.join(records), self.fsync)
+            self._refresh()
+
+
+def record(key, value=None):
+    """Encode a record setting ``key`` to ``value``, or deleting it.
+
+    >>> record('a', 'xy')[4:]
+    '\\x01\\x00\\x00\\x00\\x01\\x00\\x00\\x00\\x02axy'
+    """
+    kind = delete if value is None else put
+    value = value or ''
+    body = header.pack(0, kind, len(key), len(value))[4:] + key + value
+    return struct.pack('!I', checksum(body)) + body
+
+
+def checksum(data):
+    return zlib.crc32(data) & 0xffffffff
+
+
+def is_pack(path):
+    return isinstance(path, basestring) and path.endswith(suffix)
+
+
+class Err(err.Err):
+    pass
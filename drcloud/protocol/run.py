@@ -1,7 +1,7 @@
 """The ``run`` protocol describes how nodes run one-off tasks.
 """
 from schematics.models import Model
-from schematics.types import DateTimeType, StringType, UUIDType
+from schematics.types import DateTimeType, IntType, StringType, UUIDType
 from schematics.types.compound import ListType, ModelType
 
 from . import DrC, Rx
@@ -20,6 +20,17 @@ class TSLine(Model):
     s = StringType(required=True)
 
 
+class Usage(Model):
+    """What a task run in a cgroup used."""
+    cpu_usec = IntType()
+    memory_peak = IntType()                                        # Bytes
+    io_read = IntType()
+    io_write = IntType()
+
+    class Options:
+        serialize_when_none = False
+
+
 class Status(Rx):
     """A node responds with the status of the run."""
     uuid = UUIDType(required=True)
@@ -27,6 +38,8 @@ class Status(Rx):
     message = StringType()
     o = ListType(ModelType(TSLine), max_size=128)
     e = ListType(ModelType(TSLine), max_size=128)
+    cached = ListType(IntType())          # Commands skipped, being memoized
+    usage = ModelType(Usage)
 
     class Options:
         serialize_when_none = False
@@ -45,11 +45,13 @@ conf = dict(name='drcloud',
                               'ptpython',
                               'pytz',
                               'schematics',
+                              'scandir',
                               'sh',
                               'sqlparse',
                               'tabulate',
                               'troposphere',
-                              'tzlocal'],
+                              'tzlocal',
+                              'urllib3'],
             extras_require={'node': ['python-iptables', 'inotify']},
             setup_requires=['setuptools'],
             tests_require=['flake8', 'nose', 'tox'],
@@ -1,20 +1,29 @@
-from collections import namedtuple
 from datetime import timedelta
+import errno
 import glob
-from multiprocessing import active_children, Process, Manager
+from multiprocessing import active_children
 import os
+from Queue import Empty, Queue
+import re
 
+from schematics.exceptions import BaseError
 from sh import mkdir
 
+from .. import atomic
+from ..conf import Loader, typed
+from ..conf.lld import LayeredLocalDirs
 from ..dds import Envelope
-from ..flock import flock, Timeout
+from ..flock import flock
 from ..logger import log
 from ..protocol import DrC
 from ..protocol import run
 from ..protocol import hello
-from ..status import Status
-from ..task import Task
 from .. import time
+from ..status import Status
+from . import admission
+from .admission import Admission
+from .pool import Pool
+from .scheduler import Scheduler
 
 
 class Rx(object):
@@ -23,20 +32,27 @@ class Rx(object):
     timeout = 10
     lifetime = timedelta(minutes=15)
 
-    def __init__(self,
-                 service=None, spools=spools, etc=etc, lifetime=lifetime):
+    def __init__(self, service=None, spools=spools, etc=etc,
+                 lifetime=lifetime, conf=None, workers=4, admit=None):
         self.inbox = {}
         self.sent = {}
         self.pending = []
+        self.handled = set()
+        self.admission = admit or Admission()
+        self.waiting = []                      # Envelopes not yet admitted
+        self.results = Queue()
+        self.scheduler = Scheduler(workers)
+        self.pool = Pool(workers)
         self.spools = spools
         self.etc = etc
+        self.conf = conf or Loader(LayeredLocalDirs(paths=[etc], writable=etc))
         self.lifetime = lifetime
         self._started = None
         self._ended = None
         self._counter = 0
         self._service = service
-        self._manager = None
-        self._shared = None
+        self._fixed = service is not None
+        self._watch = None
 
     def start(self):
         """Watch the spool filesystem for messages and respond to them.
@@ -46,10 +62,12 @@ class Rx(object):
         self._started = time.utc()
         self._ended = None
         self._counter = 0
-        mkdir('-p', self.i(), self.o())
+        mkdir('-p', self.i(), self.o(), self.subsidiary_lock(''))
         announce = Envelope(dict(channel=self.service, data=hello.Hello()))
         self.pending += [announce]
-        self.manager()
+        self.pool.start()                       # Fork before starting threads
+        self.watch()
+        self.scheduler.start()
         self.loop()
 
     def loop(self):
@@ -57,60 +75,111 @@ class Rx(object):
             self._counter += 1
             log.debug('Active children: %s', len(active_children()))
             self.sync()
-            # self.handle()
+            self.dispatch()
         else:
             self._ended = time.utc()
+            self.unwatch()
+            self.scheduler.stop()
+            self.scheduler.report()
+            self.pool.stop()
+            self.sync()                                 # Write final results
             log.info('Shutting down after %s iterations in %s, exceeding '
                      'lifetime %s.',
                      self._counter, self._ended - self._started, self.lifetime)
 
+    def watch(self):
+        """Follow changes to the configured service name, so that a node
+           can be renamed without a restart.
+        """
+        if self._watch is None and not self._fixed:
+            self._watch = self.conf.layers.watch(['service'], self.reconfigure,
+                                                 convert=typed)
+
+    def unwatch(self):
+        if self._watch is not None:
+            self._watch.stop()
+            self._watch = None
+
+    def reconfigure(self, key, old, new):
+        log.info('Configuration changed: %s: %s -> %s', key, old, new)
+        self.conf.reload()
+        if key == 'service' and new is not None:
+            self._service = new
+            announce = Envelope(dict(channel=new, data=hello.Hello()))
+            self.results.put(announce)
+
     def sync(self):
+        # Envelopes are renamed into place only once they are complete, so
+        # the spools can be read without taking the lock.
+        self.inbox.update(read_spool(self.i()))
+        self.sent.update(read_spool(self.o()))
         log.info('Locking %s', self.lock)
         with flock(self.lock, seconds=self.timeout) as handle:
             handle.seek(0)
             handle.truncate()
             handle.write(self.ident + '\n')
-            ins = [os.path.basename(p) for p in glob.glob(self.i('*'))]
-            outs = [os.path.basename(p) for p in glob.glob(self.o('*'))]
-            for uuid in ins:
-                with open(self.i(str(uuid))) as h:
-                    self.inbox[uuid] = Envelope.unmarshal(h)
-            for uuid in outs:
-                with open(self.o(str(uuid))) as h:
-                    self.sent[uuid] = Envelope.unmarshal(h)
             for envelope in self.pending:
                 log.debug('Writing %s.', envelope.uuid)
-                with open(self.o(str(envelope.uuid)), 'w') as h:
-                    Envelope.marshal(envelope, h)
-            with self.shared.lock:
-                while not self.shared.pending.empty():
-                    envelope = self.shared.pending.get()
-                    with open(self.o(str(envelope.uuid)), 'w') as h:
-                        Envelope.marshal(envelope, h)
+                self.write(envelope)
             self.pending = []
+            while True:
+                try:
+                    self.write(self.results.get_nowait())
+                except Empty:
+                    break
+
+    def write(self, envelope):
+        atomic.write(self.o(str(envelope.uuid)), Envelope.marshal(envelope))
 
-    def handle(self, envelope):
+    def dispatch(self):
+        """Schedule tasks from messages that have not been handled yet, as
+           they are admitted; those waiting to be admitted go first.
+
+        Tasks already replied to with a final status, by this process or an
+        earlier one, are not run again.
+        """
+        waiting, self.waiting = self.waiting, []
+        for envelope in waiting:
+            self.admit(envelope, announce=False)
+        done = finished(self.sent.values())
+        for _, envelope in sorted(self.inbox.items()):
+            if envelope.uuid in self.handled:
+                continue
+            if envelope.uuid in done:
+                log.debug('Already ran %s.', envelope.uuid)
+            elif isinstance(envelope.data, run.Run):
+                self.admit(envelope)
+            self.handled.add(envelope.uuid)
+
+    def admit(self, envelope, announce=True):
+        """Schedule a task, make it wait or shed it, as the load allows."""
+        handler = Handler(envelope, self.results, self.pool,
+                          self.subsidiary_lock)
+        weight = envelope.data.task.weight()
+        verdict, load = self.admission.admit(weight, len(self.waiting))
+        if verdict == admission.run:
+            self.handle(envelope, weight)
+        elif verdict == admission.wait:
+            self.waiting += [envelope]
+            if announce:
+                handler.status(Status.waiting, 'Waiting for room: %s' % load)
+        else:
+            log.warning('Shedding %s: %s', envelope.data.uuid, load)
+            handler.status(Status.shed, 'Shed, the node being too busy: %s'
+                           % load)
+
+    def handle(self, envelope, weight=None):
         assert isinstance(envelope, Envelope)
-        handler = Handler(envelope, self.shared.pending)
-        self.shared.handlers[envelope.uuid] = handler
-        handler.start()
+        handler = Handler(envelope, self.results, self.pool,
+                          self.subsidiary_lock)
 
-    def manager(self):
-        if self._manager is None:
-            log.debug('Initializing state manager...')
-            self._manager = Manager()
-            # self._manager.start()
-        return self._manager
+        def job():
+            try:
+                handler.handle()
+            finally:
+                self.admission.release(weight)
 
-    @property
-    def shared(self):
-        if self._shared is None:
-            # Note that this namespace is not shared but rather is used to
-            # organize shared resources.
-            self._shared = Shared(pending=self.manager().Queue(),
-                                  handlers=self.manager().dict(),
-                                  lock=self.manager().Lock())
-        return self._shared
+        self.scheduler.submit(envelope.data.task.lock, job)
 
     def i(self, sub=None):
         return os.path.join(self.spools, 'i', sub or '')
@@ -122,7 +191,6 @@ class Rx(object):
     def lock(self):
         return os.path.join(self.spools, 'lock')
 
-    @property
     def subsidiary_lock(self, name):
         return os.path.join(self.spools, 'locks', name)
 
@@ -133,58 +201,101 @@ class Rx(object):
     @property
     def service(self):
         if self._service is None:
-            with open(os.path.join(self.etc, 'service')) as h:
-                self._service = h.read().strip()
+            self._service = self.conf.config.service
         return self._service
 
 
-class Shared(namedtuple('Shared', 'pending handlers lock')):
-    pass
+def read_spool(d):
+    """Load the envelopes in a spool directory, by name.
+
+    Envelopes are named for their UUIDs; other files, like those ``aws s3
+    sync`` writes before renaming them into place, are skipped. So are
+    envelopes that can not be parsed yet, until they can. Envelopes that
+    parse but are not valid never will be, so they are moved aside, to
+    ``quarantined(d)``.
+    """
+    for path in glob.glob(os.path.join(d, '*')):
+        name = os.path.basename(path)
+        if envelope_name.match(name) is None:
+            continue
+        try:
+            with open(path) as h:
+                yield name, Envelope.unmarshal(h)
+        except IOError as e:
+            if e.errno != errno.ENOENT:         # Removed since we listed it
+                raise
+        except BaseError as e:
+            log.warning('Quarantining invalid envelope %s: %s', path, e)
+            quarantine(path)
+        except ValueError as e:
+            log.debug('Not reading %s yet: %s', path, e)
+
+
+def quarantined(d):
+    """Where invalid envelopes from a spool directory are moved to: beside
+       the spools, so that they are not synced along with them.
+
+    >>> quarantined('/var/spool/drcloud/i/')
+    '/var/spool/drcloud/quarantine/i'
+    """
+    spools, spool = os.path.split(os.path.normpath(d))
+    return os.path.join(spools, 'quarantine', spool)
+
+
+def quarantine(path):
+    d = quarantined(os.path.dirname(path))
+    mkdir('-p', d)
+    try:
+        os.rename(path, os.path.join(d, os.path.basename(path)))
+    except OSError as e:
+        if e.errno != errno.ENOENT:             # Removed since we read it
+            raise
+
+
+def finished(envelopes):
+    """The UUIDs of the envelopes whose tasks have been run, or shed, going
+       by the statuses replying to them.
+    """
+    return set(ref for envelope in envelopes
+               if isinstance(envelope.data, run.Status) and
+               envelope.data.status in final
+               for ref in envelope.refs)
+
+
+final = {Status.success, Status.failure, Status.shed}
+envelope_name = re.compile('^[0-9a-f]{8}(-[0-9a-f]{4}){3}-[0-9a-f]{12}$',
+                           re.IGNORECASE)
 
 
 class Handler(object):
-    """Handle a single message.
+    """Handle a single message, posting replies to a queue.
+
+    :param locks: Maps a task's lock name to a path, for the ``flock`` which
+                  keeps tasks under the same lock from interleaving with
+                  those run by other processes.
     """
-    def __init__(self, envelope, q, qlock, timeout=Rx.timeout):
+    def __init__(self, envelope, q, pool, locks, timeout=Rx.timeout):
         self.q = q
-        self.qlock = qlock
+        self.pool = pool
+        self.locks = locks
         self.envelope = envelope
         self.timeout = timeout
-        self.p = None
-
-    def start(self):
-        if self.p is None:
-            name = '%s/%s' % (__package__, self.envelope.uuid)
-            self.p = Process(target=self.handle,
-                             args=(self.envelope.message,),
-                             name=name)
-            self.p.run()
-        return self.p
 
     def handle(self):
-        m = self.envelope.message
+        m = self.envelope.data
         assert isinstance(m, DrC)
         if isinstance(m, run.Run):
-            self.run(m.task)
-        raise ValueError('Unknown message type: %s (%s)',
-                         self.envelope.type,
-                         m.__class__.__name__)
+            return self.pool.run(m, self.locks(m.task.lock), self.timeout,
+                                 self.post)
+        raise ValueError('Unknown message type: %s (%s)' %
+                         (self.envelope.type, m.__class__.__name__))
+
+    def status(self, s, message):
+        self.post(run.Status(dict(uuid=self.envelope.data.uuid, status=s,
+                                  message=message)))
 
     def post(self, message):
         envelope = Envelope(dict(channel=self.envelope.channel,
                                  refs=[self.envelope.uuid],
                                  data=message))
-        with self.qlock:
-            self.q.put(envelope)
-
-    def run(self, task):
-        assert isinstance(task, Task)
-        self.post(run.Status(uuid=task.uuid, status=Status.started))
-        try:
-            with flock(self.subsidiary_lock(task.lock), seconds=Rx.timeout):
-                return task.run()
-        except Timeout as e:
-            self.post(run.Status(uuid=task.uuid,
-                                 status=Status.failed,
-                                 message=str(e)))
-        self.post(run.Status(uuid=task.uuid, status=Status.success))
+        self.q.put(envelope)
@@ -0,0 +1,125 @@
+"""Admit tasks only while the node has room for them.
+
+Tasks may declare, through ``TaskOptions``, how many CPUs (``cpu``) and how
+many MiB of memory (``memory``) they need; those that don't are taken to
+need a little of each. A task is admitted if, after setting aside what the
+tasks already admitted need, the node has room for it: the load average is
+under ``max_load`` per CPU and more than ``reserve`` of memory would still be
+available. Load averages and free memory are slow to reflect new work, so
+admitted tasks keep what they need set aside until they are done. While no
+task is admitted, the load average is not considered, so that a node busy
+with other work still runs tasks, one at a time.
+
+Otherwise the task waits, in order, behind any others waiting; once there
+are ``backlog`` tasks waiting, or if it could never fit on the node, it is
+shed instead.
+"""
+from collections import namedtuple
+import multiprocessing
+import threading
+import time
+
+from ..logger import log
+
+
+cpu = 0.1
+memory = 16
+
+run, wait, shed = 'run', 'wait', 'shed'
+
+
+class Load(namedtuple('Load', 'loadavg cpus available total')):
+    """The 1 minute load average and the number of CPUs, and memory
+       available and in total, in MiB.
+    """
+    def __str__(self):
+        return ('load %.2f on %s CPUs, %s of %s MiB available' %
+                (self.loadavg, self.cpus, self.available, self.total))
+
+
+class Admission(object):
+    def __init__(self, max_load=1.0, reserve=0.1, backlog=64, interval=1.0,
+                 proc='/proc'):
+        self.max_load = max_load
+        self.reserve = reserve
+        self.backlog = backlog
+        self.interval = interval
+        self.proc = proc
+        self.cpu = 0.0                            # Set aside for admitted
+        self.memory = 0
+        self._sampled = (0, None)
+        self._lk = threading.Lock()
+
+    def admit(self, weight, waiting=0):
+        """Decide whether a task needing ``weight``, a ``(cpu, memory)`` pair
+           (either may be ``None``), can run now, with ``waiting`` tasks
+           already waiting. An admitted task must be ``release()``-ed.
+
+        :returns: ``(verdict, load)``, the verdict being one of ``run``,
+                  ``wait`` and ``shed``.
+        """
+        c, m = fill(weight)
+        load = self.load()
+        with self._lk:
+            if m > load.total * (1 - self.reserve):
+                return shed, load
+            cpus = load.cpus * self.max_load - load.loadavg - self.cpu
+            mib = load.available - self.memory - load.total * self.reserve
+            busy = self.cpu > 0 or self.memory > 0
+            fits = (c <= cpus or not busy) and m <= mib
+            if fits and waiting == 0:
+                self.cpu += c
+                self.memory += m
+                return run, load
+        return (shed if waiting >= self.backlog else wait), load
+
+    def release(self, weight):
+        c, m = fill(weight)
+        with self._lk:
+            self.cpu = max(0.0, self.cpu - c)
+            self.memory = max(0, self.memory - m)
+
+    def load(self):
+        """The load of the node, sampled at most once per ``interval``."""
+        t, load = self._sampled
+        if load is None or time.time() - t >= self.interval:
+            load = sample(self.proc)
+            self._sampled = (time.time(), load)
+        return load
+
+
+def fill(weight):
+    """Fill in the need for CPU and memory of tasks which don't say.
+
+    >>> fill((None, 512)), fill(None)
+    ((0.1, 512), (0.1, 16))
+    """
+    c, m = weight or (None, None)
+    return (cpu if c is None else c, memory if m is None else m)
+
+
+def sample(proc='/proc'):
+    with open(proc + '/loadavg') as h:
+        loadavg = float(h.read().split()[0])
+    return Load(loadavg, multiprocessing.cpu_count(),
+                *meminfo(proc + '/meminfo'))
+
+
+def meminfo(path):
+    """Memory available and in total, in MiB, from ``/proc/meminfo``.
+
+    Kernels before 3.14 do not estimate what is available; there, free
+    memory and the page cache are counted.
+    """
+    fields = {}
+    with open(path) as h:
+        for line in h:
+            name, _, value = line.partition(':')
+            fields[name] = int(value.split()[0]) // 1024
+    if 'MemAvailable' in fields:
+        available = fields['MemAvailable']
+    else:
+        log.debug('No MemAvailable in %s; estimating it.', path)
+        available = sum(fields.get(name, 0)
+                        for name in ['MemFree', 'Buffers', 'Cached'])
+    return available, fields['MemTotal']
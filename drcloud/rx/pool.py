@@ -0,0 +1,309 @@
+"""A pool of worker processes, which run tasks.
+
+Each worker takes one task at a time over a pipe and sends back the
+resulting ``run.Status`` messages, a batch at a time: whenever ``batch``
+statuses have piled up or the capture interval has passed since the last
+batch, and when the task is done. Output of the task's commands is captured
+and reported in statuses as it arrives (see ``capture``).
+
+Tasks run in a process of their own so that they can not disturb the
+daemon, but no process is started per task.
+
+Workers are forked by a ``Spawner``, a process forked when the pool starts,
+before the daemon starts any threads: a process forked from one with threads
+may be left holding a lock (like that of ``logging``) which no thread of its
+will ever release. So a worker that dies, while tasks are being run from
+threads, can still be replaced; but once a worker has been replaced
+``restarts`` times within ``window`` seconds, it is not replaced again, and
+the pool shrinks.
+"""
+from contextlib import contextmanager
+import errno
+from multiprocessing import Pipe, Process
+from multiprocessing.reduction import recv_handle, send_handle
+import os
+from Queue import Queue
+import signal
+import threading
+import time
+
+from _multiprocessing import Connection
+
+from .. import capture, cgroup
+from ..flock import flock
+from ..logger import log
+from ..protocol import run
+from ..status import Status
+
+
+class Pool(object):
+    def __init__(self, workers=4, batch=16, restarts=3, window=60):
+        self.workers = workers
+        self.batch = batch
+        self.restarts = restarts
+        self.window = window
+        self._idle = Queue()
+        self._all = []
+        self._spawner = None
+        self._lk = threading.Lock()
+
+    def start(self):
+        if self._spawner is None:
+            self._spawner = Spawner(self.batch)
+        while len(self._all) < self.workers:
+            worker = self._spawner.spawn()
+            self._all += [worker]
+            self._idle.put(worker)
+
+    def stop(self):
+        for worker in self._all:
+            worker.stop()
+        if self._spawner is not None:
+            self._spawner.stop()
+            self._spawner = None
+        self._all = []
+        self._idle = Queue()
+
+    def run(self, m, lock, timeout, post):
+        """Run the task of a ``run.Run`` message in a worker, under ``lock``,
+           passing each status the worker reports to ``post``.
+
+        Waits for a worker to be free, and then for the task to finish.
+        """
+        worker = self._idle.get()
+        if worker is None:                      # Every worker was given up
+            self._idle.put(None)
+            post(status(m, Status.failure, message='No workers are left.'))
+            return
+        try:
+            for s in worker.run(m, lock, timeout):
+                post(s)
+        except (EOFError, IOError) as e:
+            log.error('Worker %s died running %s: %r', worker.pid, m.uuid, e)
+            post(status(m, Status.failure,
+                        message='Worker process %s died: %r' % (worker.pid,
+                                                                e)))
+            worker = self._replace(worker)
+        finally:
+            if worker is not None:
+                self._idle.put(worker)
+            elif len(self._all) == 0:
+                self._idle.put(None)     # Wake those waiting, to fail them
+
+    def _replace(self, worker):
+        """A new worker, in place of one that died; or ``None``, if it has
+           been replaced too often already.
+        """
+        worker.stop()
+        with self._lk:
+            self._all.remove(worker)
+            now = time.time()
+            restarts = [t for t in worker.restarts if now - t < self.window]
+            if len(restarts) >= self.restarts:
+                log.error('Not replacing worker %s, replaced %s times in %ss;'
+                          ' %s workers are left.', worker.pid, len(restarts),
+                          self.window, len(self._all))
+                return None
+            try:
+                new = self._spawner.spawn()
+            except (EOFError, IOError) as e:
+                log.error('Failed to replace worker %s: %r', worker.pid, e)
+                return None
+            new.restarts = restarts + [now]
+            self._all += [new]
+            return new
+
+
+class Spawner(object):
+    """A process which forks workers, for a pool in a process with threads.
+    """
+    def __init__(self, batch):
+        self.conn, child = Pipe()
+        self.p = Process(target=spawn, args=(child, batch),
+                         name='%s:spawner' % __package__)
+        self.p.daemon = True
+        self.p.start()
+        child.close()
+        self._lk = threading.Lock()
+
+    def spawn(self):
+        """Fork a worker, which we talk to over a pipe whose other end is
+           passed to the spawner.
+        """
+        ours, theirs = Pipe()
+        try:
+            with self._lk:
+                self.conn.send('spawn')
+                send_handle(self.conn, theirs.fileno(), self.p.pid)
+                pid = self.conn.recv()
+        finally:
+            theirs.close()
+        return Worker(pid, ours)
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except IOError:
+            pass
+        self.p.join(1)
+        if self.p.is_alive():
+            self.p.terminate()
+        self.conn.close()
+
+
+class Worker(object):
+    """A worker process, forked by the ``Spawner``, and our end of its pipe.
+
+    :ivar restarts: When workers were forked in place of this one's
+                    predecessors.
+    """
+    def __init__(self, pid, conn):
+        self.pid = pid
+        self.conn = conn
+        self.restarts = []
+
+    def run(self, m, lock, timeout):
+        """Send a task and yield the statuses that come back."""
+        self.conn.send((m.to_primitive(), lock, timeout))
+        while True:
+            kind, batch = self.conn.recv()
+            for status in batch:
+                yield run.Status(status)
+            if kind == 'done':
+                return
+
+    def stop(self):
+        """Ask the worker to exit, and kill it if it has not within a
+           second; it is the spawner that waits for it.
+        """
+        try:
+            self.conn.send(None)
+            if self.conn.poll(1):
+                self.conn.recv()
+            kill(self.pid)
+        except (EOFError, IOError):             # It has exited
+            pass
+        self.conn.close()
+
+
+def spawn(conn, batch):
+    """Fork a worker for each request sent over ``conn``, until told to stop.
+    """
+    while conn.recv() is not None:
+        fd = recv_handle(conn)
+        pid = os.fork()
+        if pid == 0:
+            conn.close()
+            code = 0
+            try:
+                serve(Connection(fd), batch)
+            except Exception as e:
+                log.exception('Worker %s failed: %s', os.getpid(), e)
+                code = 1
+            finally:
+                os._exit(code)
+        os.close(fd)
+        conn.send(pid)
+        reap()
+
+
+def reap():
+    """Wait for workers that have exited, so that they do not linger."""
+    while True:
+        try:
+            pid, _ = os.waitpid(-1, os.WNOHANG)
+        except OSError as e:
+            if e.errno != errno.ECHILD:
+                raise
+            return
+        if pid == 0:
+            return
+
+
+def kill(pid):
+    try:
+        os.kill(pid, signal.SIGKILL)
+    except OSError as e:
+        if e.errno != errno.ESRCH:
+            raise
+
+
+def serve(conn, batch):
+    """Run tasks sent over ``conn`` until told to stop."""
+    while True:
+        request = conn.recv()
+        if request is None:
+            return
+        m, lock, timeout = request
+        statuses, sent = [], [time.time()]
+
+        def post(status):
+            statuses.append(status.to_primitive())
+            if len(statuses) >= batch or \
+               time.time() - sent[0] >= capture.interval:
+                conn.send(('status', statuses[:]))
+                del statuses[:]
+                sent[0] = time.time()
+
+        execute(run.Run(m), lock, timeout, post)
+        conn.send(('done', statuses))
+
+
+def execute(m, lock, timeout, post):
+    """Run the task of a ``run.Run`` message under a ``flock``, reporting its
+       output as it goes.
+    """
+    def report(o, e):
+        post(status(m, Status.started, o=o, e=e))
+
+    c = capture.Capture(report)
+    usage = {}
+    post(status(m, Status.started))
+    try:
+        with flock(lock, seconds=timeout), capture.capturing(c), \
+             accounted(m, usage):
+            cached = m.task.run()
+    except Exception as e:
+        log.exception('Task %s failed: %s', m.uuid, e)
+        c.flush()
+        stdout, stderr = c.tail()
+        post(status(m, Status.failure, message=str(e), o=stdout, e=stderr,
+                    usage=usage))
+        return
+    c.flush()
+    post(status(m, Status.success, cached=cached, usage=usage))
+
+
+@contextmanager
+def accounted(m, usage):
+    """Confine the task to a cgroup, if it asks to be, and fill in ``usage``
+       with what it used.
+    """
+    limits = m.task.cgroup
+    if limits is None:
+        yield
+        return
+    group = None
+    try:
+        with cgroup.confined(str(m.uuid), limits.cpu, limits.memory) as group:
+            yield
+    finally:
+        if group is not None and group.usage is not None and limits.account:
+            usage.update(group.usage._asdict())
+
+
+def status(m, s, message=None, o=[], e=[], cached=[], usage={}):
+    """A ``run.Status`` for a ``run.Run``, with lines of output as captured,
+       the indices of commands skipped because they were memoized and what
+       the task used.
+    """
+    data = dict(uuid=m.uuid, status=s, message=message)
+    if len(cached) > 0:
+        data.update(cached=cached)
+    if len(usage) > 0:
+        data.update(usage=usage)
+    if len(o) > 0:
+        data.update(o=[dict(t=t, s=line) for t, line in o])
+    if len(e) > 0:
+        data.update(e=[dict(t=t, s=line) for t, line in e])
+    return run.Status(data)
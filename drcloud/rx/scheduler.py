@@ -0,0 +1,111 @@
+"""Run jobs in a bounded pool of threads, serially for each lock.
+
+Each lock has a FIFO queue. Jobs under one lock run one at a time, in the
+order they were submitted; jobs under different locks run concurrently, up
+to the number of workers. This is the promise made in ``task``: tasks under
+the same lock never interleave, and other tasks need not wait for them.
+"""
+from collections import deque
+import threading
+import time
+
+from ..logger import log
+
+
+class Scheduler(object):
+    def __init__(self, workers=4):
+        self.workers = workers
+        self.stats = {}                                   # Lock -> Stats
+        self._queues = {}                     # Lock -> deque of (t, job)
+        self._ready = deque()        # Locks with jobs queued, none running
+        self._cv = threading.Condition()
+        self._threads = []
+        self._stopping = False
+
+    def start(self):
+        with self._cv:
+            self._stopping = False
+            while len(self._threads) < self.workers:
+                t = threading.Thread(target=self._work, name='%s:%s' %
+                                     (__name__, len(self._threads)))
+                t.daemon = True
+                t.start()
+                self._threads += [t]
+
+    def stop(self, wait=True):
+        """Stop the workers once the queues are empty."""
+        with self._cv:
+            self._stopping = True
+            self._cv.notify_all()
+        if wait:
+            for t in self._threads:
+                t.join()
+        self._threads = []
+
+    def submit(self, lock, job):
+        """Queue ``job``, a callable, to run after earlier jobs under ``lock``.
+        """
+        with self._cv:
+            stats = self.stats.setdefault(lock, Stats())
+            stats.depth += 1
+            if lock not in self._queues:
+                self._queues[lock] = deque()
+                self._ready.append(lock)
+            self._queues[lock].append((time.time(), job))
+            self._cv.notify()
+
+    def idle(self):
+        with self._cv:
+            return len(self._queues) == 0
+
+    def report(self):
+        """Log queue depth and wait time for each lock."""
+        with self._cv:
+            for lock, stats in sorted(self.stats.items()):
+                log.info('Lock %s: %s', lock, stats)
+
+    def _work(self):
+        while True:
+            with self._cv:
+                while len(self._ready) == 0 and not self._stopping:
+                    self._cv.wait()
+                if len(self._ready) == 0:
+                    return
+                lock = self._ready.popleft()
+                t, job = self._queues[lock].popleft()
+                self.stats[lock].started(time.time() - t)
+            try:
+                job()
+            except Exception as e:
+                log.exception('Job under %s failed: %s', lock, e)
+            with self._cv:
+                if len(self._queues[lock]) > 0:
+                    self._ready.append(lock)
+                    self._cv.notify()
+                else:
+                    del self._queues[lock]
+                    self._cv.notify_all()
+
+
+class Stats(object):
+    """Jobs queued and run under a lock, and how long they waited to start.
+    """
+    def __init__(self):
+        self.depth = 0
+        self.ran = 0
+        self.waited = 0.0
+        self.longest = 0.0
+
+    def started(self, waited):
+        self.depth -= 1
+        self.ran += 1
+        self.waited += waited
+        self.longest = max(self.longest, waited)
+
+    @property
+    def mean(self):
+        return self.waited / self.ran if self.ran > 0 else 0.0
+
+    def __str__(self):
+        return ('%s queued, %s run, waited %.3fs on average and %.3fs at most'
+                % (self.depth, self.ran, self.mean, self.longest))
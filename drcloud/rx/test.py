@@ -1,14 +1,30 @@
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
 from datetime import timedelta
+from SocketServer import ThreadingMixIn
+from StringIO import StringIO
 from glob import glob
+import hashlib
+import os
+import subprocess
+import threading
+import time
+import uuid
 
 from nose import with_setup
-from sh import rm
+from sh import mkdir, rm
 
+from ..protocol import run
 from ..protocol.hello import Hello
 from ..dds import Envelope
-from .. import logger
+from .. import artifacts, capture, cgroup, logger, memo
 from ..logger import log
-from . import Rx
+from ..status import Status
+from ..task import Task
+from . import Rx, read_spool
+from . import admission
+from .admission import Admission
+from .pool import Pool
+from .scheduler import Scheduler
 
 
 test_dir = 'tmp/spools'
@@ -36,5 +52,459 @@ def test_runs_at_all():
     log.info('Loaded: %s', hellos[0])
 
 
+def test_scheduler_runs_each_lock_in_order():
+    scheduler, ran = Scheduler(workers=3), []
+    for n in range(20):
+        scheduler.submit('lock-%s' % (n % 2), lambda n=n: ran.append(n))
+    scheduler.start()
+    scheduler.stop()
+    assert [n for n in ran if n % 2 == 0] == range(0, 20, 2)
+    assert [n for n in ran if n % 2 == 1] == range(1, 20, 2)
+    assert scheduler.stats['lock-0'].ran == 10
+    assert scheduler.stats['lock-0'].depth == 0
+
+
+def test_scheduler_runs_locks_concurrently_up_to_its_cap():
+    scheduler = Scheduler(workers=2)
+    lk, running, most = threading.Lock(), [0], [0]
+
+    def job():
+        with lk:
+            running[0] += 1
+            most[0] = max(most[0], running[0])
+        time.sleep(0.02)
+        with lk:
+            running[0] -= 1
+
+    for n in range(6):
+        scheduler.submit('lock-%s' % n, job)
+    scheduler.start()
+    scheduler.stop()
+    assert most[0] == 2
+
+
 def setup():
     logger.configure()
+
+
+@with_setup(setup=clear_test_dir)
+def test_pool_runs_tasks_in_workers_and_reports_status():
+    pool, posted = Pool(workers=1, batch=1), []
+    os.makedirs(test_dir)
+    pool.start()
+    try:
+        for word in ['true', 'false']:
+            task = dict(lock='test', code=[dict(word=word, args=[])])
+            m = run.Run(dict(uuid=str(uuid.uuid4()), task=task))
+            pool.run(m, os.path.join(test_dir, 'lock'), 1, posted.append)
+    finally:
+        pool.stop()
+    assert [s.status for s in posted] == [Status.started, Status.success,
+                                          Status.started, Status.failure]
+
+
+@with_setup(setup=clear_test_dir)
+def test_pool_reports_output_of_tasks():
+    pool, posted = Pool(workers=1), []
+    os.makedirs(test_dir)
+    script = 'echo one; echo two; echo three >&2; exit 3'
+    task = dict(lock='test', code=[dict(word='sh', args=['-c', script])])
+    pool.start()
+    try:
+        m = run.Run(dict(uuid=str(uuid.uuid4()), task=task))
+        pool.run(m, os.path.join(test_dir, 'lock'), 1, posted.append)
+    finally:
+        pool.stop()
+    o = [line.s for status in posted[:-1] for line in status.o or []]
+    e = [line.s for status in posted[:-1] for line in status.e or []]
+    assert (o, e) == (['one', 'two'], ['three'])
+    assert posted[-1].status == Status.failure
+    assert [line.s for line in posted[-1].e] == ['three']
+
+
+@with_setup(setup=clear_test_dir)
+def test_pool_decodes_output_which_is_not_utf8():
+    pool, posted = Pool(workers=1), []
+    os.makedirs(test_dir)
+    task = dict(lock='test', code=[dict(word='printf',
+                                        args=['caf\\351\\n'])])
+    pool.start()
+    try:
+        m = run.Run(dict(uuid=str(uuid.uuid4()), task=task))
+        pool.run(m, os.path.join(test_dir, 'lock'), 1, posted.append)
+    finally:
+        pool.stop()
+    o = [line.s for status in posted for line in status.o or []]
+    assert o == [u'caf\ufffd']
+    assert posted[-1].status == Status.success
+
+
+@with_setup(setup=clear_test_dir)
+def test_pool_replaces_workers_which_die_until_they_die_too_often():
+    pool, posted = Pool(workers=1, batch=1, restarts=1), []
+    os.makedirs(test_dir)
+    pool.start()
+    try:
+        for script in ['kill -9 $PPID; sleep 1', 'true'] * 2:
+            task = dict(lock='test', code=[dict(word='sh',
+                                                args=['-c', script])])
+            m = run.Run(dict(uuid=str(uuid.uuid4()), task=task))
+            pool.run(m, os.path.join(test_dir, 'lock'), 1, posted.append)
+    finally:
+        pool.stop()
+    assert [s.status for s in posted] == [Status.started, Status.failure,
+                                          Status.started, Status.success,
+                                          Status.started, Status.failure,
+                                          Status.failure]
+    assert 'died: EOFError' in posted[1].message
+    assert posted[-1].message == 'No workers are left.'
+
+
+@with_setup(setup=clear_test_dir)
+def test_artifacts_are_downloaded_once_and_evicted_when_unused():
+    cache = artifacts.Cache(root=test_dir, limit=10)
+    fetched = []
+
+    def fetcher(url, path, etag=None, last_modified=None):
+        fetched.append((url, etag))
+        if etag == url:
+            return artifacts.Response(False, etag, None)
+        with open(path, 'w') as h:
+            h.write('#!/bin/sh\n')
+        return artifacts.Response(True, url, None)
+
+    digest = hashlib.sha256('#!/bin/sh\n').hexdigest()
+    with cache.fetch('http://a', fetcher) as a:
+        with cache.fetch('http://a', fetcher) as again:
+            assert a == again and os.access(a, os.X_OK)
+        with cache.fetch('http://b', fetcher, sha256=digest):
+            pass
+        with cache.fetch('http://b', fetcher, sha256=digest):
+            pass
+    assert fetched == [('http://a', None), ('http://a', 'http://a'),
+                       ('http://b', None)]
+    assert os.path.exists(a)
+    with cache.fetch('http://c', fetcher):
+        pass
+    assert not os.path.exists(a)
+    try:
+        with cache.fetch('http://d', fetcher, sha256='0' * 64):
+            assert False, 'Used content with the wrong digest.'
+    except artifacts.Err:
+        pass
+
+
+class Served(BaseHTTPRequestHandler):
+    requests = []
+
+    def do_GET(self):
+        Served.requests.append(self.headers.get('If-None-Match'))
+        if self.headers.get('If-None-Match') == '"v1"':
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', '"v1"')
+        self.send_header('Content-Length', '10')
+        self.end_headers()
+        self.wfile.write('#!/bin/sh\n')
+
+    def log_message(self, *args):
+        pass
+
+
+class KeptAlive(Served):
+    protocol_version = 'HTTP/1.1'
+    peers = []
+
+    def do_GET(self):
+        KeptAlive.peers.append(self.client_address)
+        Served.do_GET(self)
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeS3(object):
+    def __init__(self):
+        self.calls = []
+
+    def head_object(self, Bucket, Key):
+        self.calls.append(('head', Bucket, Key))
+        return dict(ETag='"e1"')
+
+    def get_object(self, Bucket, Key, IfMatch):
+        self.calls.append(('get', Bucket, Key))
+        return dict(ETag=IfMatch, Body=StringIO('#!/bin/sh\n'))
+
+
+@with_setup(setup=clear_test_dir)
+def test_artifacts_are_fetched_in_process_and_revalidated():
+    server = HTTPServer(('127.0.0.1', 0), Served)
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    try:
+        url = 'http://127.0.0.1:%s/x' % server.server_port
+        os.makedirs(test_dir)
+        path = os.path.join(test_dir, 'x')
+        res = artifacts.http(url, path)
+        assert res.changed and res.etag == '"v1"'
+        assert open(path).read() == '#!/bin/sh\n'
+        assert not artifacts.http(url, path, etag=res.etag).changed
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+@with_setup(setup=clear_test_dir)
+def test_tasks_run_artifacts_from_urls_through_the_cache():
+    server = HTTPServer(('127.0.0.1', 0), Served)
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    cache, artifacts.cache = artifacts.cache, artifacts.Cache(root=test_dir)
+    Served.requests = []
+    try:
+        url = 'http://127.0.0.1:%s/x' % server.server_port
+        for _ in range(2):
+            Task(dict(code=[dict(word=url)])).run()
+    finally:
+        artifacts.cache = cache
+        server.shutdown()
+        server.server_close()
+    assert Served.requests == [None, '"v1"']          # Then a 304
+
+
+@with_setup(setup=clear_test_dir)
+def test_tasks_share_connections_and_clients_for_downloads():
+    server = Server(('127.0.0.1', 0), KeptAlive)
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    cache, artifacts.cache = artifacts.cache, artifacts.Cache(root=test_dir)
+    s3, artifacts._clients['s3'] = artifacts._clients.get('s3'), FakeS3()
+    KeptAlive.peers = []
+    try:
+        url = 'http://127.0.0.1:%s/x' % server.server_port
+        for word in [url, url, 's3://bucket/x', 's3://bucket/x']:
+            Task(dict(code=[dict(word=word)])).run()
+        calls = artifacts._clients['s3'].calls
+    finally:
+        artifacts.cache = cache
+        artifacts._clients.pop('s3')
+        if s3 is not None:
+            artifacts._clients['s3'] = s3
+        artifacts.session().clear()
+        server.shutdown()
+        server.server_close()
+    assert len(KeptAlive.peers) == 2 and len(set(KeptAlive.peers)) == 1
+    assert calls == [('head', 'bucket', 'x'), ('get', 'bucket', 'x'),
+                     ('head', 'bucket', 'x')]
+
+
+@with_setup(setup=clear_test_dir)
+def test_memoized_commands_are_skipped_until_forgotten():
+    results = memo.Memo(root=os.path.join(test_dir, 'memo'))
+    out = os.path.join(test_dir, 'out')
+    os.makedirs(test_dir)
+
+    def task(words, env=[]):
+        code = [dict(word='//env', args=kv) for kv in env]
+        code += [dict(word='sh', args=['-c', 'echo %s >> %s' % (w, out)])
+                 for w in words]
+        return Task(dict(code=code, options={'sh': dict(memoize=True)}))
+
+    assert task(['a', 'b']).run(results) == []
+    assert task(['a', 'c']).run(results) == [0]
+    os.environ['DRCLOUD_TEST_MEMO'] = 'x'         # Differs by process: ignored
+    try:
+        assert task(['a']).run(results) == [0]
+    finally:
+        del os.environ['DRCLOUD_TEST_MEMO']
+    assert task(['a'], env=[['DRCLOUD_TEST_MEMO', 'x']]).run(results) == []
+    results.forget('sh')
+    assert task(['a']).run(results) == []
+    assert open(out).read().split() == ['a', 'b', 'c', 'a', 'a']
+
+
+@with_setup(setup=clear_test_dir)
+def test_memoized_tasks_still_change_directory_and_environment():
+    results = memo.Memo(root=os.path.join(test_dir, 'memo'))
+    work = os.path.abspath(os.path.join(test_dir, 'work'))
+    os.makedirs(work)
+
+    def task(n):
+        script = 'echo $PWD $DRCLOUD_TEST_MEMO > out # %s' % n
+        code = [dict(word='//cd', args=[work]),
+                dict(word='//env', args=['DRCLOUD_TEST_MEMO', 'x']),
+                dict(word='sh', args=['-c', script])]
+        return Task(dict(code=code, options={'*': dict(memoize=True)}))
+
+    assert task(1).run(results) == []
+    assert task(1).run(results) == [2]
+    assert task(2).run(results) == []
+    assert open(os.path.join(work, 'out')).read().split() == [work, 'x']
+    assert not os.path.exists('out')
+
+
+@with_setup(setup=clear_test_dir)
+def test_graph_runs_branches_in_their_own_scope_and_cuts_off_failures():
+    os.makedirs(os.path.join(test_dir, 'sub'))
+    out = os.path.abspath(os.path.join(test_dir, 'out'))
+
+    def echo(name, after=[], text='$X'):
+        script = 'echo %s %s $(basename $PWD) >> %s' % (name, text, out)
+        return dict(word='sh', args=['-c', script], name=name, after=after)
+
+    code = [dict(word='//cd', args=[test_dir], name='cd'),
+            dict(word='//env', args=['X', 'a'], name='a', after=['cd']),
+            dict(word='//cd', args=['sub'], name='b', after=['cd']),
+            echo('ea', ['a']), echo('eb', ['b']),
+            dict(word='false', args=[], name='f', after=['cd']),
+            echo('ef', ['f', 'ea'])]
+    try:
+        Task(dict(code=code, concurrency=2)).run()
+        assert False, 'A failed command was not reported.'
+    except Exception as e:
+        assert 'false' in str(e)
+    lines = sorted(open(out).read().splitlines())
+    assert lines == ['ea a spools', 'eb sub'], lines
+
+
+@with_setup(setup=clear_test_dir)
+def test_shell_executor_runs_commands_in_one_shell_in_their_scope():
+    os.makedirs(os.path.join(test_dir, 'sub'))
+    code = [dict(word='//cd', args=[test_dir]),
+            dict(word='//env', args=['X', "it's"]),
+            dict(word='sh', args=['-c', 'echo $PPID $X; cd /']),
+            dict(word='//cd', args=['sub']),
+            dict(word='sh', args=['-c', 'echo $PPID $(basename $PWD) >&2'])]
+    captured = []
+    c = capture.Capture(lambda o, e: captured.append((o, e)))
+    with capture.capturing(c):
+        Task(dict(code=code, executor='shell')).run()
+    o, e = c.tail()
+    (first, x), (second, sub) = [line.split(' ', 1) for _, line in o + e]
+    assert first == second, 'Commands ran in different shells.'
+    assert (x, sub) == ("it's", 'sub')
+    try:
+        Task(dict(code=[dict(word='false')], executor='shell')).run()
+        assert False, 'A failed command was not reported.'
+    except subprocess.CalledProcessError as e:
+        assert e.returncode == 1
+
+
+@with_setup(setup=clear_test_dir)
+def test_admission_queues_and_sheds_tasks_when_the_node_is_busy():
+    os.makedirs(test_dir)
+    with open(os.path.join(test_dir, 'loadavg'), 'w') as h:
+        h.write('0.00 0.00 0.00 1/100 1000\n')
+    with open(os.path.join(test_dir, 'meminfo'), 'w') as h:
+        h.write('MemTotal: 1048576 kB\nMemAvailable: 524288 kB\n')
+    gate = Admission(reserve=0.25, backlog=1, proc=test_dir)
+    assert gate.admit((None, 2048))[0] == admission.shed   # Never fits
+    assert gate.admit((None, 200))[0] == admission.run
+    assert gate.admit((None, 100))[0] == admission.wait
+    assert gate.admit((None, 10), waiting=1)[0] == admission.shed
+    gate.release((None, 200))
+    assert gate.admit((None, 100))[0] == admission.run
+
+
+@with_setup(setup=clear_test_dir)
+def test_tasks_are_confined_to_cgroups_of_their_own():
+    root = os.path.abspath(os.path.join(test_dir, 'cgroup'))
+    os.makedirs(os.path.join(root, cgroup.current().lstrip('/')))
+    with open(os.path.join(root, 'cgroup.controllers'), 'w') as h:
+        h.write('cpu memory io\n')
+    with cgroup.confined('t', cpu=0.5, memory=64, root=root) as group:
+        assert not os.path.exists(group.file('cgroup.procs'))
+        p = subprocess.Popen(['true'], preexec_fn=cgroup.preexec())
+        p.wait()
+        assert open(group.file('cgroup.procs')).read() == str(p.pid)
+        with open(group.file('cpu.stat'), 'w') as h:
+            h.write('usage_usec 1500\n')
+    assert open(group.file('cpu.max')).read() == '50000 100000'
+    assert open(group.file('memory.max')).read() == str(64 * 1024 * 1024)
+    assert open(os.path.join(root, 'cgroup.subtree_control')).read() == '+io'
+    assert group.usage == cgroup.Usage(1500, None, None, None)
+
+
+@with_setup(setup=clear_test_dir)
+def test_cgroups_are_stopped_once_their_processes_are_gone():
+    group = cgroup.Group('t', root=os.path.abspath(test_dir))
+    os.makedirs(group.path)
+    for name in ['cgroup.kill', 'cgroup.events']:
+        with open(group.file(name), 'w') as h:
+            h.write('populated 1\n')
+
+    def exit():
+        with open(group.file('cgroup.events'), 'w') as h:
+            h.write('populated 0\n')
+
+    timer = threading.Timer(0.1, exit)
+    timer.start()
+    started = time.time()
+    group.stop()
+    assert time.time() - started >= 0.1 and not group.populated()
+    assert open(group.file('cgroup.kill')).read() == '1'
+
+
+@with_setup(setup=clear_test_dir)
+def test_spools_skip_temporary_and_partial_files():
+    os.makedirs(test_dir)
+    name = str(uuid.uuid4())
+    for f in [name, name + '.a1B2c3']:
+        with open(os.path.join(test_dir, f), 'w') as h:
+            h.write('{"channel": "test.exa')
+    assert list(read_spool(test_dir)) == []
+
+
+@with_setup(setup=clear_test_dir)
+def test_spools_quarantine_invalid_envelopes():
+    spool = os.path.join(test_dir, 'i')
+    os.makedirs(spool)
+    m = run.Run(dict(uuid=str(uuid.uuid4()),
+                     task=dict(lock='test', code=[dict(word='true')])))
+    envelope = Envelope(dict(channel='test.example.com',
+                             sender='rx@test.example.com', data=m))
+    name = str(envelope.uuid)
+    text = Envelope.marshal(envelope).replace('rx@test.example.com', 'rx')
+    with open(os.path.join(spool, name), 'w') as h:
+        h.write(text)
+    assert list(read_spool(spool)) == []
+    assert os.listdir(spool) == []
+    assert os.listdir(os.path.join(test_dir, 'quarantine', 'i')) == [name]
+    assert list(read_spool(spool)) == []
+
+
+@with_setup(setup=clear_test_dir)
+def test_tasks_are_not_run_again_on_restart():
+    task = dict(lock='test', code=[dict(word='true')])
+    m = run.Run(dict(uuid=str(uuid.uuid4()), task=task))
+    sender = 'rx@test.example.com'             # Not named for this host
+    envelope = Envelope(dict(channel='test.example.com', sender=sender,
+                             data=m))
+    admitted = []
+
+    def rx():
+        r = Rx(service='test.example.com', spools=test_dir)
+        r.admit = lambda envelope, **kwargs: admitted.append(envelope.uuid)
+        mkdir('-p', r.i(), r.o())
+        return r
+
+    first = rx()
+    with open(first.i(str(envelope.uuid)), 'w') as h:
+        Envelope.marshal(envelope, h)
+    first.sync()
+    first.dispatch()
+    assert admitted == [envelope.uuid]
+    done = run.Status(dict(uuid=m.uuid, status=Status.success))
+    first.results.put(Envelope(dict(channel='test.example.com', sender=sender,
+                                    refs=[envelope.uuid], data=done)))
+    first.sync()
+    second = rx()
+    second.sync()
+    second.dispatch()
+    assert admitted == [envelope.uuid], 'A finished task was run again.'
@@ -0,0 +1,82 @@
+"""The environment and working directory that a task's commands run in.
+
+``//env`` and ``//cd`` change the scope of the thread running the task,
+rather than those of the process, so that tasks (and branches of a task run
+concurrently, see ``task.Graph``) do not see each other's changes. Commands
+are run with the scope's environment, from its directory.
+"""
+from contextlib import contextmanager
+import errno
+import os
+import re
+import threading
+
+
+_local = threading.local()
+
+
+class Scope(object):
+    """
+    >>> s = Scope(env={'A': 'a'}, cwd='/')
+    >>> t = s.fork()
+    >>> t.env['A'] = 'b'
+    >>> t.cd('tmp')
+    >>> (s.env['A'], s.cwd), (t.env['A'], t.cwd)
+    (('a', '/'), ('b', '/tmp'))
+    >>> t.expand('$A/${A}/$B')
+    'b/b/$B'
+    >>> t.changes(), s.changes()
+    ({'A': 'b'}, {})
+    """
+    def __init__(self, env=None, cwd=None, base=None):
+        self.env = dict(os.environ if env is None else env)
+        self.cwd = os.getcwd() if cwd is None else cwd
+        self.base = dict(self.env) if base is None else base
+
+    def fork(self):
+        """A copy, for a branch whose changes should not be seen here."""
+        return Scope(self.env, self.cwd, self.base)
+
+    def changes(self):
+        """The variables set, or unset (as ``None``), since the scope was
+           made; forks share the environment they started from.
+        """
+        changed = {k: v for k, v in self.env.items()
+                   if self.base.get(k) != v}
+        changed.update((k, None) for k in self.base if k not in self.env)
+        return changed
+
+    def cd(self, d):
+        d = os.path.normpath(os.path.join(self.cwd, d))
+        if not os.path.isdir(d):
+            raise OSError(errno.ENOENT, 'No such directory', d)
+        self.cwd = d
+
+    def expand(self, s):
+        """Expand ``$VAR`` and ``${VAR}``, like ``os.path.expandvars``, with
+           the scope's environment.
+        """
+        def var(m):
+            name = m.group(1).strip('{}')
+            return self.env.get(name, m.group(0))
+        return variable.sub(var, s)
+
+
+variable = re.compile(r'\$(\w+|\{[^}]*\})')
+
+
+@contextmanager
+def scoping(scope):
+    """Run commands in this thread in ``scope``."""
+    outer = current()
+    _local.scope = scope
+    try:
+        yield scope
+    finally:
+        _local.scope = outer
+
+
+def current():
+    """The scope of this thread, or one like that of the process."""
+    scope = getattr(_local, 'scope', None)
+    return scope if scope is not None else Scope()
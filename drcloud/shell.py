@@ -0,0 +1,228 @@
+"""Run a task's commands in a long lived shell, rather than a process each.
+
+A ``Shell`` is started once, and commands are written to its standard input
+one at a time. Each runs in a subshell, in the directory and with the
+environment of its scope (see ``scope``), so the shell itself is not changed
+by them; its exit status is written to file descriptor 3, which is how we
+know where the command ended::
+
+    (cd /dir && export A=b && exec cmd arg) </dev/null; echo $? >&3
+
+When there is a capture for the thread starting the shell, output is read as
+it arrives and passed on, a line at a time, as with ``capture.call()``.
+Likewise, the shell starts in the cgroup of that thread, if it has one.
+
+A ``Session`` holds the shells of a task: one for each command running at
+once, started when first needed and stopped when the task is done.
+"""
+from contextlib import contextmanager
+import errno
+import os
+from pipes import quote
+import re
+import select
+import subprocess
+import threading
+
+from . import capture, cgroup, err
+from .logger import log
+
+
+_local = threading.local()
+
+
+class Shell(object):
+    def __init__(self, c=None):
+        self.capture = c
+        self.env = dict(os.environ)
+        r, w = os.pipe()
+        out = subprocess.PIPE if c is not None else None
+        enter = cgroup.preexec()
+
+        def framing():
+            if enter is not None:
+                enter()
+            os.dup2(w, 3)
+            os.closerange(4, subprocess.MAXFD)
+
+        self.p = subprocess.Popen(['/bin/sh'], stdin=subprocess.PIPE,
+                                  stdout=out, stderr=out, cwd='/',
+                                  preexec_fn=framing)
+        os.close(w)
+        self.status = r
+        self._partial = {}
+        if c is not None:
+            self._partial = {self.p.stdout.fileno(): ('o', ''),
+                             self.p.stderr.fileno(): ('e', '')}
+
+    def run(self, argv, scope):
+        """Run a command like ``capture.call()``, in ``scope``."""
+        self.p.stdin.write(self.script(argv, scope))
+        self.p.stdin.flush()
+        code = self._wait()
+        if code != 0:
+            raise subprocess.CalledProcessError(code, argv)
+        return code
+
+    def script(self, argv, scope):
+        """A line of shell to run ``argv`` in ``scope``.
+
+        >>> from .scope import Scope
+        >>> sh = Shell.__new__(Shell)
+        >>> sh.env = dict(A='a', B='b')
+        >>> scope = Scope(dict(A='a', C='c d'), '/tmp')
+        >>> print sh.script(['echo', 'hi'], scope).strip()
+        (cd /tmp && unset B && export C='c d' && exec echo hi) </dev/null; \
+echo $? >&3
+        """
+        steps = ['cd %s' % quote(scope.cwd)]
+        unset = [k for k in sorted(self.env)
+                 if k not in scope.env and valid.match(k)]
+        if len(unset) > 0:
+            steps += ['unset %s' % ' '.join(unset)]
+        changed = ['%s=%s' % (k, quote(v))
+                   for k, v in sorted(scope.env.items())
+                   if self.env.get(k) != v and name(k)]
+        if len(changed) > 0:
+            steps += ['export %s' % ' '.join(changed)]
+        steps += ['exec %s' % ' '.join(quote(arg) for arg in argv)]
+        line = '(%s) </dev/null; echo $? >&3\n' % ' && '.join(steps)
+        return line.encode('utf-8') if isinstance(line, unicode) else line
+
+    def _wait(self):
+        """Pass on output until the exit status of the command arrives."""
+        status = ''
+        while not status.endswith('\n'):
+            fds = [self.status] + list(self._partial)
+            ready = self._select(fds, capture.interval)
+            for fd in ready:
+                if fd == self.status:
+                    data = os.read(fd, 64)
+                    if data == '':
+                        raise Err('The shell exited, with status %s.' %
+                                  self.p.wait())
+                    status += data
+                else:
+                    self._read(fd)
+            if self.capture is not None:
+                self.capture.tick()
+        while len(self._drain()) > 0:      # Written before the status was
+            pass
+        return int(status)
+
+    def _drain(self):
+        ready = self._select(list(self._partial), 0)
+        for fd in ready:
+            self._read(fd)
+        for fd, (stream, buffered) in self._partial.items():
+            if buffered != '':
+                self.capture.line(stream, buffered)
+                self._partial[fd] = (stream, '')
+        if self.capture is not None:
+            self.capture.flush()
+        return ready
+
+    def _read(self, fd):
+        stream, buffered = self._partial[fd]
+        data = os.read(fd, 65536)
+        if data == '':
+            raise Err('The shell closed its output.')
+        chunks = (buffered + data).split('\n')
+        for s in chunks[:-1]:
+            self.capture.line(stream, s)
+        self._partial[fd] = (stream, chunks[-1])
+
+    def _select(self, fds, timeout):
+        if len(fds) == 0:
+            return []
+        while True:
+            try:
+                return select.select(fds, [], [], timeout)[0]
+            except select.error as e:
+                if e.args[0] != errno.EINTR:
+                    raise
+
+    def close(self):
+        try:
+            self.p.stdin.close()
+        except IOError:
+            pass
+        self.p.wait()
+        for h in [self.p.stdout, self.p.stderr]:
+            if h is not None:
+                h.close()
+        os.close(self.status)
+
+
+class Session(object):
+    """The shells of a task, started as they are needed and reused."""
+    def __init__(self):
+        self._idle = []
+        self._all = []
+        self._lk = threading.Lock()
+
+    @contextmanager
+    def lease(self):
+        """Hold a shell, to run a command in."""
+        with self._lk:
+            sh = self._idle.pop() if len(self._idle) > 0 else None
+        if sh is None:
+            sh = Shell(capture.current())
+            with self._lk:
+                self._all += [sh]
+        try:
+            yield sh
+        finally:
+            with self._lk:
+                self._idle += [sh]
+
+    def close(self):
+        for sh in self._all:
+            try:
+                sh.close()
+            except Exception as e:
+                log.warning('Failed to stop shell %s: %s', sh.p.pid, e)
+        self._all, self._idle = [], []
+
+
+@contextmanager
+def session():
+    """Run commands of this thread in shells, until the block exits."""
+    s = Session()
+    try:
+        with using(s):
+            yield s
+    finally:
+        s.close()
+
+
+@contextmanager
+def using(s):
+    """Run commands of this thread in the shells of a session (or not, if it
+       is ``None``).
+    """
+    outer = current()
+    _local.session = s
+    try:
+        yield s
+    finally:
+        _local.session = outer
+
+
+def current():
+    return getattr(_local, 'session', None)
+
+
+valid = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+
+def name(k):
+    """Whether ``k`` can be exported by the shell."""
+    if valid.match(k) is None:
+        log.warning('Not exporting %s, which is not a valid name.', k)
+        return False
+    return True
+
+
+class Err(err.Err):
+    pass
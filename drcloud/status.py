@@ -9,6 +9,7 @@ class Status(str, Enum):
     started = 'started'
     success = 'success'
     failure = 'failure'
+    shed = 'shed'                       # Not run, the node being too busy
 
 
 class StatusType(BaseType):
@@ -20,4 +21,4 @@ class StatusType(BaseType):
         return Status.__members__[value]
 
     def to_primitive(self, value, context=None):
-        return str(value)
+        return value.value if isinstance(value, Status) else str(value)
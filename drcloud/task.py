@@ -12,42 +12,111 @@ Tasks may be one or many commands and may have labels.
 """
 import binascii
 from collections import OrderedDict
-from fnmatch import fnmatchcase
+from fnmatch import translate
 import os
-import subprocess
+import re
 import tempfile
+import threading
 
 from schematics.models import Model
-from schematics.types import BaseType, BooleanType, StringType
+from schematics.types import (BaseType, BooleanType, FloatType, IntType,
+                              StringType)
 from schematics.types.compound import DictType, ListType, ModelType
 
+from . import artifacts, capture, cgroup, err, memo, shell
 from .dns import DomainNameType
 from .logger import log
+from .scope import Scope, current, scoping
 
 
 class CmdWordType(BaseType):
     def to_native(self, value, context=None):
+        if isinstance(value, CmdWord):
+            return value
         return CmdWord.parse(value)
 
     def to_primitive(self, value, context=None):
         return value.s
 
 
-class TaskOptionType(BaseType):
-    def to_native(self, value, context=None):
-        return TaskOptions.parse(value)
-
-    def to_primitive(self, value, context=None):
-        return value.s
-
-
 class Cmd(Model):
+    """
+    :ivar name: A name, by which other commands may refer to this one.
+    :ivar after: Names of commands to run this one after. If any command of
+                 a task has these, the task is run as a graph (see
+                 ``Graph``), rather than in order.
+    """
     word = CmdWordType(required=True)
     args = ListType(StringType())
     formerly = ListType(StringType())
+    name = StringType()
+    after = ListType(StringType())
+
+    class Options:
+        serialize_when_none = False
 
     def run(self, **kwargs):
-        return self.word(*self.args, **kwargs)
+        return self.word(*(self.args or []), **kwargs)
+
+    def memoized(self, results, memoize=False, memo_ttl=None, **kwargs):
+        """Run the command, unless ``memoize`` is set and it has succeeded
+           before; in which case, return ``True``.
+
+        Internal commands, like ``//cd`` and ``//env``, are always run: the
+        commands after them depend on the scope they leave.
+        """
+        if not memoize or isinstance(self.word, Internal):
+            log.debug('Running %s', self)
+            self.run(**kwargs)
+            return False
+        scope = current()
+        key = results.key(self.word.s, self.args or [], kwargs,
+                          scope.changes(), scope.cwd)
+        if results.fresh(key, memo_ttl):
+            return True
+        log.debug('Running %s', self)
+        self.run(**kwargs)
+        results.record(key)
+        return False
+
+
+class TaskOptions(Model):
+    """
+    :ivar insecure_download: Do not check certificates when downloading.
+    :ivar sha256: The digest that downloaded content must have. An artifact
+                  already cached with this digest is used without checking
+                  for a newer one.
+    :ivar memoize: Skip the command if it has already succeeded, with the
+                   same arguments, options, environment and directory (see
+                   ``memo``).
+    :ivar memo_ttl: How long, in seconds, success is remembered for.
+    :ivar cpu: How many CPUs the command keeps busy, for admission control
+               (see ``rx.admission``).
+    :ivar memory: How much memory the command needs, in MiB.
+    """
+    insecure_download = BooleanType()
+    sha256 = StringType(regex='^[0-9a-f]{64}$')
+    memoize = BooleanType()
+    memo_ttl = IntType(min_value=0)
+    cpu = FloatType(min_value=0)
+    memory = IntType(min_value=0)
+
+    class Options:
+        serialize_when_none = False
+
+
+class Limits(Model):
+    """
+    :ivar cpu: How many CPUs the task may use (``cpu.max``).
+    :ivar memory: How much memory the task may use, in MiB (``memory.max``).
+    :ivar account: Report what the task used (the default).
+    """
+    cpu = FloatType(min_value=0.01)
+    memory = IntType(min_value=1)
+    account = BooleanType(default=True)
+
+    class Options:
+        serialize_when_none = False
 
 
 class Task(Model):
@@ -60,32 +129,241 @@ class Task(Model):
                 like ``//env``.
     :ivar options: Options to apply to commands, as key value pairs. The keys
                    are glob expressions that match command names or URLs in the
-                   the ``code`` array. The values are arrays of option strings.
+                   the ``code`` array. The values are ``TaskOptions``.
+    :ivar concurrency: How many commands may run at once, when the task is
+                       run as a graph.
+    :ivar executor: How commands are started: ``exec``, a process for each
+                    (the default), or ``shell``, in a shell kept for the
+                    whole task (see ``shell``).
+    :ivar cgroup: Run the task in a cgroup of its own, with these ``Limits``
+                  (see ``cgroup``).
     """
     lock = DomainNameType(required=True, default='run')
     label = StringType()
     code = ListType(ModelType(Cmd), required=True)
-    options = DictType(TaskOptionType())
+    options = DictType(ModelType(TaskOptions))
+    concurrency = IntType(min_value=1)
+    executor = StringType(choices=['exec', 'shell'])
+    cgroup = ModelType(Limits)
 
     class Options:
         serialize_when_none = False
 
-    def run(self):
-        for cmd in self.code:
-            log.debug('Running %s', cmd)
-            options = TaskOptions()
-            if self.options is not None:
-                for pattern, opts in self.options.items():
-                    if fnmatchcase(cmd.word.s, pattern):
-                        options = opts
-            cmd.run(**(options.to_native() or {}))
-
-
-class TaskOptions(Model):
-    insecure_download = BooleanType()
-
-    class Options:
-        serialize_when_none = False
+    def run(self, results=None):
+        """Run the commands in order, or as a graph if they have ``after``.
+
+        :param results: The ``memo.Memo`` for commands to be memoized with.
+        :returns: The indices of commands skipped because they were memoized.
+        """
+        if self.executor == 'shell':
+            with shell.session():
+                return self._run(results or memo.results)
+        return self._run(results or memo.results)
+
+    def _run(self, results):
+        table = OptionTable(self.options or {})
+        skipped = []
+
+        def step(i):
+            cmd = self.code[i]
+            options = table.match(cmd.word.s) or TaskOptions()
+            kwargs = options.to_native() or {}
+            for k in ['cpu', 'memory']:
+                kwargs.pop(k, None)
+            if cmd.memoized(results, **kwargs):
+                log.info('Skipped %s, which has already succeeded.', cmd)
+                skipped.append(i)
+
+        if any(cmd.after for cmd in self.code):
+            Graph(self.code).run(step, Scope(),
+                                 self.concurrency or concurrency)
+        else:
+            with scoping(Scope()):
+                for i in range(len(self.code)):
+                    step(i)
+        return sorted(skipped)
+
+    def weight(self):
+        """The most CPU and memory any command declares it needs, as a
+           ``(cpu, memory)`` pair; ``None`` for either, if none does.
+        """
+        table = OptionTable(self.options or {})
+        found = [table.match(cmd.word.s) for cmd in self.code]
+        found = [options for options in found if options is not None]
+        cpu = [o.cpu for o in found if o.cpu is not None]
+        memory = [o.memory for o in found if o.memory is not None]
+        return (max(cpu) if cpu else None, max(memory) if memory else None)
+
+
+concurrency = 4
+
+
+class Graph(object):
+    """Commands run as soon as the commands they are ``after`` succeed.
+
+    Commands whose dependencies have all succeeded run concurrently, in
+    threads, up to a limit. Each starts in a copy of the scope left by the
+    first command it is after (or of the task's scope, if it is after none),
+    so that ``//cd`` and ``//env`` affect only the branch they are in. When a
+    command fails, the commands that depend on it are not run; the others
+    are, and then the first failure is raised.
+
+    >>> code = [Cmd(dict(word='a', name='a')),
+    ...         Cmd(dict(word='b', name='b', after=['a'])),
+    ...         Cmd(dict(word='c', after=['a', 'b']))]
+    >>> Graph(code).after
+    [[], [0], [0, 1]]
+    >>> Graph(code[1:])
+    Traceback (most recent call last):
+    ...
+    Err: No command named a.
+    """
+    def __init__(self, code):
+        names = {}
+        for i, cmd in enumerate(code):
+            if cmd.name is None:
+                continue
+            if cmd.name in names:
+                raise Err('Two commands are named %s.' % cmd.name)
+            names[cmd.name] = i
+        self.after = []
+        for cmd in code:
+            missing = [n for n in cmd.after or [] if n not in names]
+            if len(missing) > 0:
+                raise Err('No command named %s.' % ', '.join(missing))
+            self.after += [[names[n] for n in cmd.after or []]]
+        self.order = self._order()
+
+    def _order(self):
+        """The commands in an order that respects dependencies."""
+        order, seen = [], set()
+        while len(order) < len(self.after):
+            ready = [i for i, after in enumerate(self.after)
+                     if i not in seen and all(j in seen for j in after)]
+            if len(ready) == 0:
+                raise Err('Commands depend on each other in a cycle.')
+            order += ready
+            seen.update(ready)
+        return order
+
+    def run(self, step, scope, concurrency):
+        """Call ``step(i)`` for each command, in its scope, as its
+           dependencies succeed.
+        """
+        self._state, self._scopes, self._errors = {}, {}, []
+        self._cv = threading.Condition()
+        threads = []
+        with self._cv:
+            while True:
+                self._cut()
+                running = self._state.values().count(running_)
+                for i in self._ready()[:concurrency - running]:
+                    threads += [self._start(i, step, scope)]
+                    running += 1
+                if running == 0:
+                    break
+                self._cv.wait()
+        for t in threads:
+            t.join()
+        cut = sorted(i for i, s in self._state.items() if s == cut_)
+        if len(cut) > 0:
+            log.warning('Not run, after a failure: %s', cut)
+        if len(self._errors) > 0:
+            raise self._errors[0]
+
+    def _ready(self):
+        return [i for i in self.order if i not in self._state and
+                all(self._state.get(j) == done_ for j in self.after[i])]
+
+    def _cut(self):
+        for i in self.order:
+            if i not in self._state and \
+               any(self._state.get(j) in [failed_, cut_]
+                   for j in self.after[i]):
+                self._state[i] = cut_
+
+    def _start(self, i, step, scope):
+        after = self.after[i]
+        scope = (self._scopes[after[0]] if after else scope).fork()
+        self._state[i] = running_
+        t = threading.Thread(target=self._work, name='%s:%s' % (__name__, i),
+                             args=(i, step, scope, capture.current(),
+                                   shell.current(), cgroup.active()))
+        t.daemon = True
+        t.start()
+        return t
+
+    def _work(self, i, step, scope, c, session, group):
+        try:
+            with scoping(scope), capture.capturing(c), \
+                 shell.using(session), cgroup.using(group):
+                step(i)
+            outcome = done_
+        except Exception as e:
+            log.error('Command %s failed: %s', i, e)
+            self._errors.append(e)
+            outcome = failed_
+        with self._cv:
+            self._state[i] = outcome
+            self._scopes[i] = scope
+            self._cv.notify_all()
+
+
+running_, done_, failed_, cut_ = 'running', 'done', 'failed', 'cut'
+
+
+class OptionTable(object):
+    """Options for each command word, from glob patterns.
+
+    Patterns are tried in order and the last one to match wins, as though
+    each were checked with ``fnmatchcase``; but literal patterns are looked
+    up in a dict, the globs are compiled into a few combined expressions, and
+    each distinct word is matched only once.
+
+    >>> table = OptionTable(OrderedDict([('*', 1), ('ls', 2), ('l*', 3)]))
+    >>> table.match('ls'), table.match('cat')
+    (3, 1)
+    >>> OptionTable({'x': 1}).match('y') is None
+    True
+    """
+    chunk = 90                # Python 2 allows 100 groups in an expression
+
+    def __init__(self, options):
+        self.values = list(options.values())
+        self.literals = {}
+        globs = []
+        for i, pattern in enumerate(options):
+            if glob_chars.search(pattern) is None:
+                self.literals[pattern] = i
+            else:
+                globs += [(i, pattern)]
+        globs.reverse()                     # So the first to match is last
+        self.globs = []
+        for n in range(0, len(globs), self.chunk):
+            some = globs[n:n + self.chunk]
+            expr = '|'.join('(%s)' % translate(p)[:-len('(?ms)')]
+                            for _, p in some)
+            self.globs += [(re.compile('(?ms)' + expr),
+                            [i for i, _ in some])]
+        self._memo = {}
+
+    def match(self, word):
+        if word not in self._memo:
+            i = self._index(word)
+            self._memo[word] = None if i is None else self.values[i]
+        return self._memo[word]
+
+    def _index(self, word):
+        found = self.literals.get(word)
+        for regex, indices in self.globs:
+            m = regex.match(word)
+            if m is not None:
+                i = indices[m.lastindex - 1]
+                return i if found is None else max(found, i)
+        return found
+
+
+glob_chars = re.compile(r'[*?[]')
 
 
 class CmdWord(Model):
@@ -127,7 +405,7 @@ class System(CmdWord):
         assert '//' not in self.s
 
     def __call__(self, *args, **kwargs):
-        subprocess.check_call([self.s] + list(args))
+        call([self.s] + list(args))
 
 
 class URL(CmdWord):
@@ -136,9 +414,9 @@ class URL(CmdWord):
 
     def __call__(self, *args, **kwargs):
         assert 'url' not in kwargs
-        for word, f in reversed(Internal.handlers.items()):
+        for word, f in reversed(URL.handlers.items()):
             if self.s.startswith(word):
-                return f(url=self.s, *args, **kwargs)
+                return f(self.s, *args, **kwargs)
         raise NotImplementedError('No handler for %s URLs.',
                                   self.s.split('://')[0])
 
@@ -173,7 +451,7 @@ def handler(*patterns):
 
 @handler('//env')
 def env(key, value):
-    os.environ[key] = value
+    current().env[key] = value
     # TODO: Allow retrieval of values as URLs.
 
 
@@ -186,14 +464,21 @@ def source(something):
     raise NotImplementedError('Impossible.')
 
 
+@handler('//forget')
+def forget(*words):
+    """Drop memoized results of the given commands, or of all commands."""
+    memo.results.forget(*words)
+
+
 @handler('//cd')
 def cd(d):
-    os.chdir(d)
+    current().cd(d)
 
 
 @handler('//cd+')
 def cd_expand(d):
-    os.chdir(os.path.expandvars(os.path.expanduser(d)))
+    scope = current()
+    scope.cd(os.path.expanduser(scope.expand(d)))
 
 
 @handler('//x')
@@ -202,30 +487,41 @@ def x(code, *args):
         os.chmod(h.name, 0750)
         h.write(binascii.unhexlify(''.join(code.splitlines())))
         h.flush()
-        subprocess.check_call([h.name] + list(args))
+        call([h.name] + list(args))
 
 
-@handler('https://')
-def https(url=None, insecure_download=False, *args):
-    return curlx(url=url, options=['--insecure'], *args)
+@handler('https://', 'http://')
+def urlx(url, *args, **options):
+    def fetcher(*a, **kw):
+        insecure = options.get('insecure_download') or False
+        return artifacts.http(insecure=insecure, *a, **kw)
+    cached(url, fetcher, *args, **options)
 
 
-@handler('http://')
-def http(url=None, *args):
-    return curlx(url=url, *args)
+@handler('s3://')
+def s3x(url, *args, **options):
+    cached(url, artifacts.s3, *args, **options)
 
 
-def curlx(url=None, options=[], *args):
-    with tempfile.NamedTemporaryFile(suffix='.drcloud') as h:
-        os.chmod(h.name, 0750)
-        curl = ['curl', '-o', h.name, '--retry', 2, '-sSfL'] + options + [url]
-        subprocess.check_call(curl)
-        subprocess.check_call([h.name] + list(args))
+def cached(url, fetcher, *args, **options):
+    """Run an executable from the artifact cache, downloading it if needed.
+    """
+    with artifacts.cache.fetch(url, fetcher, options.get('sha256')) as path:
+        call([path] + list(args))
 
 
-@handler('s3://')
-def s3x(url=None, *args):
-    with tempfile.NamedTemporaryFile(suffix='.drcloud') as h:
-        os.chmod(h.name, 0750)
-        subprocess.check_call(['aws', 's3', 'cp', url, h.name])
-        subprocess.check_call([h.name] + list(args))
+def call(argv):
+    """Run a command in the current scope, capturing its output, in a shell
+       of the current session if there is one.
+    """
+    scope = current()
+    session = shell.current()
+    if session is None:
+        capture.call(argv, env=scope.env, cwd=scope.cwd)
+        return
+    with session.lease() as sh:
+        sh.run(argv, scope)
+
+
+class Err(err.Err):
+    pass